@@ -0,0 +1,222 @@
+"""
+OptiTrack to coil time alignment
+
+The coil products and the optitrack poses are sampled on two different clocks.
+This module maps the two streams onto a common timeline without ever
+upsampling the optitrack data to the coil sampling rate.
+
+Alignment targets:
+    coil      : the optitrack pose is interpolated at every coil frame time
+    optitrack : the coil products are resampled (decimated) at the optitrack
+                timestamps, every frame gets an exact optitrack row
+
+Interpolation methods (for the "coil" target):
+    nearest : the nearest optitrack row
+    linear  : position is linearly interpolated, the orientation quaternion
+              is spherically interpolated (SLERP)
+
+Every function works on one run of frames at a time with searchsorted lookups
+and no python loops over frames, so alignment streams along with the rest of
+the pipeline.
+
+Optitrack rows are (frame_index, timestamp, x, y, z, qx, qy, qz, qw). Both
+timelines are in seconds from the start of their capture.
+"""
+import numpy as np
+
+ALIGN_TARGETS = ("coil", "optitrack")
+ALIGN_METHODS = ("nearest", "linear")
+
+# columns of an optitrack row
+FRAME_COLUMN = 0
+TIME_COLUMN = 1
+POSITION_COLUMNS = slice(2, 5)
+QUATERNION_COLUMNS = slice(5, 9)
+
+# below this angle between quaternions SLERP falls back to normalized lerp
+_SLERP_THRESHOLD = 1e-6
+
+
+def optitrack_times(optitrack):
+    """the optitrack timestamps in seconds from the first row
+
+    Args:
+        optitrack (np.ndarray): optitrack data, shape (nframes, 9)
+
+    Returns:
+        np.ndarray : the timestamps, shape (nframes,)
+    """
+    return optitrack[:,TIME_COLUMN] - optitrack[0,TIME_COLUMN]
+
+
+def bracket(timestamps, times):
+    """finds the pair of samples on either side of every time
+
+    Times outside of the timestamps are clamped to the first or last sample.
+
+    Args:
+        timestamps (np.ndarray): increasing sample times, shape (n,)
+        times (np.ndarray): times to look up, shape (m,)
+
+    Returns:
+        np.ndarray : index of the sample at or before each time, shape (m,)
+        np.ndarray : fraction of the way to the following sample, between
+            0 and 1, shape (m,)
+    """
+    if timestamps.size == 1:
+        return np.zeros(times.shape, dtype=np.intp), np.zeros(times.shape)
+    upper = np.searchsorted(timestamps, times, side="right").clip(1, timestamps.size - 1)
+    lower = upper - 1
+    fraction = (times - timestamps[lower]) / (timestamps[upper] - timestamps[lower])
+    return lower, np.clip(fraction, 0, 1, out=fraction)
+
+
+def slerp(q0, q1, t, out=None):
+    """spherical linear interpolation between unit quaternions
+
+    Args:
+        q0 (np.ndarray): start quaternions, shape (n, 4)
+        q1 (np.ndarray): end quaternions, shape (n, 4)
+        t (np.ndarray): interpolation fraction between 0 and 1, shape (n,)
+        out (np.ndarray): array to write the result into, shape (n, 4)
+
+    Returns:
+        np.ndarray : unit quaternions, shape (n, 4)
+    """
+    dot = np.einsum("ij,ij->i", q0, q1)
+    # q and -q are the same rotation, take the short way around
+    sign = np.where(dot < 0, -1.0, 1.0)
+    dot = np.minimum(np.abs(dot), 1)
+
+    omega = np.arccos(dot)
+    sin_omega = np.sin(omega)
+    small = sin_omega < _SLERP_THRESHOLD
+    sin_omega[small] = 1
+    w0 = np.where(small, 1 - t, np.sin((1 - t) * omega) / sin_omega)
+    w1 = np.where(small, t, np.sin(t * omega) / sin_omega) * sign
+
+    out = np.multiply(q0, w0[:,np.newaxis], out=out)
+    out += q1 * w1[:,np.newaxis]
+    # renormalize to stop lerp (and rounding) from drifting off the unit sphere
+    out /= np.linalg.norm(out, axis=1, keepdims=True)
+    return out
+
+
+def interpolate_poses(optitrack, times, method="nearest", out=None):
+    """finds the optitrack pose at arbitrary times
+
+    Args:
+        optitrack (np.ndarray): optitrack data, shape (nframes, 9)
+        times (np.ndarray): times in seconds from the first optitrack row,
+            shape (n,)
+        method (str): "nearest" or "linear"
+        out (np.ndarray): array to write the poses into, shape (n, 9)
+
+    Returns:
+        np.ndarray : optitrack rows at every time, shape (n, 9). With "linear"
+            the frame index column holds the nearest optitrack frame and the
+            timestamp column is the requested time on the optitrack clock
+    """
+    if method not in ALIGN_METHODS:
+        raise ValueError("unknown alignment method '{}', must be one of {}".format(method, ALIGN_METHODS))
+    timestamps = optitrack_times(optitrack)
+    lower, fraction = bracket(timestamps, times)
+    upper = np.minimum(lower + 1, timestamps.size - 1)
+    nearest = np.where(fraction >= 0.5, upper, lower)
+
+    if method == "nearest":
+        return np.take(optitrack, nearest, axis=0, out=out)
+
+    if out is None:
+        out = np.empty( (times.shape[0], optitrack.shape[1]) )
+    out[:,FRAME_COLUMN] = optitrack[nearest, FRAME_COLUMN]
+    out[:,TIME_COLUMN] = times + optitrack[0,TIME_COLUMN]
+
+    p0 = optitrack[lower, POSITION_COLUMNS]
+    p1 = optitrack[upper, POSITION_COLUMNS]
+    out[:,POSITION_COLUMNS] = p0 + fraction[:,np.newaxis] * (p1 - p0)
+
+    out[:,QUATERNION_COLUMNS] = slerp(optitrack[lower, QUATERNION_COLUMNS],
+                                        optitrack[upper, QUATERNION_COLUMNS],
+                                        fraction)
+    return out
+
+
+def interpolate_phase(p0, p1, t):
+    """linearly interpolates between phases the short way around the circle
+
+    Args:
+        p0 (np.ndarray): start phase in radians
+        p1 (np.ndarray): end phase in radians
+        t (np.ndarray): interpolation fraction, broadcastable against p0
+
+    Returns:
+        np.ndarray : phase in radians between -pi and pi
+    """
+    step = np.mod(p1 - p0 + np.pi, 2 * np.pi) - np.pi
+    phase = p0 + t * step
+    return np.mod(phase + np.pi, 2 * np.pi) - np.pi
+
+
+class FrameResampler(object):
+    """Resamples demodulated coil frames at the optitrack timestamps
+
+    Coil frames arrive in runs (one per block of the capture). The last frame
+    of every run is kept, so that optitrack rows falling between two runs are
+    interpolated exactly as if the capture had been processed in one piece.
+    Amplitude is interpolated linearly and phase along the shortest arc.
+
+    Optitrack rows after the final coil frame are never produced, there is no
+    coil data for them.
+
+    Args:
+        optitrack (np.ndarray): optitrack data, shape (nframes, 9)
+    """
+    def __init__(self, optitrack):
+        self.optitrack = optitrack
+        self.timestamps = optitrack_times(optitrack)
+        self.reset()
+
+    def reset(self):
+        """starts again from the first optitrack row"""
+        self._next = 0
+        self._last = None
+
+    def resample(self, frame_times, amplitude, phase):
+        """resamples a run of coil frames
+
+        Args:
+            frame_times (np.ndarray): coil frame times in seconds, shape (frames,)
+            amplitude (np.ndarray): amplitude, shape (frames, channels, bands)
+            phase (np.ndarray): phase in radians, shape (frames, channels, bands)
+
+        Returns:
+            np.ndarray : optitrack times in seconds, shape (n,)
+            np.ndarray : amplitude at those times, shape (n, channels, bands)
+            np.ndarray : phase at those times, shape (n, channels, bands)
+            np.ndarray : the optitrack rows at those times, shape (n, 9)
+        """
+        if frame_times.shape[0] == 0:
+            return self._empty(amplitude)
+        if self._last is not None:
+            frame_times = np.concatenate( (self._last[0], frame_times) )
+            amplitude = np.concatenate( (self._last[1], amplitude) )
+            phase = np.concatenate( (self._last[2], phase) )
+        self._last = (frame_times[-1:], amplitude[-1:].copy(), phase[-1:].copy())
+
+        stop = np.searchsorted(self.timestamps, frame_times[-1], side="right")
+        rows = slice(self._next, stop)
+        self._next = max(stop, self._next)
+        times = self.timestamps[rows]
+
+        lower, fraction = bracket(frame_times, times)
+        upper = np.minimum(lower + 1, frame_times.size - 1)
+        # in the precision of the products, float64 fractions would promote them
+        fraction = fraction[:,np.newaxis,np.newaxis].astype(amplitude.dtype)
+        amp = amplitude[lower] + fraction * (amplitude[upper] - amplitude[lower])
+        ph = interpolate_phase(phase[lower], phase[upper], fraction)
+        return times, amp, ph, self.optitrack[rows]
+
+    def _empty(self, like):
+        shape = (0,) + like.shape[1:]
+        return np.empty(0), np.empty(shape, dtype=like.dtype), np.empty(shape, dtype=like.dtype), self.optitrack[:0]
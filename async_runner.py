@@ -0,0 +1,191 @@
+"""
+Overlapped pipeline runs
+
+`CoilPipeline.run` pulls every block through reading, filtering and
+demodulation one after the other, so the disk and all but one core sit idle
+while a block is filtered. `AsyncRunner` runs the same stages as asyncio tasks
+connected by bounded queues:
+
+    read -> filter -> demodulate -> frames (normalize ... align)
+
+Every stage does its numpy/scipy work in a thread pool (sosfilt, the FFTs and
+large ufuncs release the GIL), so while block k is being filtered block k+1 is
+read and block k-1 is demodulated. The stages are stateful, so each one still
+handles its blocks in order, one at a time.
+
+Every queue holds at most `queue_size` blocks. A stage that gets ahead waits
+for room downstream (backpressure), so no more than
+`(queue_size + 1) * number of stages` blocks are in memory no matter how long
+the capture is.
+
+The results are identical to `CoilPipeline.run`. Zero-phase filtering needs
+the whole capture at once and can't be overlapped.
+
+    runner = async_runner.AsyncRunner(pipeline.CoilPipeline(calib))
+    result = runner.run("coil.cap", "optitrack.cap")
+"""
+import asyncio
+import concurrent.futures
+
+import numpy as np
+
+import align
+import capture
+import pipeline
+
+STAGES = ("read", "filter", "demodulate", "frames")
+DEFAULT_QUEUE_SIZE = 2
+
+# marks the end of a stream of blocks in a queue
+_END = object()
+
+
+def _length(products):
+    """number of samples or frames in the output of a stage"""
+    if isinstance(products, tuple):
+        products = products[0]
+    return products.shape[0]
+
+
+class AsyncRunner(object):
+    """Runs a pipeline with its stages overlapped
+
+    Args:
+        coil_pipeline (pipeline.CoilPipeline): the pipeline whose stages,
+            filters and demodulators are used
+        queue_size (int): the most blocks waiting between two stages
+        workers (int): threads in the pool, defaults to one per stage
+    """
+    def __init__(self, coil_pipeline, queue_size=DEFAULT_QUEUE_SIZE, workers=None):
+        if coil_pipeline.filter_mode == "zero-phase":
+            raise ValueError("zero-phase filtering needs the whole capture and can't be overlapped")
+        if queue_size < 1:
+            raise ValueError("queue_size must be at least 1, got {}".format(queue_size))
+        self.pipeline = coil_pipeline
+        self.queue_size = int(queue_size)
+        self.workers = len(STAGES) if workers is None else int(workers)
+
+    def run(self, coil_filename, optitrack_filename):
+        """processes an entire capture
+
+        Args:
+            coil_filename (str): path to the coil csv or binary capture
+            optitrack_filename (str): path to the optitrack csv or binary capture
+
+        Returns:
+            pipeline.CoilResult : the products for every frame of the capture
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as executor:
+                results = loop.run_until_complete(self.run_async(coil_filename, optitrack_filename, executor))
+        finally:
+            loop.close()
+        return pipeline.concatenate_results(results)
+
+    async def run_async(self, coil_filename, optitrack_filename, executor):
+        """processes an entire capture on the running event loop
+
+        Args:
+            coil_filename (str): path to the coil csv or binary capture
+            optitrack_filename (str): path to the optitrack csv or binary capture
+            executor (concurrent.futures.Executor): runs the work of every stage
+
+        Returns:
+            list : the CoilResult of every run of frames, in time order
+        """
+        coil_pipeline = self.pipeline
+        coil_pipeline.reset()
+        instrumentation = coil_pipeline.instrumentation
+        if instrumentation is not None:
+            # only the frame stages are recorded, the streaming stages overlap
+            instrumentation.begin(capture=coil_filename)
+        try:
+            return await self._run_stages(coil_filename, optitrack_filename, executor)
+        finally:
+            # a failed run still flushes its records and stops tracing memory
+            if instrumentation is not None:
+                instrumentation.end()
+
+    async def _run_stages(self, coil_filename, optitrack_filename, executor):
+        """the overlapped stages of `run_async`"""
+        coil_pipeline = self.pipeline
+        fs, blocks, optitrack = coil_pipeline.load(coil_filename, optitrack_filename)
+        frame_rate = capture.estimate_sample_rate(optitrack[:,1])
+        bank = coil_pipeline.filter_bank(fs)
+        demodulator = coil_pipeline.demodulator_for(fs, frame_rate)
+        resampler = align.FrameResampler(optitrack) if coil_pipeline.align_to == "optitrack" else None
+        # the "rescale" range policy needs every run before the first one is
+        # normalized, see `CoilPipeline.process_runs`
+        deferred = [] if coil_pipeline.range_policy == "rescale" else None
+        results = []
+
+        def read():
+            block = next(blocks, None)
+            if block is None:
+                return _END
+            coil_pipeline.samples_read += block.timestamps.shape[0]
+            # a new array, binary captures are read as views of the mapped file
+            # and the reader is already reading the next block while this one
+            # is filtered
+            return np.hstack( (block.coils, block.refs) )
+
+        def frames(products):
+            run = tuple(products) + (None,) if resampler is None else resampler.resample(*products)
+            if not run[0].shape[0]:
+                return
+            if deferred is None:
+                results.extend(coil_pipeline.process_runs([run], optitrack))
+            else:
+                deferred.append(run)
+
+        loop = asyncio.get_running_loop()
+        queues = [asyncio.Queue(self.queue_size) for _ in STAGES[1:]]
+        tasks = [loop.create_task(self._source(read, queues[0], executor)),
+                    loop.create_task(self._stage(bank.filter, bank.flush, queues[0], queues[1], executor)),
+                    loop.create_task(self._stage(demodulator.demodulate, demodulator.flush, queues[1], queues[2], executor)),
+                    loop.create_task(self._sink(frames, queues[2], executor))]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        # a failed stage would leave its neighbours waiting on their queues forever
+        for task in pending:
+            task.cancel()
+        # let the cancelled stages unwind before the loop is closed
+        await asyncio.gather(*pending, return_exceptions=True)
+        for task in done:
+            task.result()
+        if deferred is not None:
+            results = list(coil_pipeline.process_runs(deferred, optitrack))
+        return results
+
+    async def _source(self, read, destination, executor):
+        """reads blocks until the capture ends"""
+        loop = asyncio.get_running_loop()
+        while True:
+            block = await loop.run_in_executor(executor, read)
+            await destination.put(block)
+            if block is _END:
+                return
+
+    async def _stage(self, function, flush, source, destination, executor):
+        """passes every block through a stateful function, then flushes it"""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await source.get()
+            if item is _END:
+                break
+            products = await loop.run_in_executor(executor, function, item)
+            if _length(products):
+                await destination.put(products)
+        products = await loop.run_in_executor(executor, flush)
+        if _length(products):
+            await destination.put(products)
+        await destination.put(_END)
+
+    async def _sink(self, function, source, executor):
+        """hands every block to a function until the end of the stream"""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await source.get()
+            if item is _END:
+                return
+            await loop.run_in_executor(executor, function, item)
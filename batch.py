@@ -0,0 +1,279 @@
+"""
+Batch processing of mapping sessions
+
+Processes every coil/optitrack capture pair of a session on a pool of worker
+processes. Each worker builds one CoilPipeline when it starts, so the filter
+designs and the calibration are reused for every capture it processes.
+
+Capture pairs are found in one of two ways:
+    directory : every `<name>_coil.<ext>` file paired with `<name>_opti.<ext>`
+                (csv or binary captures)
+    manifest  : a csv file with the columns `name, coil, opti`. Relative paths
+                are relative to the manifest
+
+Results are written to an output directory containing one `<name>.npz` per
+capture and an `index.json` recording the status of every capture. Captures
+that already completed are skipped when a batch is run again, failed captures
+are retried.
+
+With `--store` the products go into a results store in `<out>/results`
+instead (see `resultstore.py`), chunked, compressed and streamed to disk while
+every capture is processed, with one manifest for the whole session.
+
+    python batch.py session_dir --out session_results --workers 8 --calib calibration.json
+    python batch.py session_dir --out session_results --store
+"""
+import argparse
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import time
+import traceback
+
+import numpy as np
+
+import main
+import rangecheck
+import resultstore
+
+INDEX_FILENAME = "index.json"
+COIL_SUFFIX = "_coil"
+OPTITRACK_SUFFIX = "_opti"
+# the results store inside the output directory, used with --store
+STORE_DIRNAME = "results"
+
+# the pipeline of this worker process, see `_init_worker`
+_WORKER_PIPELINE = None
+
+
+def find_capture_pairs(directory):
+    """finds the coil/optitrack capture pairs in a directory
+
+    Args:
+        directory (str): directory containing `<name>_coil.<ext>` and
+            `<name>_opti.<ext>` files
+
+    Returns:
+        list : (name, coil_filename, optitrack_filename) tuples sorted by name
+    """
+    pairs = []
+    for coil_filename in sorted(glob.glob(os.path.join(directory, "*" + COIL_SUFFIX + ".*"))):
+        stem, ext = os.path.splitext(coil_filename)
+        name = os.path.basename(stem)[:-len(COIL_SUFFIX)]
+        optitrack_filename = stem[:-len(COIL_SUFFIX)] + OPTITRACK_SUFFIX + ext
+        if not os.path.exists(optitrack_filename):
+            raise FileNotFoundError("no optitrack capture found for '{}' (expected '{}')".format(coil_filename, optitrack_filename))
+        pairs.append( (name, coil_filename, optitrack_filename) )
+    return pairs
+
+
+def read_manifest(filename):
+    """reads a manifest of capture pairs
+
+    Args:
+        filename (str): csv file with the columns `name, coil, opti`
+
+    Returns:
+        list : (name, coil_filename, optitrack_filename) tuples in manifest order
+    """
+    root = os.path.dirname(os.path.abspath(filename))
+    pairs = []
+    with open(filename, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            pairs.append( (row["name"].strip(),
+                            os.path.join(root, row["coil"].strip()),
+                            os.path.join(root, row["opti"].strip())) )
+    names = [pair[0] for pair in pairs]
+    if len(set(names)) != len(names):
+        raise ValueError("capture names in '{}' must be unique".format(filename))
+    return pairs
+
+
+def load_index(out_dir):
+    """reads the status of every capture processed into an output directory
+
+    Args:
+        out_dir (str): the batch output directory
+
+    Returns:
+        dict : status records keyed by capture name
+    """
+    path = os.path.join(out_dir, INDEX_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_index(out_dir, index):
+    """atomically writes the status of every capture
+
+    Args:
+        out_dir (str): the batch output directory
+        index (dict): status records keyed by capture name
+    """
+    path = os.path.join(out_dir, INDEX_FILENAME)
+    with open(path + ".tmp", 'w') as f:
+        json.dump(index, f, indent=4, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def is_complete(out_dir, index, name):
+    """checks whether a capture was already processed successfully
+
+    Args:
+        out_dir (str): the batch output directory
+        index (dict): status records keyed by capture name
+        name (str): the capture name
+
+    Returns:
+        bool : True if the capture can be skipped
+    """
+    record = index.get(name)
+    return (record is not None
+            and record["status"] == "ok"
+            and os.path.exists(os.path.join(out_dir, record["output"])))
+
+
+def _init_worker(args):
+    """builds the pipeline that this worker uses for every capture"""
+    global _WORKER_PIPELINE
+    _WORKER_PIPELINE = main.pipeline_from_args(args)
+
+
+def _process_pair(task):
+    """processes one capture pair in a worker, never raises
+
+    Returns:
+        dict : the status record of the capture
+    """
+    name, coil_filename, optitrack_filename, out_dir, store = task
+    start = time.time()
+    try:
+        if store:
+            output = os.path.join(STORE_DIRNAME, name)
+            # the store writes to a temporary directory until the capture is complete
+            writer = resultstore.CaptureWriter(os.path.join(out_dir, STORE_DIRNAME), name,
+                                                info={"coil" : coil_filename, "opti" : optitrack_filename})
+            try:
+                for result in _WORKER_PIPELINE.iter_run(coil_filename, optitrack_filename):
+                    writer.append(result)
+            except BaseException:
+                writer.abort()
+                raise
+            frames = writer.close()["frames"]
+        else:
+            output = name + ".npz"
+            result = _WORKER_PIPELINE.run(coil_filename, optitrack_filename)
+            # write to a temporary file first, a crash must never leave a partial result
+            tmp = os.path.join(out_dir, name + ".tmp.npz")
+            np.savez(tmp, **result._asdict())
+            os.replace(tmp, os.path.join(out_dir, output))
+            frames = int(result.frame_times.shape[0])
+        return {"name" : name,
+                "status" : "ok",
+                "output" : output,
+                "coil" : coil_filename,
+                "opti" : optitrack_filename,
+                "samples" : _WORKER_PIPELINE.samples_read,
+                "frames" : frames,
+                "range_warnings" : rangecheck.format_report(_WORKER_PIPELINE.range_report()),
+                "seconds" : time.time() - start,
+                }
+    except Exception as e:
+        return {"name" : name,
+                "status" : "failed",
+                "output" : None,
+                "coil" : coil_filename,
+                "opti" : optitrack_filename,
+                "error" : "{}: {}".format(type(e).__name__, e),
+                "traceback" : traceback.format_exc(),
+                "seconds" : time.time() - start,
+                }
+
+
+def run_batch(pairs, out_dir, args, workers=None, store=False):
+    """processes capture pairs on a process pool
+
+    Args:
+        pairs (list): (name, coil_filename, optitrack_filename) tuples
+        out_dir (str): the batch output directory, created if needed
+        args (argparse.Namespace): pipeline arguments, see
+            `main.add_pipeline_arguments`
+        workers (int): number of worker processes, defaults to the cpu count
+        store (bool): write the products to a results store in
+            `out_dir/results` instead of one npz file per capture
+
+    Returns:
+        dict : throughput summary of this run
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    index = load_index(out_dir)
+
+    todo = [pair for pair in pairs if not is_complete(out_dir, index, pair[0])]
+    skipped = len(pairs) - len(todo)
+    tasks = [pair + (out_dir, store) for pair in todo]
+    # only this process updates the store manifest, the workers write captures
+    results = resultstore.ResultStore(os.path.join(out_dir, STORE_DIRNAME)) if store else None
+
+    start = time.time()
+    succeeded = 0
+    failed = 0
+    samples = 0
+    if tasks:
+        workers = min(workers or multiprocessing.cpu_count(), len(tasks))
+        pool = multiprocessing.Pool(workers, initializer=_init_worker, initargs=(args,))
+        try:
+            for record in pool.imap_unordered(_process_pair, tasks):
+                index[record["name"]] = record
+                # keep the index current so an interrupted batch can resume
+                save_index(out_dir, index)
+                if record["status"] == "ok":
+                    if results is not None:
+                        results.register(record["name"])
+                    succeeded += 1
+                    samples += record["samples"]
+                    print("done: {} ({} frames in {:.1f}s)".format(record["name"], record["frames"], record["seconds"]))
+                else:
+                    failed += 1
+                    print("FAILED: {} ({})".format(record["name"], record["error"]))
+        finally:
+            pool.close()
+            pool.join()
+    elapsed = time.time() - start
+
+    return {"processed" : succeeded,
+            "failed" : failed,
+            "skipped" : skipped,
+            "seconds" : elapsed,
+            "captures_per_second" : succeeded / elapsed if elapsed else 0.0,
+            "msamples_per_second" : samples / 1e6 / elapsed if elapsed else 0.0,
+            }
+
+
+def main_batch(argv=None):
+    parser = argparse.ArgumentParser(description="process every capture pair of a mapping session")
+    parser.add_argument("source", help="directory of capture pairs, or a csv manifest")
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--workers", default=None, type=int)
+    parser.add_argument("--store", default=False, action="store_true",
+                        help="write the products to a chunked results store instead of npz files")
+    main.add_pipeline_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if os.path.isdir(args.source):
+        pairs = find_capture_pairs(args.source)
+    else:
+        pairs = read_manifest(args.source)
+
+    summary = run_batch(pairs, args.out, args, args.workers, args.store)
+    print("{processed} processed, {failed} failed, {skipped} skipped in {seconds:.1f}s".format(**summary))
+    print("throughput: {captures_per_second:.2f} captures/s, {msamples_per_second:.2f} MS/s".format(**summary))
+    return summary
+
+
+if __name__ == "__main__":
+    main_batch()
@@ -0,0 +1,527 @@
+"""
+Pipeline benchmarks
+
+Times every stage of the pipeline on synthetic captures (see
+`util.DataGenerator`) of several lengths and coil counts, and reports the
+throughput of each stage in coil samples per second along with the peak RSS
+of the process.
+
+Stages:
+    ingest        : reading coil blocks from a binary capture
+    filter        : STEP 1, the bandpass filter bank
+    demodulate    : STEP 2, amplitude and phase extraction
+    normalize     : STEP 3
+    phase_correct : STEP 4
+    solve         : STEPS 5 and 6, direction and disambiguation (see solver.py)
+    align         : optitrack pose lookup
+
+Streaming stages pull from each other, so every stage is timed exclusive of
+the stages upstream of it. Peak RSS can't be split between stages running in
+one process, so each configuration is run once per stage in a fresh process
+that stops after that stage. The peak RSS of a stage is the peak of a run up
+to and including it.
+
+Captures longer than `--loop-seconds` are not written to disk in full, the
+ingest stage loops over a shorter capture instead (an hour of 7 channel
+float32 data is ~10GB).
+
+Results are saved as json. Passing the results of an earlier run with
+`--baseline` flags every stage whose throughput dropped or whose peak RSS grew
+by more than `--tolerance`, and exits with a non-zero status if any did.
+
+    python bench.py --lengths 1 60 3600 --coils 2 3 4 --out bench.json
+    python bench.py --lengths 1 60 --baseline bench.json
+
+`--scaling` instead times filtering and demodulation with every thread count
+in `--workers`, reports the speedup over one thread and checks that every
+thread count produces exactly the same output:
+
+    python bench.py --scaling --lengths 60 --coils 4 --workers 1 2 4 8 16
+
+`--precision` runs the whole pipeline on a rotating synthetic capture in
+float64 and in float32 and reports the largest amplitude, angle (theta), field
+vector and orientation differences between the two, along with the error of
+each against the simulated orientation. It exits with a non-zero status if
+the float32 field vectors or orientation differ by more than
+`--max-angle-error` or the amplitudes by more than `--max-amplitude-error`.
+theta is reported but not checked, it's the arccos of the amplitude which
+magnifies any amplitude difference near 0 and 180 degrees:
+
+    python bench.py --precision --lengths 60 --coils 3
+"""
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import scipy
+
+import capture
+import pipeline
+import util
+
+STAGES = ("ingest", "filter", "demodulate", "normalize", "phase_correct", "solve", "align")
+DEFAULT_LENGTHS = (1, 60, 3600)
+DEFAULT_COILS = (2, 3, 4)
+
+
+class _TimedIterator(object):
+    """an iterator that adds up the time spent producing its items,
+    including the time spent in the iterators it pulls from
+    """
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self.seconds = 0.0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return next(self._iterator)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+
+def peak_rss():
+    """peak resident set size of this process in bytes"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos reports bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def looped_blocks(coil_capture, nsamples, block_size):
+    """reads `nsamples` samples of coil blocks from a capture, starting over
+    at the beginning of the capture when it runs out
+
+    The blocks are copied out of the memory map so that reading the file is
+    part of this stage rather than the first stage to touch the data.
+
+    Yields:
+        capture.CoilBlock : blocks with continuous sample indices and timestamps
+    """
+    start = 0
+    period = len(coil_capture) / coil_capture.sample_rate
+    while start < nsamples:
+        loops, offset = divmod(start, len(coil_capture))
+        stop = min(offset + block_size, len(coil_capture), offset + nsamples - start)
+        block = coil_capture[offset:stop]
+        yield capture.CoilBlock(start,
+                                block.timestamps + loops * period,
+                                np.array(block.coils),
+                                np.array(block.refs))
+        start += stop - offset
+
+
+def run_stages(coil_filename, optitrack_filename, nsamples, last_stage, options):
+    """runs the pipeline up to and including `last_stage`, this is run in a
+    fresh process for every stage
+
+    Returns:
+        dict : the exclusive seconds spent in every stage that ran, and the
+            peak RSS of the process in bytes
+    """
+    coil_pipeline = pipeline.CoilPipeline(filter_mode=options["filter_mode"],
+                                            demodulator=options["demodulator"],
+                                            block_size=options["block_size"],
+                                            workers=options.get("workers", 1))
+    coil_capture = capture.open_capture(coil_filename)
+    optitrack = capture.read_optitrack(optitrack_filename)
+    fs = coil_capture.sample_rate
+    frame_rate = capture.estimate_sample_rate(optitrack[:,1])
+    stop = STAGES.index(last_stage)
+
+    # streaming stages, timed by how long each one takes to yield
+    chain = [_TimedIterator(looped_blocks(coil_capture, nsamples, coil_pipeline.block_size))]
+    if stop >= STAGES.index("filter"):
+        chain.append(_TimedIterator(coil_pipeline.filter(chain[-1], fs)))
+    if stop >= STAGES.index("demodulate"):
+        chain.append(_TimedIterator(coil_pipeline.demodulate(chain[-1], fs, frame_rate)))
+
+    # frame stages, timed call by call
+    seconds = dict.fromkeys(STAGES[3:stop + 1], 0.0)
+    ncoils = coil_capture.ncoils
+    for item in chain[-1]:
+        if stop < STAGES.index("normalize"):
+            continue
+        frame_times, amplitude, phase = item
+        timer = time.perf_counter()
+        amplitude = coil_pipeline.normalize(amplitude[:,:ncoils], out=amplitude[:,:ncoils])
+        seconds["normalize"] += time.perf_counter() - timer
+        if stop < STAGES.index("phase_correct"):
+            continue
+
+        ref_phase = np.diagonal(phase[:,ncoils:], axis1=1, axis2=2)
+        timer = time.perf_counter()
+        relative_phase = coil_pipeline.phase_correct(phase[:,:ncoils], ref_phase, out=phase[:,:ncoils])
+        seconds["phase_correct"] += time.perf_counter() - timer
+        if stop < STAGES.index("solve"):
+            continue
+
+        timer = time.perf_counter()
+        coil_pipeline.solve(amplitude, relative_phase)
+        seconds["solve"] += time.perf_counter() - timer
+        if stop < STAGES.index("align"):
+            continue
+
+        timer = time.perf_counter()
+        coil_pipeline.align(frame_times, optitrack)
+        seconds["align"] += time.perf_counter() - timer
+
+    upstream = 0.0
+    for name, timed in zip(STAGES, chain):
+        seconds[name] = timed.seconds - upstream
+        upstream = timed.seconds
+    return {"seconds" : seconds, "peak_rss" : peak_rss()}
+
+
+def _in_fresh_process(function, *args):
+    """runs a function in a new process, so its peak RSS is its own"""
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+        return executor.submit(function, *args).result()
+
+
+def benchmark(length, ncoils, directory, options, stages=STAGES):
+    """benchmarks every stage for one capture length and coil count
+
+    Args:
+        length (float): capture length in seconds
+        ncoils (int): number of measurement coils
+        directory (str): directory to write the synthetic capture to
+        options (dict): filter_mode, demodulator, block_size and loop_seconds
+        stages (tuple): the stages to report
+
+    Returns:
+        list : one result dict per stage
+    """
+    generator = util.DataGenerator(duration=length, ncoils=ncoils)
+    coil_filename = os.path.join(directory, "bench_{}_coil.cap".format(ncoils))
+    optitrack_filename = os.path.join(directory, "bench_{}_opti.cap".format(ncoils))
+    # the optitrack capture always covers the full length
+    generator.write_coil(coil_filename, nsamples=int(options["loop_seconds"] * generator.coil_sample_rate))
+    generator.write_optitrack(optitrack_filename)
+    nsamples = generator.nsamples
+
+    runs = {stage : _in_fresh_process(run_stages, coil_filename, optitrack_filename, nsamples, stage, options)
+                for stage in stages}
+    # timings come from the run that went through every stage
+    seconds = runs[stages[-1]]["seconds"]
+
+    results = []
+    for stage in stages:
+        results.append({"length" : length,
+                        "ncoils" : ncoils,
+                        "stage" : stage,
+                        "samples" : nsamples,
+                        "seconds" : seconds[stage],
+                        "samples_per_second" : nsamples / seconds[stage] if seconds[stage] > 0 else float("inf"),
+                        "peak_rss_mb" : runs[stage]["peak_rss"] / 2**20,
+                        })
+    return results
+
+
+def scaling(length, ncoils, directory, options, workers):
+    """times filtering and demodulation with different numbers of threads
+
+    Args:
+        length (float): capture length in seconds
+        ncoils (int): number of measurement coils
+        directory (str): directory to write the synthetic capture to
+        options (dict): filter_mode, demodulator, block_size and loop_seconds
+        workers (list): the thread counts to time
+
+    Returns:
+        list : one result dict per thread count
+    """
+    generator = util.DataGenerator(duration=length, ncoils=ncoils)
+    coil_filename = os.path.join(directory, "scaling_{}_coil.cap".format(ncoils))
+    generator.write_coil(coil_filename, nsamples=int(options["loop_seconds"] * generator.coil_sample_rate))
+    coil_capture = capture.open_capture(coil_filename)
+    fs = coil_capture.sample_rate
+    nsamples = generator.nsamples
+
+    results = []
+    for count in workers:
+        coil_pipeline = pipeline.CoilPipeline(filter_mode=options["filter_mode"],
+                                                demodulator=options["demodulator"],
+                                                block_size=options["block_size"],
+                                                workers=count)
+        # the output of every thread count must be the same, down to the bit
+        digest = hashlib.sha256()
+        blocks = looped_blocks(coil_capture, nsamples, coil_pipeline.block_size)
+        start = time.perf_counter()
+        filtered = coil_pipeline.filter(blocks, fs)
+        for frame_times, amplitude, phase in coil_pipeline.demodulate(filtered, fs, generator.opti_sample_rate):
+            digest.update(amplitude.tobytes())
+            digest.update(phase.tobytes())
+        seconds = time.perf_counter() - start
+        coil_pipeline.close()
+        results.append({"length" : length,
+                        "ncoils" : ncoils,
+                        "workers" : count,
+                        "samples" : nsamples,
+                        "seconds" : seconds,
+                        "samples_per_second" : nsamples / seconds,
+                        "speedup" : results[0]["seconds"] / seconds if results else 1.0,
+                        "identical" : digest.hexdigest() == (results[0]["digest"] if results else digest.hexdigest()),
+                        "digest" : digest.hexdigest(),
+                        })
+    return results
+
+
+def _vector_angle(a, b):
+    """angle between the vectors of the last axis in degrees"""
+    cosine = np.sum(a * b, axis=-1) / (np.linalg.norm(a, axis=-1) * np.linalg.norm(b, axis=-1))
+    return np.degrees(np.arccos(np.clip(cosine, -1, 1)))
+
+
+def _quaternion_angle(q0, q1):
+    """angle of the rotation between quaternions in degrees"""
+    dot = np.abs(np.sum(q0 * q1, axis=-1)) / (np.linalg.norm(q0, axis=-1) * np.linalg.norm(q1, axis=-1))
+    return np.degrees(2 * np.arccos(np.clip(dot, 0, 1)))
+
+
+def _largest(errors):
+    """the largest error, NaN when there is nothing to compare"""
+    errors = np.asarray(errors, dtype=np.float64)
+    return float(np.nanmax(errors)) if np.any(np.isfinite(errors)) else float("nan")
+
+
+def precision_error(length, ncoils, directory, options):
+    """compares the float32 pipeline against the float64 pipeline
+
+    Args:
+        length (float): capture length in seconds
+        ncoils (int): number of measurement coils
+        directory (str): directory to write the synthetic capture to
+        options (dict): filter_mode, demodulator and block_size
+
+    Returns:
+        dict : the largest differences between the two precisions, the
+            largest orientation error of each against the simulation and the
+            time each precision took. The filters ring at both ends of the
+            capture, frames within `CoilPipeline.filter_settle_time` of
+            either end are left out
+    """
+    # rotating about a diagonal axis sweeps every coil through every field
+    generator = util.DataGenerator(duration=length, ncoils=ncoils, trajectory=util.spin(axis=(1, 1, 1)))
+    coil_filename = os.path.join(directory, "precision_{}_coil.cap".format(ncoils))
+    optitrack_filename = os.path.join(directory, "precision_{}_opti.cap".format(ncoils))
+    generator.write_coil(coil_filename)
+    generator.write_optitrack(optitrack_filename)
+
+    results = {}
+    seconds = {}
+    for precision in pipeline.PRECISIONS:
+        coil_pipeline = pipeline.CoilPipeline(generator.calib,
+                                                filter_mode=options["filter_mode"],
+                                                demodulator=options["demodulator"],
+                                                block_size=options["block_size"],
+                                                precision=precision)
+        start = time.perf_counter()
+        results[precision] = coil_pipeline.run(coil_filename, optitrack_filename)
+        seconds[precision] = time.perf_counter() - start
+
+    settle = coil_pipeline.filter_settle_time(generator.coil_sample_rate)
+    times = results["float64"].frame_times
+    settled = (times >= settle) & (times <= times[-1] - settle)
+    double = pipeline.CoilResult(*(array[settled] for array in results["float64"]))
+    single = pipeline.CoilResult(*(array[settled] for array in results["float32"]))
+    _, truth = generator.trajectory(double.frame_times)
+    return {"length" : length,
+            "ncoils" : ncoils,
+            "frames" : int(double.frame_times.shape[0]),
+            "amplitude_error" : _largest(np.abs(single.amplitude - double.amplitude)),
+            "theta_error" : _largest(np.degrees(np.abs(single.theta - double.theta))),
+            "field_error" : _largest(_vector_angle(single.field, double.field)),
+            "orientation_error" : _largest(_quaternion_angle(single.orientation, double.orientation)),
+            "float64_truth_error" : _largest(_quaternion_angle(double.orientation, truth)),
+            "float32_truth_error" : _largest(_quaternion_angle(single.orientation, truth)),
+            "float64_seconds" : seconds["float64"],
+            "float32_seconds" : seconds["float32"],
+            }
+
+
+def compare(results, baseline, tolerance):
+    """finds the stages that got slower or use more memory than a baseline
+
+    Args:
+        results (list): results of this run
+        baseline (list): results of an earlier run
+        tolerance (float): allowed relative change, ie 0.1 for 10%
+
+    Returns:
+        list : a description of every regression
+    """
+    previous = {(r["length"], r["ncoils"], r["stage"]) : r for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get( (result["length"], result["ncoils"], result["stage"]) )
+        if before is None:
+            continue
+        name = "{stage} ({length}s, {ncoils} coils)".format(**result)
+        if result["samples_per_second"] < before["samples_per_second"] * (1 - tolerance):
+            regressions.append("{}: throughput {:.3g} -> {:.3g} samples/s".format(name, before["samples_per_second"], result["samples_per_second"]))
+        if result["peak_rss_mb"] > before["peak_rss_mb"] * (1 + tolerance):
+            regressions.append("{}: peak RSS {:.1f} -> {:.1f} MB".format(name, before["peak_rss_mb"], result["peak_rss_mb"]))
+    return regressions
+
+
+def environment():
+    """describes the machine and code the benchmark ran on"""
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit" : commit,
+            "date" : datetime.datetime.now().isoformat(),
+            "platform" : platform.platform(),
+            "processor" : platform.processor(),
+            "cpus" : os.cpu_count(),
+            "python" : platform.python_version(),
+            "numpy" : np.__version__,
+            "scipy" : scipy.__version__,
+            }
+
+
+def print_results(results):
+    print("{:>8} {:>6} {:>14} {:>10} {:>14} {:>10}".format("length", "coils", "stage", "seconds", "samples/s", "RSS (MB)"))
+    for r in results:
+        print("{length:>8} {ncoils:>6} {stage:>14} {seconds:>10.3f} {samples_per_second:>14.4g} {peak_rss_mb:>10.1f}".format(**r))
+
+
+def print_scaling(results):
+    print("{:>8} {:>6} {:>8} {:>10} {:>14} {:>8} {:>10}".format("length", "coils", "workers", "seconds", "samples/s", "speedup", "identical"))
+    for r in results:
+        print("{length:>8} {ncoils:>6} {workers:>8} {seconds:>10.3f} {samples_per_second:>14.4g} {speedup:>8.2f} {identical!s:>10}".format(**r))
+
+
+def print_precision(results):
+    print("{:>8} {:>6} {:>10} {:>10} {:>10} {:>12} {:>12} {:>12} {:>9} {:>9}".format(
+            "length", "coils", "amplitude", "theta", "field", "orientation", "f64 truth", "f32 truth", "f64 (s)", "f32 (s)"))
+    for r in results:
+        print("{length:>8} {ncoils:>6} {amplitude_error:>10.3g} {theta_error:>10.3g} {field_error:>10.3g} {orientation_error:>12.3g}"
+                " {float64_truth_error:>12.3g} {float32_truth_error:>12.3g} {float64_seconds:>9.2f} {float32_seconds:>9.2f}".format(**r))
+    print("(largest float32 - float64 differences, angles in degrees)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="benchmark every stage of the pipeline on synthetic captures")
+    parser.add_argument("--lengths", default=DEFAULT_LENGTHS, type=float, nargs="+", help="capture lengths in seconds")
+    parser.add_argument("--coils", default=DEFAULT_COILS, type=int, nargs="+", help="measurement coil counts")
+    parser.add_argument("--stages", default=STAGES, nargs="+", choices=STAGES)
+    parser.add_argument("--filter-mode", default="compensated", choices=pipeline.FILTER_MODES)
+    parser.add_argument("--demodulator", default="lock-in", choices=pipeline.DEMODULATORS)
+    parser.add_argument("--block-size", default=capture.DEFAULT_BLOCK_SIZE, type=int)
+    parser.add_argument("--loop-seconds", default=60, type=float,
+                        help="longest capture written to disk, longer captures loop over it")
+    parser.add_argument("--out", default=None, help="json file to save the results to")
+    parser.add_argument("--baseline", default=None, help="json results of an earlier run to compare against")
+    parser.add_argument("--tolerance", default=0.1, type=float, help="relative change flagged as a regression")
+    parser.add_argument("--scaling", default=False, action="store_true",
+                        help="time filtering and demodulation with every thread count in --workers instead")
+    parser.add_argument("--workers", default=None, type=int, nargs="+",
+                        help="thread counts for --scaling, defaults to powers of 2 up to the number of cpus")
+    parser.add_argument("--precision", default=False, action="store_true",
+                        help="compare the float32 pipeline against the float64 pipeline instead")
+    parser.add_argument("--max-angle-error", default=0.1, type=float,
+                        help="largest float32 field or orientation difference allowed (degrees)")
+    parser.add_argument("--max-amplitude-error", default=2e-3, type=float,
+                        help="largest float32 normalized amplitude difference allowed")
+    args = parser.parse_args(argv)
+
+    options = {"filter_mode" : args.filter_mode,
+                "demodulator" : args.demodulator,
+                "block_size" : args.block_size,
+                "loop_seconds" : args.loop_seconds,
+                }
+    if args.scaling:
+        return main_scaling(args, options)
+    if args.precision:
+        return main_precision(args, options)
+
+    # keep the stages in pipeline order, every run stops after the last one
+    stages = tuple(stage for stage in STAGES if stage in args.stages)
+
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for length in args.lengths:
+            for ncoils in args.coils:
+                results.extend(benchmark(length, ncoils, directory, options, stages))
+                print_results(results[-len(stages):])
+
+    report = {"environment" : environment(), "options" : options, "results" : results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=4)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f)["results"], args.tolerance)
+        for regression in regressions:
+            print("REGRESSION: " + regression)
+        if not regressions:
+            print("no regressions against {}".format(args.baseline))
+    return 1 if regressions else 0
+
+
+def main_scaling(args, options):
+    workers = args.workers
+    if workers is None:
+        workers = [2**i for i in range(int(np.log2(os.cpu_count() or 1)) + 1)]
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for length in args.lengths:
+            for ncoils in args.coils:
+                results.extend(scaling(length, ncoils, directory, options, workers))
+                print_scaling(results[-len(workers):])
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({"environment" : environment(), "options" : options, "scaling" : results}, f, indent=4)
+    # different output from different thread counts is a bug, not a slowdown
+    return 0 if all(r["identical"] for r in results) else 1
+
+
+def main_precision(args, options):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for length in args.lengths:
+            for ncoils in args.coils:
+                results.append(precision_error(length, ncoils, directory, options))
+                print_precision(results[-1:])
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({"environment" : environment(), "options" : options, "precision" : results}, f, indent=4)
+
+    failures = []
+    for r in results:
+        name = "{length}s, {ncoils} coils".format(**r)
+        for field in ("field_error", "orientation_error"):
+            # NaN comparisons are False, rigs that can't be oriented pass
+            if r[field] > args.max_angle_error:
+                failures.append("{}: float32 {} {:.3g} degrees".format(name, field, r[field]))
+        if r["amplitude_error"] > args.max_amplitude_error:
+            failures.append("{}: float32 amplitude_error {:.3g}".format(name, r["amplitude_error"]))
+    for failure in failures:
+        print("PRECISION: " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,221 @@
+"""
+Calibration files
+
+A calibration file is a json file describing the rig that a capture was taken
+with. Every field is optional:
+
+    {
+        "bands" : [12000, 16000, 20000],   # carrier frequencies (HZ)
+        "butter_order" : 3,                # order of the bandpass filters
+        "bandwidth" : 2,                   # width of the bandpass filters (HZ)
+        "max" : [1, 1, 1],                 # coil amplitude when perpendicular
+        "min" : [0, 0, 0],                 # coil amplitude when parallel
+        "phase_offset" : [0, 0, 0]         # amplifier phase shift (radians)
+    }
+
+"max" and "min" are given per band, or per coil and band as a nested list
+shaped (ncoils, nbands). "phase_offset" is given per coil channel (applied
+equally to every band), or per coil and band shaped (ncoils, nbands).
+
+Parsed calibrations are cached by the hash of the file contents, so loading
+the same calibration for every capture of a batch only parses it once.
+"""
+import hashlib
+import json
+
+import numpy as np
+
+from filters import BAND_CENTERS
+
+# parsed calibrations keyed by the sha256 of the file contents
+_CALIBRATION_CACHE = {}
+
+
+def load_calibration(filename):
+    """loads a calibration file, reusing the parsed calibration if this file
+    content has been loaded before
+
+    Args:
+        filename (str): path to the json calibration file
+
+    Returns:
+        Calibration : the parsed calibration
+    """
+    with open(filename, 'rb') as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).hexdigest()
+
+    if digest not in _CALIBRATION_CACHE:
+        fields = json.loads(raw.decode("utf-8"))
+        _CALIBRATION_CACHE[digest] = Calibration.from_dict(fields, digest)
+    return _CALIBRATION_CACHE[digest]
+
+
+def _band_array(values, nbands, name):
+    """converts a per band or per (coil, band) list into an array shaped
+    (1, nbands) or (ncoils, nbands)
+    """
+    array = np.array(values, dtype=np.float64)
+    if array.ndim == 0:
+        array = np.full( (1, nbands), float(array) )
+    elif array.ndim == 1:
+        array = array.reshape( (1,-1) )
+    if array.ndim != 2 or array.shape[1] != nbands:
+        raise ValueError("calibration '{}' must have one value per band ({}), got shape {}".format(name, nbands, array.shape))
+    return array
+
+
+def _channel_array(values, nbands, name):
+    """converts a per channel or per (coil, band) list into an array shaped
+    (1, 1) or (ncoils, 1) or (ncoils, nbands)
+    """
+    array = np.array(values, dtype=np.float64)
+    if array.ndim == 0:
+        array = array.reshape( (1,1) )
+    elif array.ndim == 1:
+        array = array.reshape( (-1,1) )
+    if array.ndim != 2 or array.shape[1] not in (1, nbands):
+        raise ValueError("calibration '{}' must have one value per channel or shape (ncoils, {}), got shape {}".format(name, nbands, array.shape))
+    return array
+
+
+class Calibration(object):
+    """Calibration constants for a rig
+
+    The normalization is stored as a precomputed scale and offset, so that
+        (amplitude - min) / (max - min) == amplitude * scale + offset
+    can be applied to a whole (frames, coils, bands) array in place.
+
+    Calibrations are shared between captures through the cache, so they are
+    never modified. Use `with_range` to derive an adjusted calibration.
+
+    Args:
+        cal_max (array_like): coil amplitude when perpendicular to the field,
+            per band or shaped (ncoils, nbands)
+        cal_min (array_like): coil amplitude when parallel to the field,
+            per band or shaped (ncoils, nbands)
+        phase_offset (array_like): system phase offset in radians, per coil
+            channel or shaped (ncoils, nbands)
+        bands (tuple): carrier frequency of each band (in HZ)
+        butter_order (int): order of the bandpass filters
+        bandwidth (float): width of the bandpass filters (in HZ)
+        digest (str): hash of the file this calibration was loaded from
+    """
+    def __init__(self, cal_max=1, cal_min=0, phase_offset=0, bands=BAND_CENTERS, butter_order=3, bandwidth=2, digest=None):
+        self.bands = tuple(float(b) for b in bands)
+        self.butter_order = int(butter_order)
+        self.bandwidth = float(bandwidth)
+        self.digest = digest
+
+        nbands = len(self.bands)
+        self.max = _band_array(cal_max, nbands, "max")
+        self.min = _band_array(cal_min, nbands, "min")
+        self.phase_offset = _channel_array(phase_offset, nbands, "phase_offset")
+
+        if np.any(self.max <= self.min):
+            raise ValueError("calibration maximums must be greater than the minimums")
+        if self.butter_order < 1 or self.bandwidth <= 0:
+            raise ValueError("invalid filter settings (order={}, bandwidth={})".format(self.butter_order, self.bandwidth))
+
+        self.scale = 1 / (self.max - self.min)
+        self.offset = -self.min * self.scale
+        for array in (self.max, self.min, self.phase_offset, self.scale, self.offset):
+            array.setflags(write=False)
+
+    @classmethod
+    def from_dict(cls, fields, digest=None):
+        """creates a calibration from the fields of a calibration file
+
+        Args:
+            fields (dict): the parsed json calibration file
+            digest (str): hash of the file contents
+
+        Returns:
+            Calibration : the calibration
+        """
+        known = {"bands", "butter_order", "bandwidth", "max", "min", "phase_offset"}
+        unknown = set(fields) - known
+        if unknown:
+            raise ValueError("unknown calibration fields: {}".format(sorted(unknown)))
+        return cls(cal_max=fields.get("max", 1),
+                    cal_min=fields.get("min", 0),
+                    phase_offset=fields.get("phase_offset", 0),
+                    bands=fields.get("bands", BAND_CENTERS),
+                    butter_order=fields.get("butter_order", 3),
+                    bandwidth=fields.get("bandwidth", 2),
+                    digest=digest)
+
+    def to_dict(self):
+        """the fields of this calibration, as they'd be written to a file
+
+        Returns:
+            dict : the calibration fields
+        """
+        return {"bands" : list(self.bands),
+                "butter_order" : self.butter_order,
+                "bandwidth" : self.bandwidth,
+                "max" : self.max.tolist(),
+                "min" : self.min.tolist(),
+                "phase_offset" : self.phase_offset.tolist(),
+                }
+
+    def save(self, filename):
+        """writes this calibration to a json file
+
+        Args:
+            filename (str): path to write the calibration file to
+        """
+        with open(filename, 'w') as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    def with_range(self, cal_min, cal_max):
+        """derives a calibration with different minimums and maximums
+
+        Args:
+            cal_min (array_like): the new minimums, per band or (ncoils, nbands)
+            cal_max (array_like): the new maximums, per band or (ncoils, nbands)
+
+        Returns:
+            Calibration : a new calibration, this one is left unchanged
+        """
+        return Calibration(cal_max, cal_min, self.phase_offset, self.bands, self.butter_order, self.bandwidth)
+
+    def check_coils(self, ncoils):
+        """makes sure the per coil calibration values fit the capture
+
+        Args:
+            ncoils (int): number of measurement coils in the capture
+        """
+        for name, array in (("max", self.max), ("min", self.min), ("phase_offset", self.phase_offset)):
+            if array.shape[0] not in (1, ncoils):
+                raise ValueError("calibration '{}' has values for {} coils but the capture has {} coils".format(name, array.shape[0], ncoils))
+
+    def normalize(self, amplitude, out=None):
+        """normalizes coil amplitudes so that 1 is perpendicular and 0 is
+        parallel to the field
+
+        Args:
+            amplitude (np.ndarray): amplitudes shaped (frames, ncoils, nbands)
+            out (np.ndarray): array to write the result into, may be `amplitude`
+
+        Returns:
+            np.ndarray : the normalized amplitudes
+        """
+        out = np.multiply(amplitude, self.scale, out=out)
+        return np.add(out, self.offset, out=out)
+
+    def relative_phase(self, phase, ref_phase, out=None):
+        """removes the system phase offset and the reference coil phase from
+        the measurement coil phase
+
+        Args:
+            phase (np.ndarray): coil phase shaped (frames, ncoils, nbands)
+            ref_phase (np.ndarray): phase of the reference coil of each band
+                shaped (frames, nbands)
+            out (np.ndarray): array to write the result into, may be `phase`
+
+        Returns:
+            np.ndarray : the relative phase, shaped (frames, ncoils, nbands)
+        """
+        out = np.subtract(phase, self.phase_offset, out=out)
+        return np.subtract(out, ref_phase[:, np.newaxis, :], out=out)
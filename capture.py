@@ -0,0 +1,532 @@
+"""
+Capture file readers
+
+Coil captures recorded by the DAQ are long (100kS/s on up to 7 channels), so
+they are never loaded in one piece. Instead they are read in fixed size blocks
+of samples which are yielded one at a time to the processing stages.
+
+Coil capture layout (csv, one header row):
+    timestamp, coil1, coil2, ..., coilN, ref_coil1, ref_coil2, ref_coil3
+
+OptiTrack capture layout (csv, one header row):
+    frame_index, timestamp, x, y, z, qx, qy, qz, qw
+
+Parsing csv text is by far the slowest part of loading a capture, so captures
+can be converted once into a binary format with `convert_csv` and then opened
+with `open_capture`, which memory maps the samples instead of parsing them.
+
+Binary capture layout:
+    bytes [0, 4096)     magic string followed by a json header (space padded)
+    timestamps          float64, shape (nsamples,)
+    channels            header["dtype"], shape (nsamples, nchannels), C order
+
+The channels are every csv column except for the timestamp column, in their
+original order. Timestamps are always stored as float64 because float32 can't
+resolve 10us steps after a few minutes of capture.
+"""
+import collections
+import itertools
+import json
+import re
+
+import numpy as np
+
+# number of samples per block, 2**16 samples is ~0.65s of data at 100kS/s
+DEFAULT_BLOCK_SIZE = 65536
+# there is always one reference coil per field axis (12k, 16k, 20k)
+NUM_REF_COILS = 3
+
+CAPTURE_MAGIC = b"COILCAP1"
+HEADER_SIZE = 4096
+# the channel data is aligned to this many bytes
+DATA_ALIGNMENT = 64
+
+# capture kinds and the index of their timestamp column in the csv file
+CAPTURE_KINDS = {"coil": 0, "optitrack": 1, "daq": 0}
+
+# a line with nothing but whitespace, see `count_rows`
+_BLANK_LINE = re.compile(rb"^[ \t\r\f\v]*\n", re.MULTILINE)
+
+
+# A block of coil data. All arrays are views of the rows parsed for this block
+# (or read only views of a memory mapped binary capture)
+#   start (int): index of the first sample in this block
+#   timestamps (np.ndarray): shape (nsamples,)
+#   coils (np.ndarray): measurement coil voltages, shape (nsamples, ncoils)
+#   refs (np.ndarray): reference coil voltages, shape (nsamples, 3)
+CoilBlock = collections.namedtuple("CoilBlock", ["start", "timestamps", "coils", "refs"])
+
+
+def count_columns(filename, delimiter=","):
+    """counts the number of columns in a csv file using its header row
+
+    Args:
+        filename (str): path to the csv file
+        delimiter (str): the column delimiter
+
+    Returns:
+        int : number of columns
+    """
+    with open(filename, 'r') as f:
+        header = f.readline()
+    return header.count(delimiter) + 1
+
+
+def read_csv_blocks(filename, block_size=DEFAULT_BLOCK_SIZE, skip_header=1, delimiter=","):
+    """reads a numeric csv file in blocks of rows
+
+    Only one block of rows is held at a time, so memory use is constant no
+    matter how long the file is.
+
+    Args:
+        filename (str): path to the csv file
+        block_size (int): maximum number of rows per block
+        skip_header (int): number of header lines to skip
+        delimiter (str): the column delimiter
+
+    Yields:
+        int : index of the first row in the block
+        np.ndarray : the rows of the block as float64, shape (nrows, ncols)
+
+    Raises:
+        ValueError : if a row doesn't have as many columns as the header
+    """
+    ncols = count_columns(filename, delimiter)
+
+    start = 0
+    line_number = skip_header
+    with open(filename, 'r') as f:
+        for _ in range(skip_header):
+            f.readline()
+
+        while True:
+            lines = list(itertools.islice(f, block_size))
+            if not lines:
+                break
+            if not any(line.strip() for line in lines):
+                # only blank lines, ie the end of the file
+                line_number += len(lines)
+                continue
+            try:
+                rows = np.loadtxt(lines, delimiter=delimiter, ndmin=2)
+            except ValueError:
+                _check_columns(filename, lines, line_number, ncols, delimiter)
+                raise
+            if rows.shape[1] != ncols:
+                _check_columns(filename, lines, line_number, ncols, delimiter)
+            yield start, rows
+            start += rows.shape[0]
+            line_number += len(lines)
+
+
+def _check_columns(filename, lines, line_number, ncols, delimiter):
+    """raises a ValueError naming the first line without `ncols` columns
+
+    Args:
+        filename (str): path to the csv file
+        lines (list): lines of the file
+        line_number (int): number of lines of the file before `lines`
+        ncols (int): the number of columns in the header
+        delimiter (str): the column delimiter
+    """
+    for i, line in enumerate(lines, line_number + 1):
+        if line.strip() and line.count(delimiter) + 1 != ncols:
+            raise ValueError("{} line {}: expected {} columns like the header, got {}".format(
+                                filename, i, ncols, line.count(delimiter) + 1))
+
+
+def read_coil_blocks(filename, block_size=DEFAULT_BLOCK_SIZE):
+    """reads a coil capture in blocks of samples
+
+    Args:
+        filename (str): path to the coil csv or binary capture file
+        block_size (int): maximum number of samples per block
+
+    Yields:
+        CoilBlock : the timestamp, measurement coil and reference coil columns
+            of the block
+    """
+    if is_binary_capture(filename):
+        for block in open_capture(filename).blocks(block_size):
+            yield block
+        return
+
+    ncoils = count_columns(filename) - 1 - NUM_REF_COILS
+    for start, rows in read_csv_blocks(filename, block_size):
+        yield CoilBlock(start,
+                        rows[:, 0],
+                        rows[:, 1:1 + ncoils],
+                        rows[:, 1 + ncoils:])
+
+
+def read_optitrack(filename):
+    """reads an entire optitrack capture
+
+    OptiTrack data is recorded at a much lower framerate than the coils, so it
+    is small enough to read in one piece
+
+    Args:
+        filename (str): path to the optitrack csv or binary capture file
+
+    Returns:
+        np.ndarray : optitrack data, shape (nframes, 9)
+    """
+    if is_binary_capture(filename):
+        return open_capture(filename).to_rows()
+
+    blocks = [rows for _, rows in read_csv_blocks(filename)]
+    if not blocks:
+        return np.empty((0, count_columns(filename)))
+    return np.concatenate(blocks, axis=0)
+
+
+def estimate_sample_rate(timestamps):
+    """estimates the sampling frequency from a run of timestamps
+
+    Args:
+        timestamps (np.ndarray): consecutive sample timestamps in seconds
+
+    Returns:
+        float : the sampling frequency in HZ
+    """
+    if timestamps.size < 2:
+        raise ValueError("at least two timestamps are required to estimate the sample rate")
+    return 1.0 / np.median(np.diff(timestamps))
+
+
+def read_columns(filename, columns):
+    """reads selected columns of a capture in full
+
+    Args:
+        filename (str): path to the csv or binary capture file
+        columns (tuple): indices of the columns to read, using the csv column
+            numbering (timestamp included)
+
+    Returns:
+        np.ndarray : the requested columns, shape (nsamples, len(columns))
+    """
+    if is_binary_capture(filename):
+        return open_capture(filename).to_rows(columns)
+
+    columns = list(columns)
+    blocks = [rows[:, columns] for _, rows in read_csv_blocks(filename)]
+    if not blocks:
+        return np.empty((0, len(columns)))
+    return np.concatenate(blocks, axis=0)
+
+
+################################################################################
+# BINARY CAPTURES
+################################################################################
+def is_binary_capture(filename):
+    """checks whether a file is a binary capture
+
+    Args:
+        filename (str): path to the capture file
+
+    Returns:
+        bool : True if the file starts with the binary capture magic string
+    """
+    with open(filename, 'rb') as f:
+        return f.read(len(CAPTURE_MAGIC)) == CAPTURE_MAGIC
+
+
+def count_rows(filename, skip_header=1, chunk_size=2**24):
+    """counts the rows of a text file without parsing it
+
+    Blank lines (ie a trailing empty line) are not rows, they are skipped
+    when the file is parsed too.
+
+    Args:
+        filename (str): path to the text file
+        skip_header (int): number of header lines to exclude from the count
+        chunk_size (int): number of bytes read at a time
+
+    Returns:
+        int : number of rows
+    """
+    nrows = 0
+    with open(filename, 'rb') as f:
+        for _ in range(skip_header):
+            f.readline()
+        partial = b""
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            # only whole lines are counted, the rest is carried to the next chunk
+            end = chunk.rfind(b"\n") + 1
+            lines = partial + chunk[:end]
+            partial = chunk[end:] if end else partial + chunk
+            if end:
+                nrows += lines.count(b"\n") - len(_BLANK_LINE.findall(lines))
+    # the final line may not be terminated with a newline
+    if partial.strip():
+        nrows += 1
+    return nrows
+
+
+def _data_offset(nsamples):
+    """byte offset of the channel data in a binary capture"""
+    offset = HEADER_SIZE + nsamples * np.dtype(np.float64).itemsize
+    return -(-offset // DATA_ALIGNMENT) * DATA_ALIGNMENT
+
+
+def convert_csv(csv_filename, out_filename, kind="coil", dtype="float32", block_size=DEFAULT_BLOCK_SIZE):
+    """converts a csv capture into a binary capture
+
+    This only has to be done once per capture, every run after that can use
+    `open_capture` on the binary file.
+
+    Args:
+        csv_filename (str): path to the csv capture
+        out_filename (str): path to write the binary capture to
+        kind (str): the kind of capture, one of "coil", "optitrack", "daq"
+        dtype (str): the dtype to store channels as, "float32" or "float64"
+        block_size (int): number of rows converted at a time
+
+    Returns:
+        Capture : the converted capture, opened read only
+    """
+    with open(csv_filename, 'r') as f:
+        names = [name.strip() for name in f.readline().strip().split(",")]
+    nsamples = count_rows(csv_filename)
+    return write_capture(out_filename, read_csv_blocks(csv_filename, block_size), names, nsamples, kind, dtype)
+
+
+def write_capture(filename, blocks, columns, nsamples, kind="coil", dtype="float32"):
+    """writes blocks of rows into a binary capture
+
+    Args:
+        filename (str): path to write the binary capture to
+        blocks (iterable): (start, rows) tuples covering every row, where rows
+            is shaped (nrows, ncolumns) in the csv column order
+        columns (list): the csv column names
+        nsamples (int): the total number of rows
+        kind (str): the kind of capture, one of "coil", "optitrack", "daq"
+        dtype (str): the dtype to store channels as, "float32" or "float64"
+
+    Returns:
+        Capture : the written capture, opened read only
+    """
+    if kind not in CAPTURE_KINDS:
+        raise ValueError("unknown capture kind '{}', must be one of {}".format(kind, sorted(CAPTURE_KINDS)))
+    dtype = np.dtype(dtype)
+    if dtype not in (np.float32, np.float64):
+        raise ValueError("captures must be stored as float32 or float64, not {}".format(dtype))
+
+    names = list(columns)
+    ts_column = CAPTURE_KINDS[kind]
+    channel_columns = [i for i in range(len(names)) if i != ts_column]
+
+    header = {"kind" : kind,
+                "nsamples" : nsamples,
+                "columns" : names,
+                "timestamp_column" : ts_column,
+                "dtype" : dtype.name,
+                "sample_rate" : None,
+                }
+    if kind == "coil":
+        ncoils = len(channel_columns) - NUM_REF_COILS
+        header["coil_channels"] = [0, ncoils]
+        header["ref_channels"] = [ncoils, ncoils + NUM_REF_COILS]
+
+    # write the header last, once we know the sample rate
+    with open(filename, 'wb') as f:
+        f.truncate(_data_offset(nsamples) + nsamples * len(channel_columns) * dtype.itemsize)
+
+    timestamps = np.memmap(filename, dtype=np.float64, mode='r+',
+                            offset=HEADER_SIZE, shape=(nsamples,))
+    channels = np.memmap(filename, dtype=dtype, mode='r+',
+                            offset=_data_offset(nsamples), shape=(nsamples, len(channel_columns)))
+    nwritten = 0
+    for start, rows in blocks:
+        stop = start + rows.shape[0]
+        if stop > nsamples:
+            raise ValueError("'{}' has more than the {} rows it was sized for".format(filename, nsamples))
+        nwritten = max(nwritten, stop)
+        timestamps[start:stop] = rows[:, ts_column]
+        channels[start:stop] = rows[:, channel_columns]
+        if header["sample_rate"] is None and rows.shape[0] > 1:
+            header["sample_rate"] = estimate_sample_rate(rows[:, ts_column])
+
+    timestamps.flush()
+    channels.flush()
+    del timestamps, channels
+    if nwritten != nsamples:
+        # the rows that were never written would read as zero samples
+        raise ValueError("only {} of the {} rows of '{}' were written".format(nwritten, nsamples, filename))
+
+    write_header(filename, header)
+    return open_capture(filename)
+
+
+def write_header(filename, header):
+    """writes the json header of a binary capture
+
+    Args:
+        filename (str): path to the binary capture
+        header (dict): the header fields
+    """
+    encoded = CAPTURE_MAGIC + json.dumps(header).encode("utf-8")
+    if len(encoded) > HEADER_SIZE:
+        raise ValueError("capture header is too large ({} bytes)".format(len(encoded)))
+    with open(filename, 'r+b') as f:
+        f.write(encoded.ljust(HEADER_SIZE, b" "))
+
+
+def read_header(filename):
+    """reads the json header of a binary capture
+
+    Args:
+        filename (str): path to the binary capture
+
+    Returns:
+        dict : the header fields
+    """
+    with open(filename, 'rb') as f:
+        raw = f.read(HEADER_SIZE)
+    if raw[:len(CAPTURE_MAGIC)] != CAPTURE_MAGIC:
+        raise ValueError("'{}' is not a binary capture".format(filename))
+    return json.loads(raw[len(CAPTURE_MAGIC):].decode("utf-8"))
+
+
+def open_capture(filename):
+    """opens a binary capture
+
+    Args:
+        filename (str): path to the binary capture
+
+    Returns:
+        Capture : the memory mapped capture
+    """
+    return Capture(filename)
+
+
+class Capture(object):
+    """A memory mapped binary capture
+
+    Slicing a capture never copies or parses anything, the operating system
+    only pages in the parts of the file that are actually touched.
+
+    Attributes:
+        filename (str): path to the binary capture
+        header (dict): the json header of the capture
+        timestamps (np.memmap): the timestamps, shape (nsamples,)
+        channels (np.memmap): every non timestamp column, shape (nsamples, nchannels)
+    """
+    def __init__(self, filename, header=None, timestamps=None, channels=None):
+        self.filename = filename
+        self.header = read_header(filename) if header is None else header
+
+        nsamples = self.header["nsamples"]
+        nchannels = len(self.header["columns"]) - 1
+        if timestamps is None:
+            timestamps = np.memmap(filename, dtype=np.float64, mode='r',
+                                    offset=HEADER_SIZE, shape=(nsamples,))
+        if channels is None:
+            channels = np.memmap(filename, dtype=self.header["dtype"], mode='r',
+                                    offset=_data_offset(nsamples), shape=(nsamples, nchannels))
+        self.timestamps = timestamps
+        self.channels = channels
+
+    def __len__(self):
+        return self.timestamps.shape[0]
+
+    @property
+    def kind(self):
+        return self.header["kind"]
+
+    @property
+    def sample_rate(self):
+        return self.header["sample_rate"]
+
+    @property
+    def ncoils(self):
+        start, stop = self.header["coil_channels"]
+        return stop - start
+
+    @property
+    def coils(self):
+        """np.ndarray : measurement coil voltages, shape (nsamples, ncoils)"""
+        return self.channels[:, slice(*self.header["coil_channels"])]
+
+    @property
+    def refs(self):
+        """np.ndarray : reference coil voltages, shape (nsamples, 3)"""
+        return self.channels[:, slice(*self.header["ref_channels"])]
+
+    def __getitem__(self, index):
+        """slices the capture along the samples axis without copying"""
+        if not isinstance(index, slice) or index.step not in (None, 1):
+            raise IndexError("captures can only be sliced with contiguous slices")
+        return Capture(self.filename, self.header, self.timestamps[index], self.channels[index])
+
+    def window(self, t_start, t_stop):
+        """selects the samples in a time window without copying
+
+        Args:
+            t_start (float): start of the window in seconds (inclusive)
+            t_stop (float): end of the window in seconds (exclusive)
+
+        Returns:
+            Capture : a capture containing only the samples in the window
+        """
+        start, stop = np.searchsorted(self.timestamps, [t_start, t_stop])
+        return self[start:stop]
+
+    def blocks(self, block_size=DEFAULT_BLOCK_SIZE):
+        """iterates over a coil capture in blocks of samples
+
+        Args:
+            block_size (int): maximum number of samples per block
+
+        Yields:
+            CoilBlock : memory mapped views of the block, these are read only
+        """
+        if self.kind != "coil":
+            raise ValueError("only coil captures can be read as coil blocks, this is a {} capture".format(self.kind))
+        coils = self.coils
+        refs = self.refs
+        for start in range(0, len(self), block_size):
+            stop = start + block_size
+            yield CoilBlock(start, self.timestamps[start:stop], coils[start:stop], refs[start:stop])
+
+    def to_rows(self, columns=None):
+        """reassembles the capture into the csv column layout
+
+        This copies the data, so only use it on small captures or selections
+
+        Args:
+            columns (tuple): indices of the csv columns to return, defaults
+                to every column
+
+        Returns:
+            np.ndarray : the requested columns as float64, shape (nsamples, ncolumns)
+        """
+        ts_column = self.header["timestamp_column"]
+        if columns is None:
+            columns = range(len(self.header["columns"]))
+
+        out = np.empty((len(self), len(columns)), dtype=np.float64)
+        for i, column in enumerate(columns):
+            if column == ts_column:
+                out[:, i] = self.timestamps
+            else:
+                out[:, i] = self.channels[:, column - (column > ts_column)]
+        return out
+
+
+if __name__ == "__main__":
+    # one time conversion of csv captures into binary captures
+    import argparse
+
+    parser = argparse.ArgumentParser(description="convert csv captures into memory mappable binary captures")
+    parser.add_argument("csv")
+    parser.add_argument("out")
+    parser.add_argument("--kind", default="coil", choices=sorted(CAPTURE_KINDS))
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float64"])
+    args = parser.parse_args()
+
+    converted = convert_csv(args.csv, args.out, args.kind, args.dtype)
+    print("converted {} samples of {} data at {}HZ".format(len(converted), converted.kind, converted.sample_rate))
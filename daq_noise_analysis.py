@@ -4,41 +4,65 @@ Date: May 27, 2019
 
 Description:
 
-    This file is a modifiable script to analyze the DAQ's read noise
+    Characterizes the DAQ's read noise
 
     The code in this file reads in data that was collected in our coil
     testing setup, however the source of the signal was a function generator
-    outputing a DC voltage:
-        1) 50mV
-        2) 150mV
-        3) 500mV
-        4) 2500mV
-
-    **Only channel 1 is used**
+    outputing a DC voltage (20mV up to 4000mV, see `FILENAMES` and
+    `DC_VOLTAGES`).
+
+    Every capture is streamed once, in blocks, so captures of any length are
+    analyzed in constant memory. For every channel of every capture a single
+    pass keeps:
+        * the running mean, variance and skew of the deviation from the DC
+          level (blocks are merged with the parallel form of Welford's
+          algorithm, extended to the third moment, see `RunningMoments`)
+        * a fixed bin histogram of the deviation
+        * the power spectral density of the deviation, with Welch's method
+          applied one block at a time (see `ChunkedWelch`)
+    The DC level captures are analyzed in parallel, one per process.
+
+    The result is a `NoiseModel` per channel and DC voltage, saved as an npz
+    file. The pipeline loads it as its read noise estimate (`main.py
+    --noise-model`) and `util.DataGenerator` can simulate it:
+
+        model = daq_noise_analysis.load_noise_model("daq_noise.npz")
+        generator = util.DataGenerator(mean_read_noise=model.read_noise(6))
+
+    Plotting the histograms and spectra is a separate, optional step that
+    needs matplotlib:
+
+        python daq_noise_analysis.py --out daq_noise.npz
+        python daq_noise_analysis.py FG_DC_20mv.cap FG_DC_100mv.cap --voltages 20 100 --plot
+        python daq_noise_analysis.py --load daq_noise.npz --plot
 
 Assumptions:
-    1) The read noise is constant at all frequencies, this is not technically
-    true, but is often a safe assumption to make especially at low frequency
-    signals (<100khz)
-
-    2) Read Noise is normally distrubuted, this is standard
-    (in practice, I observe a skew left)
+    1) Read Noise is normally distrubuted, this is standard
+    (in practice, I observe a skew left, which is why skew is recorded)
 
-    3) Signal Generator produces a perfect signal
+    2) Signal Generator produces a perfect signal
     (checked with the oscilloscope)
 
-    4) Channel 1 is representative of all channels
+    The read noise used to be assumed constant at all frequencies and channel
+    1 was assumed to be representative of all channels. Both are measured now,
+    the PSD shows how flat the noise actually is around the carriers.
 
 
 Data Format:
     Data must be in csv file shaped as such:
 
-    timestamp (in seconds), channel1 Volts, channel2 Volts (unused), channel3 Volts (unused),
-"""
+    timestamp (in seconds), channel1 Volts, channel2 Volts, channel3 Volts, ...
 
+    or a binary capture converted from that csv with `capture.py --kind daq`
+"""
+import argparse
+import multiprocessing
+import os
 
 import numpy as np
-import matplotlib.pyplot as plt
+from scipy import signal
+
+import capture
 
 FILENAMES = ["DAQ_noise_characterization/FG_DC_20mv.csv",
                 "DAQ_noise_characterization/FG_DC_100mv.csv",
@@ -51,55 +75,533 @@ FILENAMES = ["DAQ_noise_characterization/FG_DC_20mv.csv",
 #
 DC_VOLTAGES = [20, 100, 200, 600, 1000, 2000, 4000] #millivolts
 
+NOISE_MODEL_FILENAME = "daq_noise.npz"
 
 NUM_BINS = 100
-
-
-means = []
-stds = []
-snrs = []
-figs = []
-
-for i,(fname,voltage) in enumerate(zip(FILENAMES,DC_VOLTAGES)):
-
-    fig = plt.figure()
-    # fig.add_subplot(3, 2, i+1)
-    axes = plt.gca()
-
-    print("computing plot for {}mv...".format(voltage))
-
-    data = np.genfromtxt(fname, skip_header=1, usecols=(1,), delimiter=",")
-
-    #convert to millivolts and subtract our voltage
-    data = (data * 1000) - voltage
-
-    # find average and std
-    avg = np.mean(data)
-    std = np.std(data)
-
-
-    plt.hist(data, int(NUM_BINS))
-    # plt.plot(data)
-
-    plt.xlabel("Voltage (millivolts)")
-    plt.ylabel("counts")
-    plt.title("Histogram of deviations from given {}mv DC signal (DAQ - no amp)".format(voltage))
-
-    # calculate std ticks
-    deviations = [avg + (std*i) for i in range(-3,4)]
-    axes.set_xticks(deviations)
-    axes.set_xticklabels([str(round(dev,2)) + 'mv' for dev in deviations])
-
-    plt.axvline(avg,color='black')
-
-    means.append(avg)
-    stds.append(std)
-    snrs.append( avg / std )
-    figs.append(fig.number)
-
-
-
-# plt.savefig(str(voltage) + 'mv.svg')
-for fig in figs:
-    plt.figure(fig)
-    plt.show()
+# the histograms cover deviations of +-HISTOGRAM_SPAN volts from the DC level,
+# the edge bins collect everything past it
+HISTOGRAM_SPAN = 0.025
+# samples per Welch segment, ~0.04s (24HZ resolution) at 100kS/s
+WELCH_SEGMENT = 4096
+
+
+def read_channel_blocks(filename, block_size=capture.DEFAULT_BLOCK_SIZE):
+    """reads every non timestamp column of a capture in blocks of samples
+
+    Args:
+        filename (str): path to the csv or binary capture
+        block_size (int): maximum number of samples per block
+
+    Yields:
+        np.ndarray : timestamps of the block, shape (nsamples,)
+        np.ndarray : every channel of the block, shape (nsamples, nchannels)
+    """
+    if capture.is_binary_capture(filename):
+        daq = capture.open_capture(filename)
+        for start in range(0, len(daq), block_size):
+            yield daq.timestamps[start:start + block_size], daq.channels[start:start + block_size]
+        return
+
+    for _, rows in capture.read_csv_blocks(filename, block_size):
+        yield rows[:, 0], rows[:, 1:]
+
+
+def channel_names(filename):
+    """the column names of every channel of a capture
+
+    Args:
+        filename (str): path to the csv or binary capture
+
+    Returns:
+        list : the names, without the timestamp column
+    """
+    if capture.is_binary_capture(filename):
+        header = capture.read_header(filename)
+        names = list(header["columns"])
+        del names[header["timestamp_column"]]
+        return names
+    with open(filename, 'r') as f:
+        return [name.strip() for name in f.readline().strip().split(",")][1:]
+
+
+class RunningMoments(object):
+    """Running mean, variance and skew of every channel
+
+    Every block is reduced on its own and merged into the running totals with
+    the parallel form of Welford's algorithm (Chan et al., Pebay)
+        n     = n_a + n_b
+        mean  = mean_a + delta * n_b / n
+        M2    = M2_a + M2_b + delta**2 * n_a * n_b / n
+        M3    = M3_a + M3_b + delta**3 * n_a * n_b * (n_a - n_b) / n**2
+                    + 3 * delta * (n_a * M2_b - n_b * M2_a) / n
+    where delta = mean_b - mean_a, so the result is the same as a single pass
+    over every sample.
+
+    Args:
+        nchannels (int): number of channels
+    """
+    def __init__(self, nchannels):
+        self.count = 0
+        self.mean = np.zeros(nchannels)
+        self.m2 = np.zeros(nchannels)
+        self.m3 = np.zeros(nchannels)
+
+    def update(self, values):
+        """adds a block of samples
+
+        Args:
+            values (np.ndarray): shape (nsamples, nchannels)
+        """
+        count = values.shape[0]
+        if count == 0:
+            return
+        mean = values.mean(axis=0)
+        deviation = values - mean
+        squared = deviation * deviation
+        m2 = squared.sum(axis=0)
+        m3 = np.einsum("ij,ij->j", squared, deviation)
+
+        old = self.count
+        total = old + count
+        delta = mean - self.mean
+        self.m3 += (m3 + delta ** 3 * (old * count * (old - count) / total ** 2)
+                        + 3 * delta * (old * m2 - count * self.m2) / total)
+        self.m2 += m2 + delta * delta * (old * count / total)
+        self.mean += delta * (count / total)
+        self.count = total
+
+    @property
+    def std(self):
+        """population standard deviation of every channel"""
+        return np.sqrt(self.m2 / self.count) if self.count else np.full(self.mean.shape, np.nan)
+
+    @property
+    def skew(self):
+        """population skewness of every channel, negative is skewed left"""
+        if self.count == 0:
+            return np.full(self.mean.shape, np.nan)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return (self.m3 / self.count) / (self.m2 / self.count) ** 1.5
+
+
+class ChunkedWelch(object):
+    """Welch's power spectral density estimate, one block at a time
+
+    Segments of `nperseg` samples overlap by half and run across block
+    boundaries, the samples of a segment that isn't complete yet are carried
+    over to the next block. The estimate is the same as `scipy.signal.welch`
+    over the whole capture (a hann window, mean detrending and a one sided
+    density in units**2/HZ).
+
+    Args:
+        fs (float): the sampling frequency
+        nperseg (int): number of samples per segment
+    """
+    def __init__(self, fs, nperseg=WELCH_SEGMENT):
+        self.fs = float(fs)
+        self.nperseg = int(nperseg)
+        self.step = self.nperseg - self.nperseg // 2
+        self.frequencies = np.fft.rfftfreq(self.nperseg, 1 / self.fs)
+        self.segments = 0
+        self._total = None
+        self._pending = None
+
+    def update(self, values):
+        """adds a block of samples
+
+        Args:
+            values (np.ndarray): shape (nsamples, nchannels)
+        """
+        if self._pending is not None:
+            values = np.concatenate( (self._pending, values), axis=0 )
+        if values.shape[0] < self.nperseg:
+            self._pending = np.array(values, dtype=np.float64)
+            return
+        count = (values.shape[0] - self.nperseg) // self.step + 1
+        _, psd = signal.welch(values[:(count - 1) * self.step + self.nperseg], self.fs, window="hann",
+                                nperseg=self.nperseg, noverlap=self.nperseg - self.step, axis=0)
+        psd *= count
+        self._total = psd if self._total is None else self._total + psd
+        self.segments += count
+        self._pending = np.array(values[count * self.step:], dtype=np.float64)
+
+    @property
+    def psd(self):
+        """the density of every channel, shape (nfrequencies, nchannels)
+
+        Raises:
+            ValueError : before the first complete segment
+        """
+        if self._total is None:
+            raise ValueError("no complete Welch segment of {} samples yet".format(self.nperseg))
+        return self._total / self.segments
+
+
+def analyze_capture(filename, voltage, nbins=NUM_BINS, span=HISTOGRAM_SPAN, nperseg=WELCH_SEGMENT,
+                        block_size=capture.DEFAULT_BLOCK_SIZE):
+    """streams one DC level capture once
+
+    Args:
+        filename (str): path to the csv or binary capture
+        voltage (float): the DC level of the function generator (in mV)
+        nbins (int): number of histogram bins
+        span (float): the histograms cover +-span volts around the DC level
+        nperseg (int): samples per Welch segment
+        block_size (int): number of samples read at a time
+
+    Returns:
+        dict : the sample rate, count, mean, std, skew, histogram and psd of
+            the deviation (in volts) of every channel from the DC level
+    """
+    edges = np.linspace(-span, span, nbins + 1)
+    moments = None
+    for timestamps, channels in read_channel_blocks(filename, block_size):
+        if channels.shape[0] == 0:
+            continue
+        if moments is None:
+            fs = capture.estimate_sample_rate(timestamps)
+            moments = RunningMoments(channels.shape[1])
+            welch = ChunkedWelch(fs, nperseg)
+            histogram = np.zeros( (channels.shape[1], nbins), dtype=np.int64 )
+            offsets = np.arange(channels.shape[1]) * nbins
+
+        deviation = channels - voltage / 1e3
+        moments.update(deviation)
+        welch.update(deviation)
+
+        index = (deviation - edges[0]) * (nbins / (2 * span))
+        np.clip(index, 0, nbins - 1, out=index)
+        index = index.astype(np.intp) + offsets
+        histogram += np.bincount(index.ravel(), minlength=histogram.size).reshape(histogram.shape)
+
+    if moments is None:
+        raise ValueError("capture '{}' is empty".format(filename))
+    if welch.segments == 0:
+        raise ValueError("capture '{}' has {} samples, fewer than one Welch segment ({} samples). "
+                            "Use a shorter segment".format(filename, moments.count, nperseg))
+    return {"filename" : filename,
+            "voltage" : voltage,
+            "channels" : channel_names(filename),
+            "sample_rate" : fs,
+            "count" : moments.count,
+            "mean" : moments.mean,
+            "std" : moments.std,
+            "skew" : moments.skew,
+            "bin_edges" : edges,
+            "histogram" : histogram,
+            "frequencies" : welch.frequencies,
+            "psd" : welch.psd,
+            }
+
+
+def _analyze_task(task):
+    """unpacks the arguments of `analyze_capture` in a worker. Workers never
+    print, their output would interleave
+    """
+    filename, voltage, options = task
+    return analyze_capture(filename, voltage, **options)
+
+
+def analyze(filenames=FILENAMES, voltages=DC_VOLTAGES, workers=None, **options):
+    """characterizes the read noise of every channel from DC level captures,
+    analyzing the captures in parallel
+
+    Args:
+        filenames (list): paths to the csv or binary captures
+        voltages (list): the DC level of every capture (in mV)
+        workers (int): number of worker processes, defaults to the cpu count.
+            1 analyzes the captures in this process
+        **options: passed to `analyze_capture`
+
+    Returns:
+        NoiseModel : the noise model of every channel and DC voltage
+    """
+    if len(filenames) != len(voltages):
+        raise ValueError("every capture needs a DC voltage, got {} captures and {} voltages".format(len(filenames), len(voltages)))
+    if not filenames:
+        raise ValueError("no captures to analyze")
+    tasks = [(filename, voltage, options) for filename, voltage in zip(filenames, voltages)]
+    workers = min(workers or multiprocessing.cpu_count(), len(tasks))
+    if workers == 1:
+        results = [_analyze_task(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_analyze_task, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    # the results are in the order of the captures
+    for result in results:
+        print("analyzed {} ({:g}mv): {} samples at {:g}HZ".format(result["filename"], result["voltage"],
+                                                                    result["count"], result["sample_rate"]))
+    return NoiseModel.from_results(results)
+
+
+class NoiseModel(object):
+    """The read noise of every channel of the DAQ at every DC voltage
+
+    All noise statistics are of the deviation from the DC level, in volts.
+
+    Args:
+        voltages (array_like): the DC level of every capture (in mV), shape (nvoltages,)
+        channels (list): the name of every channel
+        sample_rate (float): the sampling frequency of the captures (in HZ)
+        count (array_like): samples per capture, shape (nvoltages,)
+        mean (array_like): mean deviation, shape (nvoltages, nchannels)
+        std (array_like): standard deviation, shape (nvoltages, nchannels)
+        skew (array_like): skewness, shape (nvoltages, nchannels)
+        bin_edges (array_like): histogram bin edges, shape (nbins + 1,)
+        histogram (array_like): counts, shape (nvoltages, nchannels, nbins)
+        frequencies (array_like): PSD frequencies (in HZ), shape (nfrequencies,)
+        psd (array_like): one sided power spectral density (in V**2/HZ),
+            shape (nvoltages, nfrequencies, nchannels)
+    """
+    FIELDS = ("voltages", "channels", "sample_rate", "count", "mean", "std", "skew",
+                "bin_edges", "histogram", "frequencies", "psd")
+
+    def __init__(self, voltages, channels, sample_rate, count, mean, std, skew, bin_edges, histogram, frequencies, psd):
+        self.voltages = np.asarray(voltages, dtype=np.float64)
+        self.channels = [str(name) for name in channels]
+        self.sample_rate = float(sample_rate)
+        self.count = np.asarray(count, dtype=np.int64)
+        self.mean = np.asarray(mean, dtype=np.float64)
+        self.std = np.asarray(std, dtype=np.float64)
+        self.skew = np.asarray(skew, dtype=np.float64)
+        self.bin_edges = np.asarray(bin_edges, dtype=np.float64)
+        self.histogram = np.asarray(histogram, dtype=np.int64)
+        self.frequencies = np.asarray(frequencies, dtype=np.float64)
+        self.psd = np.asarray(psd, dtype=np.float64)
+
+        shape = (self.voltages.shape[0], len(self.channels))
+        if self.std.shape != shape or self.histogram.shape[:2] != shape:
+            raise ValueError("noise statistics must be shaped (voltages, channels) = {}".format(shape))
+        if self.psd.shape != (shape[0], self.frequencies.shape[0], shape[1]):
+            raise ValueError("psd must be shaped (voltages, frequencies, channels), got {}".format(self.psd.shape))
+
+    @classmethod
+    def from_results(cls, results):
+        """combines the output of `analyze_capture` for every DC voltage
+
+        Args:
+            results (list): dicts from `analyze_capture`
+
+        Returns:
+            NoiseModel : the model, with the voltages in increasing order
+        """
+        results = sorted(results, key=lambda result: result["voltage"])
+        first = results[0]
+        for result in results[1:]:
+            if result["channels"] != first["channels"]:
+                raise ValueError("'{}' has channels {}, '{}' has {}".format(first["filename"], first["channels"],
+                                                                            result["filename"], result["channels"]))
+            if not np.isclose(result["sample_rate"], first["sample_rate"], rtol=1e-6):
+                raise ValueError("'{}' and '{}' were recorded at different sample rates".format(first["filename"],
+                                                                                                result["filename"]))
+            if result["bin_edges"].shape != first["bin_edges"].shape or result["frequencies"].shape != first["frequencies"].shape:
+                raise ValueError("every capture must be analyzed with the same histogram and Welch settings")
+        stack = lambda name: np.stack([result[name] for result in results])
+        return cls([result["voltage"] for result in results], first["channels"], first["sample_rate"],
+                    [result["count"] for result in results], stack("mean"), stack("std"), stack("skew"),
+                    first["bin_edges"], stack("histogram"), first["frequencies"], stack("psd"))
+
+    @classmethod
+    def load(cls, filename):
+        """reads a model saved with `save`
+
+        Args:
+            filename (str): path to the npz file
+
+        Returns:
+            NoiseModel : the model
+        """
+        with np.load(filename) as arrays:
+            return cls(**{name : arrays[name] for name in cls.FIELDS})
+
+    def save(self, filename):
+        """writes this model to an npz file
+
+        Args:
+            filename (str): path to write the model to
+        """
+        # write to a temporary file first, a crash must never leave a partial model
+        tmp = filename + ".tmp.npz"
+        np.savez(tmp, **{name : getattr(self, name) for name in self.FIELDS})
+        os.replace(tmp, filename)
+
+    @property
+    def nchannels(self):
+        return len(self.channels)
+
+    def _select(self, values, nchannels, voltage):
+        """averages per voltage values over the voltages (or takes the nearest
+        voltage) and fits them to `nchannels` channels
+        """
+        if voltage is None:
+            values = np.nanmean(values, axis=0)
+        else:
+            values = values[np.argmin(np.abs(self.voltages - voltage))]
+        if nchannels is None:
+            return values
+        # channels past the characterized ones get the mean of all of them
+        out = np.empty(values.shape[:-1] + (nchannels,))
+        measured = min(nchannels, self.nchannels)
+        out[..., :measured] = values[..., :measured]
+        out[..., measured:] = np.nanmean(values, axis=-1, keepdims=True)
+        return out
+
+    def read_noise(self, nchannels=None, voltage=None):
+        """the read noise standard deviation of every channel
+
+        Args:
+            nchannels (int): number of channels to return. Channels past the
+                characterized ones get the mean read noise of all of them
+            voltage (float): use the DC level closest to this voltage (in mV)
+                instead of the mean over every DC level
+
+        Returns:
+            np.ndarray : the read noise (in volts), shape (nchannels,)
+        """
+        return self._select(self.std, nchannels, voltage)
+
+    def noise_density(self, frequencies, nchannels=None, voltage=None):
+        """the read noise power spectral density of every channel
+
+        Args:
+            frequencies (array_like): frequencies to evaluate (in HZ)
+            nchannels (int): number of channels to return, see `read_noise`
+            voltage (float): use the DC level closest to this voltage (in mV)
+                instead of the mean over every DC level
+
+        Returns:
+            np.ndarray : one sided density (in V**2/HZ), shape (nfrequencies, nchannels)
+        """
+        psd = self._select(self.psd, None, voltage)
+        frequencies = np.atleast_1d(np.asarray(frequencies, dtype=np.float64))
+        density = np.stack([np.interp(frequencies, self.frequencies, psd[:, i]) for i in range(self.nchannels)], axis=-1)
+        if nchannels is None:
+            return density
+        return self._select(density[np.newaxis], nchannels, None)
+
+    def summary(self):
+        """describes the noise of every channel at every DC voltage
+
+        Returns:
+            list : one line per DC voltage and channel
+        """
+        lines = []
+        for i, voltage in enumerate(self.voltages):
+            for j, name in enumerate(self.channels):
+                mean = self.mean[i, j]
+                std = self.std[i, j]
+                lines.append("{:g}mv {}: mean {:+.4f}mv, std {:.4f}mv, skew {:+.3f}, snr {:.1f}".format(
+                                voltage, name, mean * 1e3, std * 1e3, self.skew[i, j],
+                                voltage / 1e3 / std if std else np.inf))
+        return lines
+
+
+def load_noise_model(filename):
+    """reads a noise model saved by `NoiseModel.save`
+
+    Args:
+        filename (str): path to the npz file
+
+    Returns:
+        NoiseModel : the model
+    """
+    return NoiseModel.load(filename)
+
+
+################################################################################
+# PLOTTING
+################################################################################
+def plot(model, directory=None, show=True):
+    """plots the histograms and spectra of a noise model, needs matplotlib
+
+    Args:
+        model (NoiseModel): the model to plot
+        directory (str): save every figure as an svg in this directory
+        show (bool): show the figures, blocks until they are closed
+
+    Returns:
+        list : the matplotlib figures
+    """
+    import matplotlib.pyplot as plt
+
+    centers = (model.bin_edges[:-1] + model.bin_edges[1:]) / 2 * 1e3
+    widths = np.diff(model.bin_edges) * 1e3
+    figs = []
+    for i, voltage in enumerate(model.voltages):
+        fig, all_axes = plt.subplots(1, model.nchannels, figsize=(5 * model.nchannels, 4), squeeze=False)
+        for j, axes in enumerate(all_axes[0]):
+            avg = model.mean[i, j] * 1e3
+            std = model.std[i, j] * 1e3
+            axes.bar(centers, model.histogram[i, j], widths)
+            axes.set_xlabel("Voltage (millivolts)")
+            axes.set_ylabel("counts")
+            axes.set_title("{} (skew {:+.2f})".format(model.channels[j], model.skew[i, j]))
+
+            # calculate std ticks
+            deviations = [avg + (std * k) for k in range(-3, 4)]
+            axes.set_xticks(deviations)
+            axes.set_xticklabels([str(round(dev, 2)) + 'mv' for dev in deviations])
+            axes.axvline(avg, color='black')
+        fig.suptitle("Histogram of deviations from given {:g}mv DC signal (DAQ - no amp)".format(voltage))
+        figs.append(fig)
+
+    fig, all_axes = plt.subplots(1, model.nchannels, figsize=(5 * model.nchannels, 4), squeeze=False)
+    for j, axes in enumerate(all_axes[0]):
+        for i, voltage in enumerate(model.voltages):
+            axes.loglog(model.frequencies[1:], model.psd[i, 1:, j], label="{:g}mv".format(voltage))
+        axes.set_xlabel("Frequency (HZ)")
+        axes.set_ylabel("PSD (V**2/HZ)")
+        axes.set_title(model.channels[j])
+        axes.legend()
+    fig.suptitle("Read noise power spectral density")
+    figs.append(fig)
+
+    if directory is not None:
+        for k, fig in enumerate(figs):
+            name = "{:g}mv.svg".format(model.voltages[k]) if k < len(model.voltages) else "psd.svg"
+            fig.savefig(os.path.join(directory, name))
+    if show:
+        plt.show()
+    return figs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="characterize the DAQ read noise from DC level captures")
+    parser.add_argument("captures", nargs="*", default=FILENAMES, help="csv or binary DC level captures")
+    parser.add_argument("--voltages", nargs="+", default=None, type=float,
+                        help="DC level of every capture (in mV), required if captures are given")
+    parser.add_argument("--out", default=NOISE_MODEL_FILENAME, help="where to save the noise model")
+    parser.add_argument("--load", default=None, help="read this noise model instead of analyzing captures")
+    parser.add_argument("--workers", default=None, type=int, help="number of processes, defaults to the cpu count")
+    parser.add_argument("--bins", default=NUM_BINS, type=int)
+    parser.add_argument("--span", default=HISTOGRAM_SPAN, type=float, help="histogram half width (in volts)")
+    parser.add_argument("--segment", default=WELCH_SEGMENT, type=int, help="samples per Welch segment")
+    parser.add_argument("--plot", default=False, action="store_true", help="plot the histograms and spectra (needs matplotlib)")
+    parser.add_argument("--plot-dir", default=None, help="save the plots as svg files in this directory")
+    args = parser.parse_args(argv)
+
+    if args.load:
+        model = load_noise_model(args.load)
+    else:
+        voltages = args.voltages
+        if voltages is None:
+            if args.captures != FILENAMES:
+                parser.error("--voltages is required when captures are given")
+            voltages = DC_VOLTAGES
+        model = analyze(args.captures, voltages, args.workers, nbins=args.bins, span=args.span, nperseg=args.segment)
+        model.save(args.out)
+        print("saved the noise model to {}".format(args.out))
+
+    for line in model.summary():
+        print(line)
+    if args.plot or args.plot_dir:
+        plot(model, args.plot_dir, show=args.plot)
+    return model
+
+
+if __name__ == "__main__":
+    main()
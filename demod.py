@@ -0,0 +1,495 @@
+"""
+Amplitude and phase extraction
+
+The coil signals are amplitude modulated carriers, so their amplitude and phase
+are recovered by lock-in (I/Q) demodulation: each channel is multiplied by a
+complex oscillator at every carrier frequency, low pass filtered, and
+decimated straight down to the OptiTrack frame rate.
+
+For a carrier `A * cos(2*pi*f*t + phi)` the demodulated output is
+`A/2 * exp(1j * phi)`, so the amplitude is twice the magnitude and the phase
+is measured relative to a cosine that started at the first sample of the
+capture. The phase of a measurement coil is therefore directly comparable to
+the phase of its reference coil.
+
+`AnalyticSignal` is an alternative backend that computes the analytic signal
+of band separated data with an FIR hilbert transformer applied in overlap-save
+blocks. It produces the same amplitude and phase products as `LockIn`, either
+at every sample or at the frame rate.
+
+Both demodulators work in float64/complex128 unless they are given
+`dtype=float32`, then every buffer, the filter state and the products are
+float32/complex64. Oscillator phases are always computed in float64 first.
+"""
+import functools
+import math
+
+import numpy as np
+from scipy import fft, signal
+
+from filters import BAND_CENTERS, make_executor, run_tasks, split_channels
+
+
+@functools.lru_cache(maxsize=None)
+def design_lowpass(fs, cutoff, order):
+    """designs a butterworth lowpass filter in second order sections form
+
+    Args:
+        fs (float): the sampling frequency
+        cutoff (float): the cutoff frequency (in HZ)
+        order (int): the order of the butterworth filter
+
+    Returns:
+        np.ndarray : the filter sections. This array is shared between callers
+            and must not be modified
+    """
+    sos = signal.butter(order, cutoff, btype="low", output="sos", fs=fs)
+    sos.setflags(write=False)
+    return sos
+
+
+def choose_predecimation(fs, centers, cutoff, oversample=16):
+    """chooses how many samples to average together before the lowpass filter
+
+    Averaging M samples is a boxcar filter with nulls at multiples of fs/M,
+    which are exactly the frequencies that alias to DC when we keep one sample
+    in M. If fs/M divides every carrier frequency, every mixing product of two
+    carriers lands on a null and is removed completely.
+
+    Args:
+        fs (float): the sampling frequency
+        centers (tuple): the carrier frequencies (in HZ)
+        cutoff (float): the lowpass cutoff frequency (in HZ)
+        oversample (int): the minimum ratio between the decimated rate and
+            the cutoff frequency
+
+    Returns:
+        int : the predecimation factor M
+    """
+    max_factor = max(int(fs / (oversample * cutoff)), 1)
+    freqs = [fs] + list(centers)
+    if all(float(f).is_integer() for f in freqs):
+        # fs / M must divide the gcd of the sample rate and the carriers
+        step = int(fs) // functools.reduce(math.gcd, [int(f) for f in freqs])
+        if step <= max_factor:
+            return (max_factor // step) * step
+    return max_factor
+
+
+class FrameSampler(object):
+    """Linearly interpolates a stream of evenly spaced samples at frame times
+
+    The stream is fed in consecutive blocks of any length. Frames that fall
+    after the last sample of a block are produced by the next block.
+
+    Args:
+        samples_per_frame (float): number of stream samples per output frame
+        offset (float): fractional stream index of frame 0
+    """
+    def __init__(self, samples_per_frame, offset=0.0):
+        self.samples_per_frame = float(samples_per_frame)
+        self.offset = float(offset)
+        self.reset()
+
+    def reset(self):
+        """restarts the stream at sample 0"""
+        self._count = 0
+        self._previous = None
+        self._next_frame = 0
+
+    def sample(self, values):
+        """interpolates the frames that fall within a block of the stream
+
+        Args:
+            values (np.ndarray): the next block of the stream, samples along axis 0
+
+        Returns:
+            np.ndarray : the indices of the frames in this block
+            np.ndarray : the interpolated value of every frame, shape
+                (nframes,) + values.shape[1:]
+        """
+        first = self._count
+        self._count += values.shape[0]
+        if self._previous is None:
+            # the stream is zero before its first sample
+            self._previous = np.zeros( (1,) + values.shape[1:], dtype=values.dtype )
+        # stream samples [first - 1, self._count)
+        values = np.concatenate( (self._previous, values), axis=0 )
+        self._previous = values[-1:].copy()
+
+        # frames j with first - 1 <= offset + j * samples_per_frame <= count - 1
+        last_frame = int(np.floor((self._count - 1 - self.offset) / self.samples_per_frame))
+        frames = np.arange(self._next_frame, max(last_frame + 1, self._next_frame))
+        position = self.offset + frames * self.samples_per_frame
+        keep = position >= first - 1
+        frames = frames[keep]
+        position = position[keep]
+        if frames.size:
+            self._next_frame = int(frames[-1]) + 1
+
+        lower = np.floor(position).astype(int)
+        weight = (position - lower).reshape( (-1,) + (1,) * (values.ndim - 1) )
+        lower -= first - 1
+        # the last frame may land exactly on the final sample
+        upper = np.minimum(lower + 1, values.shape[0] - 1)
+        interpolated = values[lower] * (1 - weight) + values[upper] * weight
+        return frames, interpolated.astype(values.dtype, copy=False)
+
+
+class LockIn(object):
+    """A lock-in demodulator for every carrier frequency
+
+    Every channel is demodulated at every carrier in one vectorized pass, and
+    the result is decimated to `frame_rate`. All state (oscillator phase,
+    filter state, partially averaged samples) is carried between calls, so a
+    capture can be demodulated one block at a time.
+
+    Args:
+        fs (float): the sampling frequency
+        frame_rate (float): the output frame rate, usually the OptiTrack rate
+        centers (tuple): the carrier frequency of each band (in HZ)
+        cutoff (float): the lowpass cutoff (in HZ). Defaults to frame_rate / 4
+        order (int): the order of the butterworth lowpass filter
+        compensate_delay (bool): whether to account for the group delay of the
+            lowpass filter, so that output frames line up with the input
+            samples they describe
+        workers (int): number of threads to split the channels over while
+            mixing and averaging, the output is identical for any number
+        dtype (np.dtype): float64 or float32, the precision of the products.
+            The baseband and filter state are the matching complex type
+    """
+    def __init__(self, fs, frame_rate, centers=BAND_CENTERS, cutoff=None, order=4, compensate_delay=True, workers=1,
+                    dtype=np.float64):
+        self.fs = float(fs)
+        self.frame_rate = float(frame_rate)
+        self.centers = tuple(float(c) for c in centers)
+        self.cutoff = self.frame_rate / 4 if cutoff is None else float(cutoff)
+        self.order = int(order)
+        self.compensate_delay = compensate_delay
+        self.workers = int(workers)
+        self._executor = make_executor(self.workers)
+        self.dtype = np.dtype(dtype)
+        self.complex_dtype = np.result_type(self.dtype, np.complex64)
+
+        self.decimation = choose_predecimation(self.fs, self.centers, self.cutoff)
+        self.sos = design_lowpass(self.fs / self.decimation, self.cutoff, self.order)
+        self._sos = self.sos.astype(self.dtype)
+        # carrier frequencies in cycles per sample
+        self._cycles = np.asarray(self.centers) / self.fs
+
+        # the lowpass filter delays the output by its group delay at DC
+        self.delay = self.group_delay() if compensate_delay else 0.0
+
+        # group g is centered on sample g*M + (M-1)/2 and represents the input
+        # `delay` samples before that. frame j is at sample j * fs / frame_rate
+        self._sampler = FrameSampler(self.fs / self.frame_rate / self.decimation,
+                                        (self.delay - (self.decimation - 1) / 2) / self.decimation)
+        self.reset()
+
+    @property
+    def nbands(self):
+        return len(self.centers)
+
+    def group_delay(self):
+        """the group delay of the lowpass filter at DC
+
+        Returns:
+            float : the group delay (in samples at `fs`)
+        """
+        _, gd = signal.group_delay(signal.sos2tf(self.sos), w=[0])
+        return gd[0] * self.decimation
+
+    def reset(self):
+        """clears all state, the next block is treated as the start of a
+        new capture
+        """
+        self.zi = None
+        self._carry = None
+        self._consumed = 0
+        self._sampler.reset()
+
+    def close(self):
+        """shuts down the worker threads. The demodulator still works, on
+        the calling thread only
+        """
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def demodulate(self, data):
+        """demodulates a block of samples
+
+        Args:
+            data (np.ndarray): either raw channels shaped (nsamples, nchannels),
+                which are demodulated at every carrier, or band separated
+                channels shaped (nsamples, nchannels, nbands) from a
+                `filters.FilterBank`, where band i is demodulated at carrier i
+
+        Returns:
+            np.ndarray : time of each output frame relative to the first
+                sample of the capture (in seconds), shape (nframes,)
+            np.ndarray : amplitude, shape (nframes, nchannels, nbands)
+            np.ndarray : phase in radians, shape (nframes, nchannels, nbands)
+        """
+        groups = self._mix_average(data)
+
+        if self.zi is None:
+            self.zi = np.zeros( (self.sos.shape[0], 2) + groups.shape[1:], dtype=self.complex_dtype )
+        filtered, self.zi = signal.sosfilt(self._sos, groups, axis=0, zi=self.zi)
+
+        frames, picked = self._sampler.sample(filtered)
+        times = frames / self.frame_rate
+        return times, 2 * np.abs(picked), np.angle(picked)
+
+    def flush(self):
+        """the lock-in never holds back complete frames, this exists so that
+        every demodulator can be driven the same way
+
+        Returns:
+            the same products as `demodulate`, always empty
+        """
+        shape = (0,) if self.zi is None else (0,) + self.zi.shape[2:]
+        return np.empty( (0,) ), np.empty(shape, dtype=self.dtype), np.empty(shape, dtype=self.dtype)
+
+    def _mix_average(self, data):
+        """multiplies the data by a complex oscillator at every carrier and
+        averages every `decimation` samples together, carrying leftovers
+
+        Every channel is mixed and averaged on its own, so the channels are
+        split into a group per worker.
+        """
+        nsamples, nchannels = data.shape[:2]
+        if data.ndim == 3 and data.shape[2] != self.nbands:
+            raise ValueError("expected {} bands, got {}".format(self.nbands, data.shape[2]))
+        # keep the phase small to avoid losing precision on long captures
+        start = np.mod(self._cycles * self._consumed, 1.0)
+        n = np.arange(nsamples).reshape( (-1,1) )
+        oscillator = np.exp(-2j * np.pi * (start + n * self._cycles)).astype(self.complex_dtype, copy=False)
+        self._consumed += nsamples
+
+        carry = self._carry
+        if carry is None:
+            carry = np.empty( (0, nchannels, self.nbands), dtype=self.complex_dtype )
+        total = carry.shape[0] + nsamples
+        ngroups = total // self.decimation
+        used = ngroups * self.decimation
+        groups = np.empty( (ngroups, nchannels, self.nbands), dtype=self.complex_dtype )
+        self._carry = np.empty( (total - used, nchannels, self.nbands), dtype=self.complex_dtype )
+
+        data = np.asarray(data, dtype=self.dtype)
+        def task(channels):
+            if data.ndim == 2:
+                # raw channels, every channel at every carrier
+                baseband = data[:, channels, np.newaxis] * oscillator[:, np.newaxis, :]
+            else:
+                baseband = data[:, channels] * oscillator[:, np.newaxis, :]
+            if carry.shape[0]:
+                baseband = np.concatenate( (carry[:, channels], baseband), axis=0 )
+            groups[:, channels] = baseband[:used].reshape( (ngroups, self.decimation) + baseband.shape[1:] ).mean(axis=1)
+            self._carry[:, channels] = baseband[used:]
+        run_tasks(self._executor, task, [(channels,) for channels in split_channels(nchannels, self.workers)])
+        return groups
+
+
+def demodulate_blocks(demodulator, blocks):
+    """demodulates a sequence of blocks, including the final flush
+
+    Args:
+        demodulator (LockIn, AnalyticSignal): the demodulator to use
+        blocks (iterable): blocks of samples to demodulate
+
+    Yields:
+        the (times, amplitude, phase) products of every block that produced
+        any output
+    """
+    for block in blocks:
+        products = demodulator.demodulate(block)
+        if products[0].size:
+            yield products
+    products = demodulator.flush()
+    if products[0].size:
+        yield products
+
+
+def hilbert_fir(ntaps, beta=8.0):
+    """designs a kaiser windowed FIR hilbert transformer
+
+    Args:
+        ntaps (int): number of taps, must be odd
+        beta (float): kaiser window shape parameter
+
+    Returns:
+        np.ndarray : the filter taps, shape (ntaps,). The filter delays its
+            input by (ntaps - 1) // 2 samples
+    """
+    if ntaps % 2 == 0:
+        raise ValueError("hilbert transformers must have an odd number of taps, not {}".format(ntaps))
+    n = np.arange(ntaps) - (ntaps - 1) // 2
+    taps = np.zeros(ntaps)
+    odd = (n % 2) != 0
+    taps[odd] = 2 / (np.pi * n[odd])
+    return taps * np.kaiser(ntaps, beta)
+
+
+class AnalyticSignal(object):
+    """Analytic signal amplitude and phase using overlap-save hilbert filtering
+
+    Unlike `scipy.signal.hilbert`, which needs the entire capture in memory,
+    the hilbert transform is applied as an FIR filter in fixed size FFT
+    blocks. The FFT size is chosen with `next_fast_len` and never changes, so
+    the FFT plans, kernel spectrum and block buffer are all reused.
+
+    The input must be band separated (the output of a `filters.FilterBank`),
+    because the analytic signal of a sum of carriers has no per-band meaning.
+
+    Args:
+        fs (float): the sampling frequency
+        centers (tuple): the carrier frequency of each band (in HZ)
+        frame_rate (float): output frame rate, if None then every sample is
+            output. Defaults to None
+        ntaps (int): number of taps in the hilbert transformer
+        nfft (int): minimum FFT size, rounded up with `next_fast_len`
+        workers (int): number of threads the FFTs of the (channel, band)
+            columns are split over
+        dtype (np.dtype): float64 or float32, the precision of the products,
+            the block buffer and the FFTs
+    """
+    def __init__(self, fs, centers=BAND_CENTERS, frame_rate=None, ntaps=255, nfft=16384, workers=1, dtype=np.float64):
+        self.fs = float(fs)
+        self.centers = tuple(float(c) for c in centers)
+        self.frame_rate = None if frame_rate is None else float(frame_rate)
+        self.ntaps = int(ntaps)
+        self.delay = (self.ntaps - 1) // 2
+        self.workers = int(workers)
+        self.dtype = np.dtype(dtype)
+        self.complex_dtype = np.result_type(self.dtype, np.complex64)
+
+        self.nfft = fft.next_fast_len(max(int(nfft), 2 * self.ntaps), real=True)
+        # every FFT block produces this many new output samples
+        self.hop = self.nfft - (self.ntaps - 1)
+        self._kernel = fft.rfft(hilbert_fir(self.ntaps), self.nfft).reshape( (-1,1) ).astype(self.complex_dtype)
+        self._cycles = np.asarray(self.centers) / self.fs
+
+        samples_per_frame = 1.0 if frame_rate is None else self.fs / self.frame_rate
+        self._sampler = FrameSampler(samples_per_frame)
+        self.reset()
+
+    @property
+    def nbands(self):
+        return len(self.centers)
+
+    def reset(self):
+        """clears all state, the next block is treated as the start of a
+        new capture
+        """
+        self._buffer = None
+        self._fill = self.ntaps - 1
+        self._consumed = 0
+        self._sampler.reset()
+
+    def close(self):
+        """nothing to release, the FFTs use scipy's own workers"""
+
+    def demodulate(self, data):
+        """computes the amplitude and phase of a block of band separated data
+
+        Output lags the input by `delay` samples plus up to one FFT hop, call
+        `flush` after the final block to retrieve the rest.
+
+        Args:
+            data (np.ndarray): band separated channels shaped
+                (nsamples, nchannels, nbands)
+
+        Returns:
+            np.ndarray : time of each output sample or frame relative to the
+                first sample of the capture (in seconds), shape (nout,)
+            np.ndarray : amplitude, shape (nout, nchannels, nbands)
+            np.ndarray : phase in radians relative to the carrier, shape
+                (nout, nchannels, nbands)
+        """
+        if data.ndim != 3 or data.shape[2] != self.nbands:
+            raise ValueError("expected band separated data shaped (nsamples, nchannels, {})".format(self.nbands))
+        self._consumed += data.shape[0]
+        return self._process(data.reshape( (data.shape[0], -1) ), data.shape[1:])
+
+    def flush(self):
+        """processes the samples still held back by the hilbert filter
+
+        Returns:
+            the same products as `demodulate`, for the final samples
+        """
+        if self._buffer is None:
+            return self._products(np.empty( (0, 0, self.nbands), dtype=self.complex_dtype ), 0)
+        # outputs lag the input by `delay` samples, so push that many zeros
+        # through and then transform whatever is left in the final block
+        self._fill_buffer(np.zeros( (self.delay, self._buffer.shape[1]), dtype=self.dtype ))
+        if self._fill > self.ntaps - 1:
+            self._buffer[self._fill:] = 0
+            self._transform()
+        return self._emit()
+
+    def _process(self, data, shape):
+        """runs the overlap-save blocks over flattened (nsamples, nchannels * nbands) data"""
+        if self._buffer is None:
+            # rows [0, ntaps - 1) hold the previous block's tail, zero at the start
+            self._buffer = np.zeros( (self.nfft, data.shape[1]), dtype=self.dtype )
+            self._shape = shape
+            self._outputs = []
+            self._next_index = -self.delay
+        self._fill_buffer(data)
+        return self._emit()
+
+    def _fill_buffer(self, data):
+        """copies data into the block buffer, transforming every full block"""
+        position = 0
+        while position < data.shape[0]:
+            count = min(self.nfft - self._fill, data.shape[0] - position)
+            self._buffer[self._fill:self._fill + count] = data[position:position + count]
+            self._fill += count
+            position += count
+            if self._fill == self.nfft:
+                self._transform()
+
+    def _emit(self):
+        """converts the analytic samples produced so far into products"""
+        if self._outputs:
+            analytic = np.concatenate(self._outputs, axis=0)
+        else:
+            analytic = np.empty( (0, self._buffer.shape[1]), dtype=self.complex_dtype )
+        self._outputs = []
+
+        # drop outputs from before the start or after the end of the capture
+        first = self._next_index - analytic.shape[0]
+        start = max(-first, 0)
+        stop = max(min(analytic.shape[0], self._consumed - first), start)
+        analytic = analytic[start:stop]
+        first += start
+        return self._products(analytic.reshape( (-1,) + self._shape ), first)
+
+    def _transform(self):
+        """hilbert transforms one full block and shifts its tail to the front"""
+        # linear convolution outputs [ntaps - 1, nfft) are valid
+        spectrum = fft.rfft(self._buffer, axis=0, workers=self.workers)
+        imag = fft.irfft(spectrum * self._kernel, self.nfft, axis=0, workers=self.workers)[self.ntaps - 1:]
+        # the real part is the input delayed to line up with the hilbert output
+        real = self._buffer[self.delay:self.delay + self.hop]
+        self._outputs.append(real + 1j * imag)
+        self._next_index += self.hop
+
+        self._buffer[:self.ntaps - 1] = self._buffer[self.hop:]
+        self._fill = self.ntaps - 1
+
+    def _products(self, analytic, first):
+        """converts analytic samples [first, first + n) into amplitude and phase"""
+        # remove the carrier so that phase is relative to a cosine starting at sample 0
+        start = np.mod(self._cycles * first, 1.0)
+        n = np.arange(analytic.shape[0]).reshape( (-1,1) )
+        carrier = np.exp(-2j * np.pi * (start + n * self._cycles)).astype(self.complex_dtype, copy=False)
+        baseband = analytic * carrier[:, np.newaxis, :]
+
+        if self.frame_rate is None:
+            times = (first + np.arange(analytic.shape[0])) / self.fs
+        else:
+            frames, baseband = self._sampler.sample(baseband)
+            times = frames / self.frame_rate
+        return times, np.abs(baseband), np.angle(baseband)
@@ -0,0 +1,440 @@
+"""
+Field map
+
+Accumulates the coil products of many captures into a 3D voxel grid covering
+the mapped volume. Every voxel holds the running count, mean and variance of
+the values measured inside it, so a map can be built up one capture at a time
+and new captures fold into an existing map without reprocessing the old ones.
+
+Each run of samples is reduced per voxel first and then merged into the map
+with the parallel form of Welford's algorithm (Chan et al.)
+    n     = n_a + n_b
+    mean  = mean_a + delta * n_b / n
+    M2    = M2_a + M2_b + delta**2 * n_a * n_b / n
+where delta = mean_b - mean_a, so the result is the same as a single pass over
+every sample ever added.
+
+A map is stored as a directory:
+    meta.json  : grid geometry, value shape and the captures already added
+    count.npy  : samples per voxel, shape (nx, ny, nz)
+    mean.npy   : running mean, shape (nx, ny, nz) + value_shape
+    m2.npy     : running sum of squared deviations, same shape as mean
+The arrays are opened memory mapped, so maps larger than memory can be queried
+and updated. A map opened to add samples works on a temporary copy of the
+arrays, which replaces the map directory only once the new meta.json is
+written into it. A crash while a capture is being added leaves the saved map
+as it was, and the captures listed in meta.json are exactly the captures
+counted in the arrays, so no capture is ever counted twice.
+
+    python fieldmap.py field_map session_results/*.npz --voxel-size 0.01 --lower -1 -1 0 --upper 1 1 2
+    python fieldmap.py field_map session_results/results --voxel-size 0.01 --lower -1 -1 0 --upper 1 1 2
+
+Results stores (see `resultstore.py`) are read one chunk at a time, so
+captures of any length are added in constant memory.
+"""
+import argparse
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+import align
+import resultstore
+
+META_FILENAME = "meta.json"
+ARRAY_NAMES = ("count", "mean", "m2")
+
+# offsets of the 8 corners of a voxel cell, used for trilinear interpolation
+_CORNERS = np.array([(i, j, k) for i in (0, 1) for j in (0, 1) for k in (0, 1)])
+
+
+class FieldMap(object):
+    """A voxel grid of running statistics
+
+    Args:
+        lower (array_like): (x, y, z) of the lower corner of the grid
+        voxel_size (float): edge length of a voxel, in the optitrack units
+        shape (tuple): number of voxels along x, y and z
+        value_shape (tuple): shape of the value measured at every sample, ie
+            (coils, bands)
+        count (np.ndarray): existing voxel counts, used when loading a map
+        mean (np.ndarray): existing voxel means, used when loading a map
+        m2 (np.ndarray): existing sums of squared deviations, used when
+            loading a map
+        captures (list): names of the captures already added to the map
+    """
+    def __init__(self, lower, voxel_size, shape, value_shape=(), count=None, mean=None, m2=None, captures=()):
+        self.lower = np.asarray(lower, dtype=np.float64).reshape(3)
+        self.voxel_size = float(voxel_size)
+        self.shape = tuple(int(s) for s in shape)
+        self.value_shape = tuple(int(s) for s in value_shape)
+        if self.voxel_size <= 0 or len(self.shape) != 3 or min(self.shape) < 1:
+            raise ValueError("invalid grid (voxel_size={}, shape={})".format(voxel_size, shape))
+
+        full_shape = self.shape + self.value_shape
+        self.count = np.zeros(self.shape, dtype=np.int64) if count is None else count
+        self.mean = np.zeros(full_shape) if mean is None else mean
+        self.m2 = np.zeros(full_shape) if m2 is None else m2
+        if self.count.shape != self.shape or self.mean.shape != full_shape or self.m2.shape != full_shape:
+            raise ValueError("voxel arrays don't match the grid shape {}".format(full_shape))
+        self.captures = list(captures)
+        # the temporary copy of the arrays being updated, see `load`
+        self._working = None
+
+    @classmethod
+    def from_bounds(cls, lower, upper, voxel_size, value_shape=()):
+        """creates an empty map covering a box
+
+        Args:
+            lower (array_like): (x, y, z) of the lower corner of the box
+            upper (array_like): (x, y, z) of the upper corner of the box
+            voxel_size (float): edge length of a voxel
+            value_shape (tuple): shape of the value measured at every sample
+
+        Returns:
+            FieldMap : the empty map
+        """
+        lower = np.asarray(lower, dtype=np.float64)
+        upper = np.asarray(upper, dtype=np.float64)
+        if np.any(upper <= lower):
+            raise ValueError("upper corner {} must be above the lower corner {}".format(upper, lower))
+        shape = np.maximum(np.ceil((upper - lower) / voxel_size), 1).astype(int)
+        return cls(lower, voxel_size, shape, value_shape)
+
+    @classmethod
+    def load(cls, directory, mode="r+"):
+        """opens a map saved with `save`
+
+        Args:
+            directory (str): the map directory
+            mode (str): memmap mode, "r" for read only or "r+" to add samples
+                to a temporary copy of the arrays that `save` moves into
+                place. None reads the arrays into memory
+
+        Returns:
+            FieldMap : the map
+        """
+        with open(os.path.join(directory, META_FILENAME), 'r') as f:
+            meta = json.load(f)
+        working = None
+        source = directory
+        if mode == "r+":
+            working = _temporary_directory(directory)
+            os.makedirs(working)
+            for name in ARRAY_NAMES:
+                shutil.copyfile(os.path.join(directory, name + ".npy"), os.path.join(working, name + ".npy"))
+            source = working
+        arrays = {name : np.load(os.path.join(source, name + ".npy"), mmap_mode=mode) for name in ARRAY_NAMES}
+        fieldmap = cls(meta["lower"], meta["voxel_size"], meta["shape"], meta["value_shape"],
+                        captures=meta["captures"], **arrays)
+        fieldmap._working = working
+        return fieldmap
+
+    def save(self, directory):
+        """writes this map to a directory
+
+        The map is written to a temporary directory that then replaces the
+        map directory, so a saved map is never left partially written.
+
+        Args:
+            directory (str): the map directory, created if needed
+        """
+        working = self._working
+        if working is None:
+            working = _temporary_directory(directory)
+            os.makedirs(working)
+        for name in ARRAY_NAMES:
+            array = getattr(self, name)
+            path = os.path.join(working, name + ".npy")
+            # memory mapped arrays of the working copy are already up to date
+            if isinstance(array, np.memmap) and os.path.abspath(array.filename) == os.path.abspath(path):
+                array.flush()
+            else:
+                np.save(path, array)
+        meta = {"lower" : self.lower.tolist(),
+                "voxel_size" : self.voxel_size,
+                "shape" : list(self.shape),
+                "value_shape" : list(self.value_shape),
+                "captures" : self.captures,
+                }
+        # meta.json is written last, it marks the arrays as complete
+        with open(os.path.join(working, META_FILENAME), 'w') as f:
+            json.dump(meta, f, indent=4)
+        _replace_directory(working, directory)
+
+        if self._working is not None:
+            # keep adding to private copies of the saved arrays, the next
+            # save writes them to a new working copy
+            for name in ARRAY_NAMES:
+                setattr(self, name, np.load(os.path.join(directory, name + ".npy"), mmap_mode="c"))
+            self._working = None
+
+    def discard(self):
+        """throws away the samples added since the map was loaded or saved,
+        the saved map is left as it was
+        """
+        if self._working is not None:
+            for name in ARRAY_NAMES:
+                setattr(self, name, None)
+            shutil.rmtree(self._working, ignore_errors=True)
+            self._working = None
+
+    @property
+    def upper(self):
+        """(x, y, z) of the upper corner of the grid"""
+        return self.lower + self.voxel_size * np.array(self.shape)
+
+    @property
+    def variance(self):
+        """sample variance of every voxel, nan where there are fewer than 2 samples"""
+        count = self.count.reshape(self.shape + (1,) * len(self.value_shape))
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(count > 1, self.m2 / (count - 1), np.nan)
+
+    ############################################################################
+    # ACCUMULATION
+    ############################################################################
+    def voxel_index(self, positions):
+        """finds the voxel containing every position
+
+        Args:
+            positions (np.ndarray): (x, y, z) positions, shape (n, 3)
+
+        Returns:
+            np.ndarray : (i, j, k) voxel index of every position, shape (n, 3)
+            np.ndarray : True where the position is inside the grid, shape (n,)
+        """
+        index = np.floor((positions - self.lower) / self.voxel_size)
+        inside = np.all((index >= 0) & (index < self.shape), axis=1)
+        index[~inside] = 0
+        return index.astype(np.intp), inside
+
+    def add(self, positions, values):
+        """adds a run of samples to the map
+
+        Samples outside of the grid and samples with non-finite positions or
+        values are ignored.
+
+        Args:
+            positions (np.ndarray): (x, y, z) position of every sample, shape (n, 3)
+            values (np.ndarray): value at every sample, shape (n,) + value_shape
+
+        Returns:
+            int : the number of samples added
+        """
+        values = np.asarray(values, dtype=np.float64).reshape( (positions.shape[0], -1) )
+        index, inside = self.voxel_index(positions)
+        keep = inside & np.all(np.isfinite(values), axis=1) & np.all(np.isfinite(positions), axis=1)
+        if not np.any(keep):
+            return 0
+
+        flat = np.ravel_multi_index(index[keep].T, self.shape)
+        order = np.argsort(flat, kind="stable")
+        flat = flat[order]
+        values = values[keep][order]
+
+        # per voxel statistics of this run
+        voxels, starts, batch_count = np.unique(flat, return_index=True, return_counts=True)
+        batch_mean = np.add.reduceat(values, starts, axis=0) / batch_count[:,np.newaxis]
+        deviation = values - np.repeat(batch_mean, batch_count, axis=0)
+        batch_m2 = np.add.reduceat(deviation * deviation, starts, axis=0)
+
+        # merge them into the map
+        count = self.count.reshape(-1)
+        mean = self.mean.reshape( (count.size, -1) )
+        m2 = self.m2.reshape( (count.size, -1) )
+        old_count = count[voxels][:,np.newaxis]
+        new_count = old_count + batch_count[:,np.newaxis]
+        delta = batch_mean - mean[voxels]
+        mean[voxels] += delta * (batch_count[:,np.newaxis] / new_count)
+        m2[voxels] += batch_m2 + delta * delta * (old_count * batch_count[:,np.newaxis] / new_count)
+        count[voxels] += batch_count
+        return int(keep.sum())
+
+    def add_capture(self, name, positions, values):
+        """adds every sample of a capture to the map, once
+
+        Args:
+            name (str): unique name of the capture
+            positions (np.ndarray): (x, y, z) position of every sample, shape (n, 3)
+            values (np.ndarray): value at every sample, shape (n,) + value_shape
+
+        Returns:
+            int : the number of samples added
+
+        Raises:
+            ValueError : if the capture is already part of the map
+        """
+        self.check_new(name)
+        added = self.add(positions, values)
+        self.captures.append(name)
+        return added
+
+    def check_new(self, name):
+        """refuses a capture that is already part of the map
+
+        Args:
+            name (str): unique name of the capture
+
+        Raises:
+            ValueError : if the capture is already part of the map
+        """
+        if name in self.captures:
+            raise ValueError("capture '{}' is already part of the field map".format(name))
+
+    ############################################################################
+    # QUERIES
+    ############################################################################
+    def lookup(self, positions):
+        """finds the statistics of the voxel containing every position
+
+        Args:
+            positions (np.ndarray): (x, y, z) positions, shape (n, 3)
+
+        Returns:
+            np.ndarray : voxel mean, shape (n,) + value_shape. nan outside
+                of the grid or in empty voxels
+            np.ndarray : voxel variance, shape (n,) + value_shape
+            np.ndarray : voxel sample count, shape (n,)
+        """
+        index, inside = self.voxel_index(positions)
+        index = tuple(index.T)
+        count = np.where(inside, self.count[index], 0)
+        valid = (count > 0).reshape( (-1,) + (1,) * len(self.value_shape) )
+        mean = np.where(valid, self.mean[index], np.nan)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            variance = np.where(valid & (count.reshape(valid.shape) > 1),
+                                self.m2[index] / (count.reshape(valid.shape) - 1),
+                                np.nan)
+        return mean, variance, count
+
+    def interpolate(self, positions):
+        """trilinearly interpolates the voxel means at every position
+
+        Voxel values sit at the voxel centers. Empty voxels are left out of
+        the interpolation and the weights of the remaining corners are
+        renormalized.
+
+        Args:
+            positions (np.ndarray): (x, y, z) positions, shape (n, 3)
+
+        Returns:
+            np.ndarray : interpolated mean, shape (n,) + value_shape. nan
+                where every surrounding voxel is empty
+        """
+        grid = (positions - self.lower) / self.voxel_size - 0.5
+        base = np.floor(grid).astype(np.intp)
+        fraction = grid - base
+        shape = np.array(self.shape)
+
+        total = np.zeros( (positions.shape[0],) + self.value_shape )
+        weights = np.zeros(positions.shape[0])
+        expand = (slice(None),) + (np.newaxis,) * len(self.value_shape)
+        for corner in _CORNERS:
+            index = base + corner
+            inside = np.all((index >= 0) & (index < shape), axis=1)
+            index = tuple(np.clip(index, 0, shape - 1).T)
+            weight = np.prod(np.where(corner, fraction, 1 - fraction), axis=1)
+            weight *= inside & (self.count[index] > 0)
+            total += weight[expand] * self.mean[index]
+            weights += weight
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(weights[expand] > 0, total / weights[expand], np.nan)
+
+
+def _temporary_directory(directory):
+    """a unique temporary directory next to `directory`"""
+    parent, base = os.path.split(os.path.abspath(directory))
+    return os.path.join(parent, ".{}.{}.tmp".format(base, uuid.uuid4().hex))
+
+
+def _replace_directory(source, destination):
+    """moves a directory into place, replacing any directory already there.
+    The old directory is renamed aside before the new one is moved in and
+    deleted afterwards, so one of them is always on disk
+    """
+    old = None
+    if os.path.isdir(destination):
+        old = _temporary_directory(destination)
+        os.rename(destination, old)
+    os.rename(source, destination)
+    if old is not None:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def open_or_create(directory, lower, upper, voxel_size, value_shape):
+    """opens a saved map, or creates an empty one if it doesn't exist yet
+
+    Returns:
+        FieldMap : the map
+    """
+    if os.path.exists(os.path.join(directory, META_FILENAME)):
+        return FieldMap.load(directory)
+    if lower is None or upper is None:
+        raise ValueError("'{}' is not a field map, --lower and --upper are needed to create one".format(directory))
+    return FieldMap.from_bounds(lower, upper, voxel_size, value_shape)
+
+
+def read_runs(filenames, field):
+    """reads the positions and values of every capture in result npz files
+    and results stores
+
+    Args:
+        filenames (list): result .npz files and results store directories
+        field (str): the CoilResult field to read
+
+    Yields:
+        str : the name of the capture
+        iterator : (positions, values) runs of the capture, read lazily
+    """
+    for filename in filenames:
+        if os.path.isdir(filename) and resultstore.is_store(filename):
+            store = resultstore.ResultStore(filename)
+            for name in store.captures:
+                chunks = store.open(name).iter_chunks(fields=("pose", field))
+                yield name, ((chunk.pose[:,align.POSITION_COLUMNS], getattr(chunk, field)) for chunk in chunks)
+        else:
+            with np.load(filename) as result:
+                runs = [(result["pose"][:,align.POSITION_COLUMNS], result[field])]
+            yield os.path.splitext(os.path.basename(filename))[0], iter(runs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="add processed captures (from batch.py) to a field map")
+    parser.add_argument("map", help="field map directory, created if needed")
+    parser.add_argument("results", nargs="+", help="result .npz files or results store directories")
+    parser.add_argument("--field", default="field", help="CoilResult field to map")
+    parser.add_argument("--voxel-size", default=0.01, type=float)
+    parser.add_argument("--lower", default=None, type=float, nargs=3)
+    parser.add_argument("--upper", default=None, type=float, nargs=3)
+    args = parser.parse_args(argv)
+
+    fieldmap = None
+    if os.path.exists(os.path.join(args.map, META_FILENAME)):
+        fieldmap = FieldMap.load(args.map)
+    try:
+        for name, runs in read_runs(args.results, args.field):
+            if fieldmap is not None and name in fieldmap.captures:
+                print("{}: already part of the map, skipped".format(name))
+                continue
+            added = 0
+            for positions, values in runs:
+                if fieldmap is None:
+                    fieldmap = open_or_create(args.map, args.lower, args.upper, args.voxel_size, values.shape[1:])
+                added += fieldmap.add(positions, values)
+            if fieldmap is not None:
+                fieldmap.captures.append(name)
+            print("{}: {} samples added".format(name, added))
+        if fieldmap is not None:
+            fieldmap.save(args.map)
+    except BaseException:
+        if fieldmap is not None:
+            fieldmap.discard()
+        raise
+    return fieldmap
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+"""
+Live mode
+
+Processes coil samples as the DAQ produces them and publishes the amplitude
+and orientation of every frame as soon as it is demodulated, so the field can
+be watched while the coil is swept instead of after the session.
+
+Samples arrive as a headerless stream of interleaved rows in the coil capture
+column order (see `capture.py` and `util.DataGenerator.coil_data`):
+    timestamp, coil1, coil2, ..., coilN, ref_coil1, ref_coil2, ref_coil3
+every value a little endian float64 (or float32 with `--dtype float32`).
+
+The stream is read from stdin ("-"), a file or named pipe (a path), or a socket
+that live mode listens on ("tcp://host:port" or "unix:///path/to/socket").
+It is processed in fixed size blocks of `--block-size` samples, the block size
+bounds how long a sample waits before it's processed.
+
+The 2HZ wide bandpass filters of the offline pipeline have a group delay of
+~0.32s, far too long for live results. Live mode demodulates the raw channels
+with the lock-in instead, whose lowpass (`--cutoff`, frame_rate / 4 by
+default) is what separates the bands. Its frames are not delay compensated,
+they describe the signal a lowpass group delay before their timestamp.
+`--bandpass` adds the causal filter bank back in, at the cost of its delay.
+
+Every frame is published as a json line:
+    {"time": ..., "amplitude": [[...]], "field": [[...]], "orientation": [...]}
+to stdout, a file or named pipe, or a socket that live mode connects to
+(`--out`). Use `replay.py` to stream a recorded capture at its real rate:
+
+    python replay.py capture.cap | python live.py - --coils 3
+    python live.py tcp://127.0.0.1:5555 --coils 3 --out results.jsonl &
+    python replay.py capture.cap --to tcp://127.0.0.1:5555
+"""
+import argparse
+import json
+import os
+import socket
+import sys
+import time
+
+import numpy as np
+
+import capture
+import demod
+import main
+import pipeline
+import rangecheck
+
+STREAM_DTYPES = ("float64", "float32")
+# ~10ms of samples at 100kS/s
+LIVE_BLOCK_SIZE = 1024
+DEFAULT_FRAME_RATE = 120.0
+# seconds to keep retrying to connect to a socket that isn't listening yet
+CONNECT_TIMEOUT = 10.0
+
+
+def parse_address(address):
+    """parses a socket address
+
+    Args:
+        address (str): "tcp://host:port" or "unix:///path/to/socket"
+
+    Returns:
+        tuple : the socket family and address, None if `address` isn't a
+            socket address (ie a path)
+    """
+    if address.startswith("tcp://"):
+        host, port = address[len("tcp://"):].rsplit(":", 1)
+        return socket.AF_INET, (host, int(port))
+    if address.startswith("unix://"):
+        return socket.AF_UNIX, address[len("unix://"):]
+    return None
+
+
+def open_source(source):
+    """opens a stream of samples to read from, listening for a single
+    connection if `source` is a socket address
+
+    Args:
+        source (str): "-" for stdin, a socket address or a path
+
+    Returns:
+        file : a binary file object
+    """
+    if source == "-":
+        return sys.stdin.buffer
+    address = parse_address(source)
+    if address is None:
+        return open(source, 'rb', buffering=0)
+
+    family, address = address
+    server = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        if family == socket.AF_INET:
+            server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        elif os.path.exists(address):
+            os.remove(address)
+        server.bind(address)
+        server.listen(1)
+        connection, _ = server.accept()
+    finally:
+        server.close()
+    return connection.makefile('rb', buffering=0)
+
+
+def open_sink(destination, binary=False):
+    """opens a stream to write to, connecting if `destination` is a socket
+    address
+
+    Args:
+        destination (str): "-" for stdout, a socket address or a path
+        binary (bool): open the stream in binary mode
+
+    Returns:
+        file : a file object
+    """
+    if destination == "-":
+        return sys.stdout.buffer if binary else sys.stdout
+    address = parse_address(destination)
+    if address is None:
+        return open(destination, 'wb' if binary else 'w')
+
+    family, address = address
+    deadline = time.time() + CONNECT_TIMEOUT
+    while True:
+        connection = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            connection.connect(address)
+            break
+        except OSError:
+            connection.close()
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+    return connection.makefile('wb' if binary else 'w')
+
+
+def _read_into(stream, view):
+    """fills a buffer from a stream, returns fewer bytes only at the end of
+    the stream
+    """
+    filled = 0
+    while filled < len(view):
+        count = stream.readinto(view[filled:])
+        if not count:
+            break
+        filled += count
+    return filled
+
+
+def read_blocks(stream, ncoils, block_size=LIVE_BLOCK_SIZE, dtype="float64"):
+    """reads fixed size blocks of interleaved sample rows from a stream
+
+    Every block is read into the same buffer, so the arrays of a block are only
+    valid until the next block is read. A partial row at the end of the stream
+    is dropped.
+
+    Args:
+        stream (file): binary stream of rows
+        ncoils (int): number of measurement coils
+        block_size (int): number of samples per block
+        dtype (str): "float64" or "float32"
+
+    Yields:
+        capture.CoilBlock : every block, the last one may be shorter
+    """
+    if dtype not in STREAM_DTYPES:
+        raise ValueError("unknown stream dtype '{}', must be one of {}".format(dtype, STREAM_DTYPES))
+    buffer = np.empty( (block_size, 1 + ncoils + capture.NUM_REF_COILS), dtype=np.dtype(dtype).newbyteorder("<") )
+    view = memoryview(buffer).cast("B")
+    row_bytes = buffer.strides[0]
+    start = 0
+    while True:
+        nbytes = _read_into(stream, view)
+        nrows = nbytes // row_bytes
+        if nrows:
+            rows = buffer[:nrows]
+            yield capture.CoilBlock(start, rows[:, 0], rows[:, 1:1 + ncoils], rows[:, 1 + ncoils:])
+            start += nrows
+        if nbytes < len(view):
+            return
+
+
+class JsonLinesPublisher(object):
+    """writes one json object per frame to a text stream
+
+    Args:
+        stream (file): the stream to write to, flushed after every block
+    """
+    def __init__(self, stream):
+        self.stream = stream
+
+    def publish(self, result):
+        lines = []
+        for i in range(result.frame_times.shape[0]):
+            lines.append(json.dumps({"time" : float(result.frame_times[i]),
+                                        "amplitude" : result.amplitude[i].tolist(),
+                                        "field" : result.field[i].tolist(),
+                                        "orientation" : result.orientation[i].tolist(),
+                                        }) + "\n")
+        self.stream.write("".join(lines))
+        self.stream.flush()
+
+
+class LiveRunner(object):
+    """Runs the stateful stages of a pipeline on a live stream of blocks
+
+    Args:
+        coil_pipeline (pipeline.CoilPipeline): provides the calibration and the
+            frame stages (normalize, phase_correct, solve)
+        frame_rate (float): output frames per second
+        cutoff (float): lock-in lowpass cutoff (in HZ), defaults to
+            frame_rate / 4
+        bandpass (bool): filter the channels through the causal bandpass
+            filter bank before demodulating them (adds ~0.3s of delay)
+    """
+    def __init__(self, coil_pipeline, frame_rate=DEFAULT_FRAME_RATE, cutoff=None, bandpass=False):
+        if bandpass and coil_pipeline.filter_mode != "causal":
+            raise ValueError("live mode can only use the causal filter mode, not '{}'".format(coil_pipeline.filter_mode))
+        if coil_pipeline.range_policy == "rescale":
+            raise ValueError("the rescale range policy needs the whole capture, live mode can clamp, fail or ignore")
+        self.pipeline = coil_pipeline
+        self.frame_rate = float(frame_rate)
+        self.cutoff = cutoff
+        self.bandpass = bandpass
+        # processing time of every block that produced frames, in seconds
+        self.latencies = []
+        self.frames = 0
+        self.samples = 0
+        self.fs = None
+
+    def run(self, blocks, publish, fs=None):
+        """processes blocks until the stream ends
+
+        Args:
+            blocks (iterable): CoilBlocks from `read_blocks`
+            publish (callable): called with a pipeline.CoilResult for every
+                block that produced frames
+            fs (float): the sampling frequency, estimated from the timestamps
+                of the first block if None
+        """
+        coil_pipeline = self.pipeline
+        calib = coil_pipeline.calibration
+        coil_pipeline.reset()
+        blocks = iter(blocks)
+        first = next(blocks, None)
+        if first is None:
+            return
+        calib.check_coils(first.coils.shape[1])
+        if fs is None:
+            fs = capture.estimate_sample_rate(first.timestamps)
+        self.fs = fs
+        start_time = float(first.timestamps[0])
+
+        demodulator = demod.LockIn(fs, self.frame_rate, calib.bands, self.cutoff, compensate_delay=False,
+                                    workers=coil_pipeline.workers, dtype=coil_pipeline.dtype)
+        bank = coil_pipeline.filter_bank(fs) if self.bandpass else None
+        # the start-up transient of the filters is left out of the range
+        # diagnostics
+        delay = demodulator.group_delay()
+        if bank is not None:
+            delay += bank.group_delay().max()
+        coil_pipeline.settle_time = start_time + pipeline.SETTLE_GROUP_DELAYS * delay / fs
+
+        self.latencies = []
+        self.frames = 0
+        self.samples = 0
+        instrumentation = coil_pipeline.instrumentation
+        if instrumentation is not None:
+            instrumentation.begin(capture="live")
+        try:
+            block = first
+            while block is not None:
+                arrived = time.perf_counter()
+                data = np.hstack( (block.coils, block.refs) ).astype(coil_pipeline.dtype)
+                self.samples += data.shape[0]
+                if bank is not None:
+                    data = bank.filter(data)
+                frame_times, amplitude, phase = demodulator.demodulate(data)
+                if frame_times.size:
+                    result = coil_pipeline.process_frames(frame_times + start_time, amplitude, phase, None)
+                    publish(result)
+                    self.frames += frame_times.shape[0]
+                    self.latencies.append(time.perf_counter() - arrived)
+                block = next(blocks, None)
+        finally:
+            # an interrupted or failed stream still flushes its records
+            if instrumentation is not None:
+                instrumentation.end()
+            demodulator.close()
+
+    def summary(self):
+        """describes the latency of the last run
+
+        Returns:
+            str : the summary
+        """
+        if not self.latencies:
+            return "no frames were produced from {} samples".format(self.samples)
+        latencies = np.array(self.latencies) * 1e3
+        return ("published {} frames from {} samples, processing latency median {:.2f}ms, p99 {:.2f}ms, max {:.2f}ms"
+                " (plus up to {:.1f}ms waiting for a block)".format(
+                    self.frames, self.samples, np.median(latencies), np.percentile(latencies, 99),
+                    latencies.max(), self.pipeline.block_size / self.fs * 1e3))
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="process a live stream of coil samples")
+    parser.add_argument("source", help="'-' for stdin, a file or named pipe, or tcp://host:port or unix:///path to listen on")
+    parser.add_argument("--coils", default=3, type=int, help="number of measurement coils in the stream")
+    parser.add_argument("--dtype", default="float64", choices=STREAM_DTYPES)
+    parser.add_argument("--sample-rate", default=None, type=float, help="estimated from the timestamps if not given")
+    parser.add_argument("--frame-rate", default=DEFAULT_FRAME_RATE, type=float)
+    parser.add_argument("--cutoff", default=None, type=float, help="lock-in lowpass cutoff (HZ), defaults to frame_rate / 4")
+    parser.add_argument("--bandpass", default=False, action="store_true",
+                        help="filter through the causal bandpass filters first (adds ~0.3s of delay)")
+    parser.add_argument("--out", default="-", help="'-' for stdout, a file or named pipe, or a socket address to connect to")
+    main.add_pipeline_arguments(parser)
+    # the group delay can't be removed without waiting for it
+    parser.set_defaults(block_size=LIVE_BLOCK_SIZE, filter_mode="causal")
+    return parser
+
+
+def main_live(argv=None):
+    args = make_parser().parse_args(argv)
+    with main.pipeline_from_args(args) as coil_pipeline:
+        return _run_live(args, coil_pipeline)
+
+
+def _run_live(args, coil_pipeline):
+    """streams the source given on the command line, the pipeline is closed
+    by `main_live`
+    """
+    runner = LiveRunner(coil_pipeline, args.frame_rate, args.cutoff, args.bandpass)
+
+    sink = open_sink(args.out)
+    source = open_source(args.source)
+    blocks = read_blocks(source, args.coils, coil_pipeline.block_size, args.dtype)
+    try:
+        runner.run(blocks, JsonLinesPublisher(sink).publish, args.sample_rate)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        source.close()
+        if sink is not sys.stdout:
+            sink.close()
+
+    # stdout may be carrying the results
+    print(runner.summary(), file=sys.stderr)
+    report = coil_pipeline.range_report()
+    if report is not None:
+        for line in rangecheck.format_report(report):
+            print("WARNING: " + line, file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_live())
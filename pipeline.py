@@ -0,0 +1,737 @@
+"""
+Coil processing pipeline
+
+The steps of the coil calibration process as an importable API. A single
+`CoilPipeline` can process any number of captures back to back, filters and
+demodulators are designed once and reused for every capture with the same
+sampling frequency.
+
+Stages (see the README for the reasoning behind each step):
+    load          : open the coil capture in blocks and read the optitrack data
+    filter        : STEP 1, separate the 12k, 16k and 20k carriers
+    demodulate    : STEP 2, amplitude and uncalibrated phase at every frame
+    normalize     : STEP 3, normalized amplitude
+    phase_correct : STEP 4, remove the system phase offset and reference phase
+    solve         : STEPS 5 and 6, flux direction, angle to every field axis,
+                    field vectors and coil orientation (see `solver.py`)
+    align         : optitrack pose at every frame, or coil frames resampled
+                    at every optitrack row (see `align.py`)
+
+Array layout used by every stage:
+    SAMPLES (or FRAMES) IS AXIS 0
+    CHANNEL (or COIL) INDEX IS AXIS 1
+    BANDS IS AXIS 2
+"""
+import collections
+import itertools
+
+import numpy as np
+
+import align
+import calibration
+import capture
+import demod
+import filters
+import instrument
+import rangecheck
+import solver
+
+FILTER_MODES = filters.FILTER_MODES
+DEMODULATORS = ("lock-in", "hilbert")
+ALIGN_TARGETS = align.ALIGN_TARGETS
+ALIGN_METHODS = align.ALIGN_METHODS
+RANGE_POLICIES = rangecheck.RANGE_POLICIES
+# the filters ring for this many group delays at the start (and end) of a
+# capture, overshooting the calibration range. Those frames are left out of
+# the range diagnostics
+SETTLE_GROUP_DELAYS = 5
+PRECISIONS = ("float64", "float32")
+
+
+# The products of the pipeline for a run of frames
+#   frame_times (np.ndarray): time of each frame in seconds, shape (frames,)
+#   amplitude (np.ndarray): normalized coil amplitude, shape (frames, coils, bands)
+#   relative_phase (np.ndarray): coil phase relative to the reference coil,
+#       shape (frames, coils, bands)
+#   theta (np.ndarray): angle between every coil axis and every field axis
+#       in radians, between 0 and pi, shape (frames, coils, bands)
+#   direction (np.ndarray): flux direction, 0 for back->front and 1 for
+#       front->back, shape (frames, coils, bands)
+#   field (np.ndarray): unit field vector of every band in coil coordinates,
+#       shape (frames, bands, 3)
+#   orientation (np.ndarray): coil to field rotation as a quaternion (qx, qy,
+#       qz, qw), shape (frames, 4)
+#   pose (np.ndarray): optitrack row (frame_index, timestamp, x, y, z, qx, qy,
+#       qz, qw) at every frame, shape (frames, 9)
+CoilResult = collections.namedtuple("CoilResult",
+                                    ["frame_times", "amplitude", "relative_phase", "theta", "direction",
+                                        "field", "orientation", "pose"])
+
+
+def concatenate_results(results):
+    """joins the results of consecutive runs of frames
+
+    Args:
+        results (list): CoilResults in time order
+
+    Returns:
+        CoilResult : a single result covering every frame
+    """
+    if not results:
+        raise ValueError("no frames were produced, is the capture shorter than one optitrack frame?")
+    return CoilResult(*(np.concatenate(arrays, axis=0) for arrays in zip(*results)))
+
+
+def _runs(array, lengths, copy=False):
+    """splits an array into consecutive runs of rows
+
+    Args:
+        array (np.ndarray): the array to split along axis 0
+        lengths (list): the number of rows in every run
+        copy (bool): copy every run instead of returning views
+
+    Yields:
+        np.ndarray : every run
+    """
+    start = 0
+    for length in lengths:
+        run = array[start:start + length]
+        yield np.array(run) if copy else run
+        start += length
+
+
+class CoilPipeline(object):
+    """Processes coil and optitrack captures into coil orientations
+
+    Args:
+        calib (calibration.Calibration): rig calibration, defaults to an
+            identity calibration
+        filter_mode (str): one of "causal", "compensated", "zero-phase", see
+            `filters.FilterBank`
+        demodulator (str): "lock-in" or "hilbert", see `demod.py`
+        block_size (int): number of samples read and processed at a time
+        align_to (str): "coil" to find the pose at every coil frame, or
+            "optitrack" to resample the coil frames at every optitrack row
+        align_method (str): "nearest" or "linear" pose interpolation, used
+            when aligning to the coil frames
+        range_policy (str): what to do with amplitudes outside of the
+            calibration range, one of "rescale", "clamp", "fail", "ignore".
+            See `rangecheck.py`
+        workers (int): number of threads the filter bank and demodulator
+            split their (band, channel) work over. Results are identical for
+            any number of workers. `close` the pipeline (or use it in a with
+            statement) to shut the threads down
+        precision (str): "float64", or "float32" to keep the samples, filter
+            state and every product in float32/complex64 from ingest through
+            the solver. Halves the memory and bandwidth of every stage, see
+            `bench.py --precision` for the error it costs
+        instrumentation (instrument.Instrumentation): records the time and
+            memory used by every stage of every run, off when None
+        noise_model (daq_noise_analysis.NoiseModel): the DAQ read noise of
+            every channel, see `amplitude_noise`
+        cache (stagecache.StageCache): keeps the parsed samples and the output
+            of every stage on disk, so `run` only recomputes the stages
+            downstream of a changed parameter. Off when None
+    """
+    def __init__(self, calib=None, filter_mode="compensated", demodulator="lock-in", block_size=capture.DEFAULT_BLOCK_SIZE,
+                    align_to="coil", align_method="nearest", range_policy="clamp", workers=1,
+                    precision="float64", instrumentation=None, noise_model=None,
+                    cache=None):
+        if filter_mode not in FILTER_MODES:
+            raise ValueError("unknown filter mode '{}', must be one of {}".format(filter_mode, FILTER_MODES))
+        if demodulator not in DEMODULATORS:
+            raise ValueError("unknown demodulator '{}', must be one of {}".format(demodulator, DEMODULATORS))
+        if align_to not in ALIGN_TARGETS:
+            raise ValueError("unknown alignment target '{}', must be one of {}".format(align_to, ALIGN_TARGETS))
+        if align_method not in ALIGN_METHODS:
+            raise ValueError("unknown alignment method '{}', must be one of {}".format(align_method, ALIGN_METHODS))
+        if precision not in PRECISIONS:
+            raise ValueError("unknown precision '{}', must be one of {}".format(precision, PRECISIONS))
+        if range_policy not in RANGE_POLICIES:
+            raise ValueError("unknown range policy '{}', must be one of {}".format(range_policy, RANGE_POLICIES))
+        self.calibration = calibration.Calibration() if calib is None else calib
+        self.filter_mode = filter_mode
+        self.demodulator = demodulator
+        self.block_size = int(block_size)
+        self.align_to = align_to
+        self.align_method = align_method
+        self.range_policy = range_policy
+        self.workers = int(workers)
+        self.precision = precision
+        self.dtype = np.dtype(precision)
+        self.instrumentation = instrumentation
+        self.noise_model = noise_model
+        self.cache = cache
+
+        # reused between captures, keyed by sampling frequency (and frame rate)
+        self._filter_banks = {}
+        self._demodulators = {}
+        self._solvers = {}
+        # the calibration in use for the current capture, it is widened to the
+        # observed amplitudes (with the "rescale" range policy)
+        self._active_calibration = self.calibration
+        # range diagnostics of the current (or last) capture, see `range_report`
+        self.range_check = None
+        # number of coil samples read from the current (or last) capture
+        self.samples_read = 0
+        # coil sampling frequency of the current (or last) capture
+        self.sample_rate = None
+        # frames before this frame time (in seconds) are left out of the range
+        # diagnostics, see `filter_settle_time`
+        self.settle_time = 0.
+
+    ############################################################################
+    # STAGES
+    ############################################################################
+    @instrument.stage("load")
+    def load(self, coil_filename, optitrack_filename):
+        """opens a coil capture and reads its optitrack capture
+
+        Args:
+            coil_filename (str): path to the coil csv or binary capture
+            optitrack_filename (str): path to the optitrack csv or binary capture
+
+        Returns:
+            float : the coil sampling frequency (in HZ)
+            iterator : CoilBlocks covering the whole coil capture
+            np.ndarray : optitrack data, shape (nframes, 9)
+        """
+        optitrack = self._read_optitrack(optitrack_filename)
+        coil_blocks = self._read_coil_blocks(coil_filename)
+
+        # peek at the first block to determine our sampling frequency
+        first_block = next(coil_blocks, None)
+        if first_block is None:
+            raise ValueError("coil capture '{}' is empty".format(coil_filename))
+        fs = capture.estimate_sample_rate(first_block.timestamps)
+        self.calibration.check_coils(first_block.coils.shape[1])
+        self.sample_rate = fs
+        self.settle_time = self.filter_settle_time(fs)
+        return fs, itertools.chain([first_block], coil_blocks), optitrack
+
+    @instrument.stage("filter", streaming=True)
+    def filter(self, blocks, fs):
+        """STEP 1, filters the coil and reference channels through every band
+
+        Args:
+            blocks (iterable): CoilBlocks
+            fs (float): the sampling frequency
+
+        Yields:
+            np.ndarray : filtered blocks in the pipeline precision, shape
+                (samples, channels, bands).
+                The measurement coils come first, then the three reference coils
+        """
+        bank = self.filter_bank(fs)
+        channel_blocks = (np.hstack( (block.coils, block.refs) ) for block in blocks)
+        return bank.filter_blocks(channel_blocks)
+
+    @instrument.stage("demodulate", streaming=True)
+    def demodulate(self, filtered_blocks, fs, frame_rate):
+        """STEP 2, extracts amplitude and uncalibrated phase at every frame
+
+        Args:
+            filtered_blocks (iterable): output of `filter`
+            fs (float): the sampling frequency
+            frame_rate (float): the optitrack frame rate
+
+        Yields:
+            np.ndarray : frame times in seconds, shape (frames,)
+            np.ndarray : amplitude, shape (frames, channels, bands)
+            np.ndarray : phase in radians, shape (frames, channels, bands)
+        """
+        return demod.demodulate_blocks(self.demodulator_for(fs, frame_rate), filtered_blocks)
+
+    @instrument.stage("normalize")
+    def normalize(self, amplitude, out=None, frame_times=None):
+        """STEP 3, normalizes the coil amplitude so that 1 is perpendicular
+        and 0 is parallel to the field lines
+
+        The angle to the field follows from
+            coil_voltage = cos(theta) * maximum_voltage
+        which gives us one of four possible angles, see `solve`
+
+        Every call adds the frames from after `settle_time` to the range
+        diagnostics of the capture (see `range_report`). Amplitudes outside of
+        the calibration range are handled according to `range_policy`, the
+        "rescale" policy is applied to a whole capture by `rescale` before
+        its first frame is normalized.
+
+        Args:
+            amplitude (np.ndarray): coil amplitude, shape (frames, coils, bands)
+            out (np.ndarray): array to write the normalized amplitude to, may
+                be `amplitude`
+            frame_times (np.ndarray): frame times in seconds, shape (frames,).
+                Every frame is range checked when None
+
+        Returns:
+            np.ndarray : the normalized amplitude, shape (frames, coils, bands)
+        """
+        check = self._range_check(amplitude.shape[1])
+        if self.range_policy != "rescale":
+            settled = 0 if frame_times is None else np.searchsorted(frame_times, self.settle_time)
+            check.update(amplitude[settled:])
+        if self.range_policy == "fail" and check.out_of_range():
+            raise ValueError("coil amplitude is outside of the calibration range\n"
+                                + "\n".join(rangecheck.format_report(check.report())))
+
+        out = self._active_calibration.normalize(amplitude, out=out)
+        if self.range_policy == "clamp":
+            np.clip(out, 0, 1, out=out)
+        return out
+
+    def rescale(self, runs):
+        """STEP 3 of the "rescale" range policy, range checks every frame of a
+        capture and widens the calibration to the observed range before any
+        frame is normalized
+
+        Every frame is then normalized with the same calibration whatever the
+        block size. The filters ring at both ends of a capture, frames within
+        `filter_settle_time` of either end aren't checked.
+
+        Args:
+            runs (list): (frame_times, amplitude, phase, pose) of every run of
+                frames of the capture
+
+        Returns:
+            list : the runs
+        """
+        runs = [run for run in runs if run[0].shape[0]]
+        if not runs:
+            return runs
+        last = runs[-1][0][-1] - self.filter_settle_time(self.sample_rate)
+        for frame_times, amplitude, _, _ in runs:
+            ncoils = amplitude.shape[1] - capture.NUM_REF_COILS
+            settled = slice(np.searchsorted(frame_times, self.settle_time), np.searchsorted(frame_times, last, side="right"))
+            self._range_check(ncoils).update(amplitude[settled, :ncoils])
+
+        check = self.range_check
+        calib = self.calibration
+        if check.frames and (np.any(check.minimum < calib.min) or np.any(check.maximum > calib.max)):
+            # calibrations are shared, so we make a new one with the observed range
+            self._active_calibration = calib.with_range(np.minimum(calib.min, check.minimum),
+                                                        np.maximum(calib.max, check.maximum))
+        return runs
+
+    def _range_check(self, ncoils):
+        """the range diagnostics of the current capture, created by its first
+        frames"""
+        if self.range_check is None:
+            self.range_check = rangecheck.RangeCheck(self.calibration, ncoils)
+        return self.range_check
+
+    @instrument.stage("phase_correct")
+    def phase_correct(self, phase, ref_phase, out=None):
+        """STEP 4, removes the system phase offset (caused by our amplifiers)
+        and the reference coil phase from the coil phase
+
+        Args:
+            phase (np.ndarray): uncalibrated coil phase, shape (frames, coils, bands)
+            ref_phase (np.ndarray): phase of each band's reference coil,
+                shape (frames, bands)
+            out (np.ndarray): array to write the result to, may be `phase`
+
+        Returns:
+            np.ndarray : relative phase in radians, shape (frames, coils, bands)
+        """
+        return self._active_calibration.relative_phase(phase, ref_phase, out=out)
+
+    @instrument.stage("solve")
+    def solve(self, amplitude, relative_phase):
+        """STEPS 5 and 6, solves the coil rotation for every frame
+
+        The coil and reference phase should be separated by 0 or pi. 0
+        indicates the flux is going through the coil back to front and pi
+        front to back (a rotation of 180 degrees), which signs the normalized
+        amplitude. The signed amplitudes of the orthogonal coils in the
+        orthogonal fields make up the rotation between the coil and the field,
+        which resolves the remaining ambiguity.
+
+        Args:
+            amplitude (np.ndarray): normalized amplitude from `normalize`,
+                shape (frames, coils, bands)
+            relative_phase (np.ndarray): relative phase from `phase_correct`,
+                shape (frames, coils, bands)
+
+        Returns:
+            solver.Solution : theta, direction, field vectors and orientation
+        """
+        key = amplitude.shape[1:]
+        if key not in self._solvers:
+            self._solvers[key] = solver.OrientationSolver(*key, dtype=self.dtype)
+        return self._solvers[key].solve(amplitude, relative_phase)
+
+    @instrument.stage("align")
+    def align(self, frame_times, optitrack):
+        """finds the optitrack pose at every frame, interpolated with
+        `align_method`
+
+        Args:
+            frame_times (np.ndarray): frame times in seconds, shape (frames,)
+            optitrack (np.ndarray): optitrack data, shape (nframes, 9)
+
+        Returns:
+            np.ndarray : the optitrack pose at every frame, shape (frames, 9)
+        """
+        return align.interpolate_poses(optitrack, frame_times, self.align_method)
+
+    @instrument.stage("resample", streaming=True)
+    def resample(self, frames, resampler):
+        """decimates demodulated coil frames to the optitrack timestamps
+
+        Args:
+            frames (iterable): (frame_times, amplitude, phase) from `demodulate`
+            resampler (align.FrameResampler): the resampler for this capture
+
+        Yields:
+            np.ndarray : optitrack times in seconds, shape (rows,)
+            np.ndarray : amplitude, shape (rows, channels, bands)
+            np.ndarray : phase in radians, shape (rows, channels, bands)
+            np.ndarray : the optitrack row of every frame, shape (rows, 9)
+        """
+        for frame_times, amplitude, phase in frames:
+            resampled = resampler.resample(frame_times, amplitude, phase)
+            if resampled[0].shape[0]:
+                yield resampled
+
+    ############################################################################
+    # RUNNING
+    ############################################################################
+    def filter_bank(self, fs):
+        """the filter bank for a sampling frequency, designed once per pipeline
+
+        Args:
+            fs (float): the sampling frequency
+
+        Returns:
+            filters.FilterBank : the filter bank, reset for a new capture
+        """
+        bank = self._filter_bank(fs)
+        bank.reset()
+        return bank
+
+    def _filter_bank(self, fs):
+        """the filter bank for a sampling frequency, as it is"""
+        calib = self.calibration
+        key = (fs, calib.bands, calib.bandwidth, calib.butter_order)
+        if key not in self._filter_banks:
+            self._filter_banks[key] = filters.FilterBank(fs, calib.bands, calib.bandwidth, calib.butter_order,
+                                                                self.filter_mode, self.workers, self.dtype)
+        return self._filter_banks[key]
+
+    def filter_settle_time(self, fs):
+        """how long the start-up transient of the filter bank lasts, frames
+        from before then are left out of the range diagnostics
+
+        Args:
+            fs (float): the sampling frequency
+
+        Returns:
+            float : `SETTLE_GROUP_DELAYS` group delays of the slowest band,
+                in seconds
+        """
+        return SETTLE_GROUP_DELAYS * float(self._filter_bank(fs).group_delay().max()) / fs
+
+    def demodulator_for(self, fs, frame_rate):
+        """the demodulator for a sampling frequency and frame rate, created
+        once per pipeline
+
+        Args:
+            fs (float): the sampling frequency
+            frame_rate (float): the optitrack frame rate
+
+        Returns:
+            demod.LockIn or demod.AnalyticSignal : the demodulator, reset for a
+                new capture
+        """
+        key = (fs, frame_rate, self.calibration.bands)
+        if key not in self._demodulators:
+            if self.demodulator == "hilbert":
+                self._demodulators[key] = demod.AnalyticSignal(fs, self.calibration.bands, frame_rate,
+                                                                workers=self.workers, dtype=self.dtype)
+            else:
+                self._demodulators[key] = demod.LockIn(fs, frame_rate, self.calibration.bands,
+                                                        workers=self.workers, dtype=self.dtype)
+        demodulator = self._demodulators[key]
+        demodulator.reset()
+        return demodulator
+
+    def close(self):
+        """shuts down the worker threads of every filter bank and
+        demodulator, once the pipeline is no longer needed
+        """
+        for stage in list(self._filter_banks.values()) + list(self._demodulators.values()):
+            stage.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def reset(self):
+        """clears the state of the last capture, before a new one starts"""
+        self._active_calibration = self.calibration
+        self.range_check = None
+        self.samples_read = 0
+
+    def range_report(self):
+        """the calibration range diagnostics of the current (or last) capture
+
+        Returns:
+            rangecheck.RangeReport : the report, None if no frames were normalized
+        """
+        return None if self.range_check is None else self.range_check.report()
+
+    def amplitude_noise(self, nchannels, fs=None):
+        """the standard deviation the DAQ read noise adds to the demodulated
+        amplitude of every channel and band
+
+        Only the read noise inside a band's filter makes it through, so this is
+            sqrt(read noise density at the band center * noise bandwidth of the band)
+        with the density from `noise_model` and the noise bandwidth from the
+        filter bank. The demodulator lowpass is much wider than the bands and
+        is ignored.
+
+        Args:
+            nchannels (int): number of channels, the measurement coils then
+                the reference coils
+            fs (float): the sampling frequency, defaults to the one of the
+                current (or last) capture
+
+        Returns:
+            np.ndarray : the amplitude noise (in volts), shape (nchannels, bands),
+                None without a noise model
+        """
+        if self.noise_model is None:
+            return None
+        fs = self.sample_rate if fs is None else fs
+        if fs is None:
+            raise ValueError("the sampling frequency is unknown until a capture is loaded")
+        calib = self.calibration
+        # a new bank, the one in use keeps its filter state
+        bank = filters.FilterBank(fs, calib.bands, calib.bandwidth, calib.butter_order, self.filter_mode)
+        density = self.noise_model.noise_density(calib.bands, nchannels)
+        return np.sqrt(density * bank.noise_bandwidth()[:,np.newaxis]).T
+
+    def process_frames(self, frame_times, amplitude, phase, optitrack, pose=None):
+        """runs STEP 3 to the final alignment on a run of demodulated frames
+
+        Args:
+            frame_times (np.ndarray): frame times in seconds, shape (frames,)
+            amplitude (np.ndarray): amplitude from `demodulate`, shape
+                (frames, channels, bands). Modified in place
+            phase (np.ndarray): phase from `demodulate`, shape
+                (frames, channels, bands). Modified in place
+            optitrack (np.ndarray): optitrack data, shape (nframes, 9). None
+                when there is no optitrack data (live mode), the pose is NaN
+            pose (np.ndarray): the optitrack pose of every frame if it is
+                already known, otherwise it is found with `align`
+
+        Returns:
+            CoilResult : the products for these frames
+        """
+        ncoils = amplitude.shape[1] - capture.NUM_REF_COILS
+        # reference coil 1 carries the 12k field, 2 the 16k field and 3 the 20k field
+        ref_phase = np.diagonal(phase[:,ncoils:], axis1=1, axis2=2)
+
+        coil_amp = self.normalize(amplitude[:,:ncoils], out=amplitude[:,:ncoils], frame_times=frame_times)
+        relative_phase = self.phase_correct(phase[:,:ncoils], ref_phase, out=phase[:,:ncoils])
+        solution = self.solve(coil_amp, relative_phase)
+        if pose is None and optitrack is None:
+            pose = np.full( (frame_times.shape[0], 9), np.nan )
+        elif pose is None:
+            pose = self.align(frame_times, optitrack)
+        return CoilResult(frame_times, coil_amp, relative_phase, *solution, pose=pose)
+
+    def iter_run(self, coil_filename, optitrack_filename):
+        """processes a capture one block at a time
+
+        With the "rescale" range policy nothing is yielded until the whole
+        capture has been demodulated, see `process_runs`.
+
+        Args:
+            coil_filename (str): path to the coil csv or binary capture
+            optitrack_filename (str): path to the optitrack csv or binary capture
+
+        Yields:
+            CoilResult : the products of every block that produced frames
+        """
+        self.reset()
+        if self.instrumentation is not None:
+            self.instrumentation.begin(capture=coil_filename)
+        try:
+            fs, blocks, optitrack = self.load(coil_filename, optitrack_filename)
+            frame_rate = capture.estimate_sample_rate(optitrack[:,1])
+
+            filtered = self.filter(self._count_samples(blocks), fs)
+            frames = self.demodulate(filtered, fs, frame_rate)
+            for result in self._process_all(frames, optitrack):
+                yield result
+        finally:
+            # a failed run still flushes its records and stops tracing memory
+            if self.instrumentation is not None:
+                self.instrumentation.end()
+
+    def _process_all(self, frames, optitrack):
+        """runs STEP 3 to the final alignment on every run of demodulated frames"""
+        if self.align_to == "optitrack":
+            runs = self.resample(frames, align.FrameResampler(optitrack))
+        else:
+            runs = ((frame_times, amplitude, phase, None) for frame_times, amplitude, phase in frames)
+        return self.process_runs(runs, optitrack)
+
+    def process_runs(self, runs, optitrack):
+        """runs STEP 3 to the final alignment on every run of frames of a
+        capture
+
+        With the "rescale" range policy the runs are held back until the last
+        one has been range checked (see `rescale`), the demodulated frames are
+        small next to the samples they came from.
+
+        Args:
+            runs (iterable): (frame_times, amplitude, phase, pose) of every run
+                of frames, pose is None when it should be found with `align`
+            optitrack (np.ndarray): optitrack data, shape (nframes, 9)
+
+        Yields:
+            CoilResult : the products of every run
+        """
+        if self.range_policy == "rescale":
+            runs = self.rescale(runs)
+        for frame_times, amplitude, phase, pose in runs:
+            yield self.process_frames(frame_times, amplitude, phase, optitrack, pose)
+
+    @instrument.stage("ingest", streaming=True)
+    def _count_samples(self, blocks):
+        """passes blocks through, counting their samples in `samples_read`"""
+        for block in blocks:
+            self.samples_read += block.timestamps.shape[0]
+            yield block
+
+    def run(self, coil_filename, optitrack_filename):
+        """processes an entire capture
+
+        Args:
+            coil_filename (str): path to the coil csv or binary capture
+            optitrack_filename (str): path to the optitrack csv or binary capture
+
+        Returns:
+            CoilResult : the products for every frame of the capture
+        """
+        if self.cache is not None:
+            return self._run_cached(coil_filename, optitrack_filename)
+        return concatenate_results(list(self.iter_run(coil_filename, optitrack_filename)))
+
+    ############################################################################
+    # CACHED RUNS
+    ############################################################################
+    def _read_optitrack(self, filename):
+        """reads an optitrack capture, parsed csv captures come from the cache"""
+        if self.cache is None or capture.is_binary_capture(filename):
+            return capture.read_optitrack(filename)
+        key = self.cache.key("parse optitrack", self.cache.file_digest(filename))
+        entry = self.cache.get(key)
+        if entry is None:
+            entry = self.cache.put(key, {"rows" : capture.read_optitrack(filename)})
+        return entry["rows"]
+
+    def _read_coil_blocks(self, filename):
+        """reads a coil capture in blocks, parsed csv captures come from the
+        cache (binary captures are memory mapped already)
+        """
+        if self.cache is None or capture.is_binary_capture(filename):
+            return capture.read_coil_blocks(filename, self.block_size)
+        key = self.cache.key("parse coil", self.cache.file_digest(filename))
+        entry = self.cache.get(key)
+        if entry is None:
+            nsamples = capture.count_rows(filename)
+            writer = self.cache.create(key, {"timestamps" : ((nsamples,), np.float64),
+                                                "channels" : ((nsamples, capture.count_columns(filename) - 1), np.float64)})
+            try:
+                ncoils = 0
+                stop = 0
+                for block in capture.read_coil_blocks(filename, self.block_size):
+                    stop = block.start + block.timestamps.shape[0]
+                    ncoils = block.coils.shape[1]
+                    writer.arrays["timestamps"][block.start:stop] = block.timestamps
+                    writer.arrays["channels"][block.start:stop] = np.hstack( (block.coils, block.refs) )
+                if stop != nsamples:
+                    raise ValueError("parsed {} of the {} rows of '{}'".format(stop, nsamples, filename))
+            except BaseException:
+                writer.abort()
+                raise
+            entry = writer.commit({"ncoils" : ncoils})
+        return self._entry_blocks(entry)
+
+    def _entry_blocks(self, entry):
+        """CoilBlocks of a cached coil capture"""
+        timestamps = entry["timestamps"]
+        channels = entry["channels"]
+        ncoils = entry["meta"]["ncoils"]
+        for start in range(0, timestamps.shape[0], self.block_size):
+            stop = start + self.block_size
+            yield capture.CoilBlock(start, timestamps[start:stop], channels[start:stop, :ncoils], channels[start:stop, ncoils:])
+
+    def _run_cached(self, coil_filename, optitrack_filename):
+        """processes an entire capture, taking the output of every stage whose
+        input and parameters haven't changed from the cache
+
+        The demodulator and the frame stages are fed the same runs of samples
+        and frames as `iter_run` would, so the results are identical.
+        """
+        self.reset()
+        if self.instrumentation is not None:
+            self.instrumentation.begin(capture=coil_filename)
+        try:
+            return self._run_cached_stages(coil_filename, optitrack_filename)
+        finally:
+            # a failed run still flushes its records and stops tracing memory
+            if self.instrumentation is not None:
+                self.instrumentation.end()
+
+    def _run_cached_stages(self, coil_filename, optitrack_filename):
+        """the stages of `_run_cached`"""
+        cache = self.cache
+        calib = self.calibration
+        fs, blocks, optitrack = self.load(coil_filename, optitrack_filename)
+        frame_rate = capture.estimate_sample_rate(optitrack[:,1])
+
+        # STEPS 1 and 2, the filtered samples aren't cached: at the full sample
+        # rate they are far larger than the parsed capture and only the
+        # demodulator reads them
+        demod_key = cache.key("demodulate", cache.file_digest(coil_filename), fs, calib.bands, calib.bandwidth,
+                                calib.butter_order, self.filter_mode, self.precision, self.block_size,
+                                self.demodulator, frame_rate)
+        frames = cache.get(demod_key)
+        if frames is None:
+            products = list(self.demodulate(self.filter(self._count_samples(blocks), fs), fs, frame_rate))
+            frames = cache.put(demod_key, {name : np.concatenate(arrays, axis=0)
+                                            for name, arrays in zip(("frame_times", "amplitude", "phase"), zip(*products))},
+                                {"lengths" : [times.shape[0] for times, _, _ in products],
+                                "samples" : self.samples_read})
+        self.samples_read = frames["meta"]["samples"]
+        lengths = frames["meta"]["lengths"]
+        # the frame stages work in place
+        frame_runs = zip(*(_runs(frames[name], lengths, copy=True) for name in ("frame_times", "amplitude", "phase")))
+
+        # STEPS 3 to 7
+        solve_key = cache.key("solve", demod_key, calib.to_dict(), self.range_policy, self.align_to,
+                                self.align_method, cache.file_digest(optitrack_filename))
+        solved = cache.get(solve_key)
+        if solved is None:
+            result = concatenate_results(list(self._process_all(frame_runs, optitrack)))
+            check = self.range_check
+            cache.put(solve_key, dict(result._asdict(), range_counts=check.counts, range_minimum=check.minimum,
+                                        range_maximum=check.maximum, range_below=check.below, range_above=check.above),
+                        {"range_frames" : check.frames})
+        else:
+            result = CoilResult(*(solved[name] for name in CoilResult._fields))
+            # the range diagnostics of the run that was cached
+            ncoils = result.amplitude.shape[1]
+            check = self.range_check = rangecheck.RangeCheck(calib, ncoils)
+            check.frames = solved["meta"]["range_frames"]
+            for name in ("counts", "minimum", "maximum", "below", "above"):
+                setattr(check, name, np.array(solved["range_" + name]))
+        return result
+
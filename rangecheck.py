@@ -0,0 +1,175 @@
+"""
+Calibration range checking
+
+Compares the demodulated coil amplitudes against the calibration range
+(min, max) of every coil and band while a capture is processed. Every chunk of
+frames updates the running minimum, maximum, out of range counts and a fixed
+bin histogram of every coil and band at once, so a capture of any length is
+checked in one sweep without keeping its amplitudes.
+
+The histogram covers the calibration range plus half of it on either side,
+percentiles are interpolated from it (to within 1/`nbins` of twice the
+calibration range) and clipped to the observed minimum and maximum.
+
+What happens to amplitudes outside of the calibration range is a policy of
+`CoilPipeline`:
+    clamp   : clip the normalized amplitude to [0, 1]
+    rescale : widen the calibration to the range observed over the whole
+              capture, before any frame is normalized (not in live mode)
+    fail    : raise a ValueError
+    ignore  : normalize as is, the normalized amplitude goes past [0, 1]
+"""
+import collections
+
+import numpy as np
+
+RANGE_POLICIES = ("clamp", "rescale", "fail", "ignore")
+DEFAULT_PERCENTILES = (1, 50, 99)
+DEFAULT_BINS = 512
+
+# The range diagnostics of a capture
+#   frames (int): number of frames checked
+#   bands (tuple): carrier frequency of each band (in HZ)
+#   cal_min, cal_max (np.ndarray): calibration range, shape (coils, bands)
+#   minimum, maximum (np.ndarray): observed amplitude range, shape (coils, bands)
+#   percentiles (tuple): the percentile levels, ie (1, 50, 99)
+#   values (np.ndarray): amplitude at every percentile level, shape
+#       (percentiles, coils, bands)
+#   below, above (np.ndarray): number of frames below the calibration minimum
+#       and above the calibration maximum, shape (coils, bands)
+RangeReport = collections.namedtuple("RangeReport",
+                                        ["frames", "bands", "cal_min", "cal_max", "minimum", "maximum",
+                                            "percentiles", "values", "below", "above"])
+
+
+class RangeCheck(object):
+    """Accumulates the range diagnostics of one capture
+
+    Args:
+        calib (calibration.Calibration): the calibration to check against
+        ncoils (int): number of measurement coils
+        nbins (int): number of histogram bins per coil and band
+        percentiles (tuple): the percentile levels to report
+    """
+    def __init__(self, calib, ncoils, nbins=DEFAULT_BINS, percentiles=DEFAULT_PERCENTILES):
+        shape = (ncoils, len(calib.bands))
+        self.bands = calib.bands
+        self.cal_min = np.broadcast_to(calib.min, shape).copy()
+        self.cal_max = np.broadcast_to(calib.max, shape).copy()
+        self.nbins = int(nbins)
+        self.percentiles = tuple(percentiles)
+
+        span = self.cal_max - self.cal_min
+        self._first_edge = self.cal_min - span / 2
+        self._inverse_width = self.nbins / (2 * span)
+        # every coil and band gets its own run of bins in one flat histogram
+        self._bin_offsets = np.arange(self.cal_min.size).reshape(shape) * self.nbins
+        self.reset()
+
+    def reset(self):
+        """clears everything observed so far"""
+        shape = self.cal_min.shape
+        self.frames = 0
+        self.minimum = np.full(shape, np.inf)
+        self.maximum = np.full(shape, -np.inf)
+        self.below = np.zeros(shape, dtype=np.int64)
+        self.above = np.zeros(shape, dtype=np.int64)
+        self.counts = np.zeros(shape + (self.nbins,), dtype=np.int64)
+
+    def update(self, amplitude):
+        """adds a chunk of frames
+
+        Args:
+            amplitude (np.ndarray): coil amplitude before normalization,
+                shape (frames, coils, bands)
+        """
+        if amplitude.shape[0] == 0:
+            return
+        self.frames += amplitude.shape[0]
+        np.minimum(self.minimum, amplitude.min(axis=0), out=self.minimum)
+        np.maximum(self.maximum, amplitude.max(axis=0), out=self.maximum)
+        self.below += np.count_nonzero(amplitude < self.cal_min, axis=0)
+        self.above += np.count_nonzero(amplitude > self.cal_max, axis=0)
+
+        index = (amplitude - self._first_edge) * self._inverse_width
+        # the edge bins collect everything past the histogram
+        np.clip(index, 0, self.nbins - 1, out=index)
+        index = index.astype(np.intp) + self._bin_offsets
+        self.counts += np.bincount(index.ravel(), minlength=self.counts.size).reshape(self.counts.shape)
+
+    def out_of_range(self):
+        """True if any frame so far was outside of the calibration range"""
+        return bool(self.below.any() or self.above.any())
+
+    def quantiles(self, percentiles):
+        """interpolates amplitude percentiles from the histogram
+
+        Args:
+            percentiles (tuple): percentile levels between 0 and 100
+
+        Returns:
+            np.ndarray : shape (percentiles, coils, bands), NaN before any frames
+        """
+        values = np.full( (len(percentiles),) + self.cal_min.shape, np.nan )
+        if self.frames == 0:
+            return values
+        cumulative = np.cumsum(self.counts, axis=-1)
+        for i, percentile in enumerate(percentiles):
+            target = percentile / 100 * self.frames
+            # first bin whose cumulative count reaches the target
+            index = np.minimum(np.count_nonzero(cumulative < target, axis=-1), self.nbins - 1)
+            count = np.take_along_axis(self.counts, index[...,None], axis=-1)[...,0]
+            before = np.take_along_axis(cumulative, index[...,None], axis=-1)[...,0] - count
+            fraction = np.clip((target - before) / np.maximum(count, 1), 0, 1)
+            values[i] = self._first_edge + (index + fraction) / self._inverse_width
+        return np.clip(values, self.minimum, self.maximum)
+
+    def report(self):
+        """the diagnostics of everything observed so far
+
+        Returns:
+            RangeReport : the report
+        """
+        return RangeReport(self.frames, self.bands, self.cal_min.copy(), self.cal_max.copy(),
+                            self.minimum.copy(), self.maximum.copy(), self.percentiles,
+                            self.quantiles(self.percentiles), self.below.copy(), self.above.copy())
+
+
+def format_report(report):
+    """describes every coil and band that went out of the calibration range
+
+    Args:
+        report (RangeReport): the report
+
+    Returns:
+        list : one line per coil and band out of range, empty if none were
+    """
+    lines = []
+    for coil, band in zip(*np.nonzero((report.below > 0) | (report.above > 0))):
+        name = "{}K".format(int(report.bands[band] / 1e3))
+        percentiles = ", ".join("p{:g}={:.4g}".format(level, value)
+                                    for level, value in zip(report.percentiles, report.values[:,coil,band]))
+        lines.append("coil {} {}: observed [{:.4g}, {:.4g}] outside of the calibration [{:.4g}, {:.4g}],"
+                        " {} frames below, {} above of {} ({})".format(
+                            coil, name, report.minimum[coil,band], report.maximum[coil,band],
+                            report.cal_min[coil,band], report.cal_max[coil,band],
+                            report.below[coil,band], report.above[coil,band], report.frames, percentiles))
+    return lines
+
+
+def report_to_dict(report):
+    """converts a report into json serializable lists
+
+    Args:
+        report (RangeReport): the report
+
+    Returns:
+        dict : the fields of the report
+    """
+    fields = report._asdict()
+    for name, value in fields.items():
+        if isinstance(value, np.ndarray):
+            fields[name] = value.tolist()
+    fields["bands"] = list(report.bands)
+    fields["percentiles"] = list(report.percentiles)
+    return dict(fields)
@@ -0,0 +1,87 @@
+"""
+Capture replay
+
+Streams a recorded coil capture (csv or binary) as the live stream of
+interleaved sample rows that `live.py` reads, paced so that every block is
+sent when the DAQ would have finished recording it. Live mode can be tested
+this way without the rig.
+
+    python replay.py capture.cap | python live.py - --coils 3
+    python replay.py capture.cap --to tcp://127.0.0.1:5555 --speed 2
+    python replay.py capture.cap --to /tmp/coil_fifo --speed 0
+"""
+import argparse
+import sys
+import time
+
+import numpy as np
+
+import capture
+import live
+
+
+def replay(filename, stream, block_size=live.LIVE_BLOCK_SIZE, dtype="float64", speed=1.0):
+    """writes a capture to a stream as interleaved sample rows
+
+    Args:
+        filename (str): path to the coil csv or binary capture
+        stream (file): binary stream to write to
+        block_size (int): number of samples written at a time
+        dtype (str): "float64" or "float32"
+        speed (float): how many times faster than real time to send the
+            samples, 0 sends them as fast as possible
+
+    Returns:
+        int : the number of samples sent
+    """
+    if dtype not in live.STREAM_DTYPES:
+        raise ValueError("unknown stream dtype '{}', must be one of {}".format(dtype, live.STREAM_DTYPES))
+    dtype = np.dtype(dtype).newbyteorder("<")
+    rows = None
+    fs = None
+    sent = 0
+    start = time.perf_counter()
+    for block in capture.read_coil_blocks(filename, block_size):
+        nsamples = block.timestamps.shape[0]
+        if rows is None:
+            ncoils = block.coils.shape[1]
+            rows = np.empty( (block_size, 1 + ncoils + capture.NUM_REF_COILS), dtype=dtype )
+            fs = capture.estimate_sample_rate(block.timestamps) if nsamples > 1 else 1.0
+        rows[:nsamples, 0] = block.timestamps
+        rows[:nsamples, 1:1 + ncoils] = block.coils
+        rows[:nsamples, 1 + ncoils:] = block.refs
+
+        sent += nsamples
+        if speed > 0:
+            # the block is complete once its last sample has been recorded
+            delay = start + sent / fs / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        stream.write(rows[:nsamples].tobytes())
+        stream.flush()
+    return sent
+
+
+def main_replay(argv=None):
+    parser = argparse.ArgumentParser(description="stream a recorded coil capture at its real rate")
+    parser.add_argument("capture", help="coil csv or binary capture")
+    parser.add_argument("--to", default="-", help="'-' for stdout, a file or named pipe, or a socket address to connect to")
+    parser.add_argument("--block-size", default=live.LIVE_BLOCK_SIZE, type=int)
+    parser.add_argument("--dtype", default="float64", choices=live.STREAM_DTYPES)
+    parser.add_argument("--speed", default=1.0, type=float, help="multiple of real time, 0 for as fast as possible")
+    args = parser.parse_args(argv)
+
+    stream = live.open_sink(args.to, binary=True)
+    try:
+        sent = replay(args.capture, stream, args.block_size, args.dtype, args.speed)
+    except BrokenPipeError:
+        return 1
+    finally:
+        if stream is not sys.stdout.buffer:
+            stream.close()
+    print("sent {} samples".format(sent), file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_replay())
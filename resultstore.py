@@ -0,0 +1,550 @@
+"""
+Results store
+
+Keeps the products of every capture of a session (see `pipeline.CoilResult`)
+on disk, so they can be analyzed without running the pipeline again. Every
+field of a capture is split into chunks of `chunk_frames` consecutive frames
+that are compressed separately, and a timestamp index records the time span of
+every chunk. Reading a time window only decompresses the chunks that overlap
+it, and only of the fields that are asked for. Coils and bands are selected
+from the decompressed chunks.
+
+Chunks are compressed with zlib after shuffling their bytes (the first byte of
+every value, then the second ...), which groups the slowly changing sign and
+exponent bytes of neighbouring frames together and compresses float data much
+better than the raw values.
+
+A store is a directory:
+    manifest.json       : the captures in the store, with their frame count,
+                          start time, time span and details (coil and
+                          optitrack files ...)
+    <name>/capture.json : start time, shape, dtype and chunking of every field
+    <name>/index.npz    : "times", the first and last frame time of every
+                          chunk, shape (chunks, 2), and the byte offsets of
+                          every chunk of every field, shape (chunks + 1,)
+    <name>/<field>.z    : the compressed chunks of a field, back to back
+A capture is written to a temporary directory and renamed into place when it
+is complete, so a crash never leaves a partial capture in the store.
+
+Frame times start at 0 in every capture, so the windows read from a capture
+are relative to its start. Every capture also records `start_time`, the
+optitrack timestamp of its frame time 0, which places the captures of a
+session on a common clock. `ResultStore.select` finds captures by that
+session time.
+
+    store = resultstore.ResultStore("session_results")
+    store.write("sweep01", coil_pipeline.iter_run("sweep01_coil.cap", "sweep01_opti.cap"))
+    sweep = store.open("sweep01")
+    window = sweep.read(10.0, 20.0, fields=("frame_times", "amplitude"), coils=[0], bands=[1, 2])
+"""
+import json
+import os
+import shutil
+import uuid
+import zlib
+
+import numpy as np
+
+import align
+import pipeline
+
+MANIFEST_FILENAME = "manifest.json"
+CAPTURE_FILENAME = "capture.json"
+INDEX_FILENAME = "index.npz"
+CHUNK_SUFFIX = ".z"
+# 10s of frames at 120 frames per second
+DEFAULT_CHUNK_FRAMES = 1200
+DEFAULT_LEVEL = 6
+
+# the named axes of every field after the frame axis, coil and band
+# selections apply to the "coil" and "band" axes
+FIELD_AXES = {"frame_times" : (),
+                "amplitude" : ("coil", "band"),
+                "relative_phase" : ("coil", "band"),
+                "theta" : ("coil", "band"),
+                "direction" : ("coil", "band"),
+                "field" : ("band", None),
+                "orientation" : (None,),
+                "pose" : (None,),
+                }
+
+
+def compress(array, level=DEFAULT_LEVEL):
+    """byte shuffles and compresses an array
+
+    Args:
+        array (np.ndarray): the array
+        level (int): zlib compression level, 1 (fastest) to 9 (smallest)
+
+    Returns:
+        bytes : the compressed bytes
+    """
+    raw = np.ascontiguousarray(array).view(np.uint8).reshape( (-1, array.dtype.itemsize) )
+    return zlib.compress(np.ascontiguousarray(raw.T).tobytes(), level)
+
+
+def decompress(data, dtype, shape):
+    """reverses `compress`
+
+    Args:
+        data (bytes): the compressed bytes
+        dtype (np.dtype): the dtype of the array
+        shape (tuple): the shape of the array
+
+    Returns:
+        np.ndarray : the array
+    """
+    dtype = np.dtype(dtype)
+    shuffled = np.frombuffer(zlib.decompress(data), dtype=np.uint8).reshape( (dtype.itemsize, -1) )
+    return np.ascontiguousarray(shuffled.T).view(dtype).reshape(shape)
+
+
+def _save_json(filename, fields):
+    """writes a json file atomically"""
+    tmp = "{}.{}.tmp".format(filename, uuid.uuid4().hex)
+    with open(tmp, 'w') as f:
+        json.dump(fields, f, indent=4)
+    os.replace(tmp, filename)
+
+
+def _estimate_start_time(result):
+    """the optitrack timestamp at frame time 0 of a run of frames, from the
+    poses. None if the frames have no pose (ie live captures)
+    """
+    offsets = result.pose[:, align.TIME_COLUMN] - result.frame_times
+    offsets = offsets[np.isfinite(offsets)]
+    # the median ignores frames clamped to the first or last optitrack row
+    return float(np.median(offsets)) if offsets.size else None
+
+
+def _select(name, array, coils, bands):
+    """selects coils and bands from the frames of a field"""
+    selections = {"coil" : coils, "band" : bands}
+    for axis, kind in enumerate(FIELD_AXES.get(name, ()), 1):
+        if selections.get(kind) is not None:
+            array = np.take(array, selections[kind], axis=axis)
+    return array
+
+
+class CaptureWriter(object):
+    """Writes the products of one capture, a run of frames at a time
+
+    Args:
+        directory (str): the store directory
+        name (str): the name of the capture, replaces a capture with the same
+            name when the writer is closed
+        chunk_frames (int): number of frames per chunk
+        level (int): zlib compression level
+        info (dict): json serializable details kept with the capture, ie the
+            coil and optitrack files
+        start_time (float): the session time of frame time 0, in seconds.
+            Estimated from the optitrack timestamps in the poses if None
+            (exact when the poses are interpolated linearly or resampled at
+            the optitrack rows, within half an optitrack frame for "nearest"
+            alignment)
+    """
+    def __init__(self, directory, name, chunk_frames=DEFAULT_CHUNK_FRAMES, level=DEFAULT_LEVEL, info=None,
+                    start_time=None):
+        if chunk_frames < 1:
+            raise ValueError("chunk_frames must be at least 1, got {}".format(chunk_frames))
+        self.directory = directory
+        self.name = name
+        self.chunk_frames = int(chunk_frames)
+        self.level = int(level)
+        self.info = {} if info is None else dict(info)
+        self.start_time = None if start_time is None else float(start_time)
+        self.frames = 0
+        self._tmp = os.path.join(directory, ".{}.{}.tmp".format(name, uuid.uuid4().hex))
+        os.makedirs(self._tmp)
+        self._files = None
+        self._fields = None
+        self._offsets = {}
+        self._times = []
+        self._pending = []
+        self._npending = 0
+
+    def append(self, result):
+        """adds a run of frames, following the frames already written
+
+        Args:
+            result (pipeline.CoilResult): the products of the frames
+        """
+        if self._files is None:
+            self._fields = {name : {"dtype" : array.dtype.str, "shape" : list(array.shape[1:])}
+                                for name, array in zip(result._fields, result)}
+            self._files = {name : open(os.path.join(self._tmp, name + CHUNK_SUFFIX), 'wb') for name in result._fields}
+            self._offsets = {name : [0] for name in result._fields}
+        if result.frame_times.shape[0] == 0:
+            return
+        if self.start_time is None:
+            self.start_time = _estimate_start_time(result)
+        # the result is sliced into the chunks it completes, so no frame is
+        # copied more than once however long the run is
+        while self._npending + result.frame_times.shape[0] >= self.chunk_frames:
+            split = self.chunk_frames - self._npending
+            self._pending.append(pipeline.CoilResult(*(array[:split] for array in result)))
+            result = pipeline.CoilResult(*(array[split:] for array in result))
+            self._write_chunk()
+        if result.frame_times.shape[0]:
+            self._pending.append(result)
+            self._npending += result.frame_times.shape[0]
+
+    def _write_chunk(self):
+        """compresses the pending frames, at most `chunk_frames` of them"""
+        chunk = pipeline.concatenate_results(self._pending)
+        for name, array in zip(chunk._fields, chunk):
+            data = compress(array, self.level)
+            self._files[name].write(data)
+            self._offsets[name].append(self._offsets[name][-1] + len(data))
+        self._times.append( (chunk.frame_times[0], chunk.frame_times[-1]) )
+        self.frames += chunk.frame_times.shape[0]
+        self._pending = []
+        self._npending = 0
+
+    def close(self):
+        """writes the last chunk and the index and moves the capture into the
+        store
+
+        Returns:
+            dict : the capture description (the contents of capture.json)
+        """
+        if self._files is None:
+            self.abort()
+            raise ValueError("capture '{}' has no frames".format(self.name))
+        if self._pending:
+            self._write_chunk()
+        for f in self._files.values():
+            f.close()
+        times = np.array(self._times, dtype=np.float64).reshape( (-1, 2) )
+        np.savez(os.path.join(self._tmp, INDEX_FILENAME), times=times,
+                    **{name : np.array(offsets, dtype=np.int64) for name, offsets in self._offsets.items()})
+        description = {"name" : self.name,
+                        "frames" : self.frames,
+                        "chunk_frames" : self.chunk_frames,
+                        "chunks" : times.shape[0],
+                        "start_time" : self.start_time,
+                        "t_start" : float(times[0, 0]) if times.size else None,
+                        "t_stop" : float(times[-1, 1]) if times.size else None,
+                        "compression" : "zlib-shuffle",
+                        "fields" : self._fields,
+                        "info" : self.info,
+                        }
+        _save_json(os.path.join(self._tmp, CAPTURE_FILENAME), description)
+
+        path = os.path.join(self.directory, self.name)
+        old = None
+        if os.path.isdir(path):
+            # moved aside rather than deleted, so the capture is never missing
+            old = os.path.join(self.directory, ".{}.{}.old".format(self.name, uuid.uuid4().hex))
+            os.rename(path, old)
+        os.rename(self._tmp, path)
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
+        return description
+
+    def abort(self):
+        """discards everything written so far"""
+        if self._files is not None:
+            for f in self._files.values():
+                f.close()
+        shutil.rmtree(self._tmp, ignore_errors=True)
+
+
+class StoredCapture(object):
+    """The products of one capture in a store, read lazily
+
+    Args:
+        directory (str): the capture directory inside the store
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, CAPTURE_FILENAME), 'r') as f:
+            self.description = json.load(f)
+        with np.load(os.path.join(directory, INDEX_FILENAME)) as index:
+            self.times = index["times"]
+            self.offsets = {name : index[name] for name in self.fields}
+
+    @property
+    def name(self):
+        return self.description["name"]
+
+    @property
+    def fields(self):
+        """the names of the stored fields"""
+        return [name for name in pipeline.CoilResult._fields if name in self.description["fields"]]
+
+    @property
+    def frames(self):
+        return self.description["frames"]
+
+    @property
+    def nchunks(self):
+        return self.times.shape[0]
+
+    @property
+    def info(self):
+        return self.description["info"]
+
+    @property
+    def start_time(self):
+        """the session time of frame time 0 in seconds, None if unknown"""
+        return self.description.get("start_time")
+
+    def chunk_range(self, t_start=None, t_stop=None):
+        """finds the chunks that overlap a time window
+
+        Args:
+            t_start (float): start of the window in seconds from the start of
+                the capture (inclusive), None for the start of the capture
+            t_stop (float): end of the window in seconds from the start of
+                the capture (exclusive), None for the end of the capture
+
+        Returns:
+            range : the indices of the chunks
+        """
+        first = 0 if t_start is None else int(np.searchsorted(self.times[:, 1], t_start, side="left"))
+        last = self.nchunks if t_stop is None else int(np.searchsorted(self.times[:, 0], t_stop, side="left"))
+        return range(first, max(first, last))
+
+    def read_chunk(self, index, field):
+        """decompresses one chunk of one field
+
+        Args:
+            index (int): the chunk index
+            field (str): the field name
+
+        Returns:
+            np.ndarray : the frames of the chunk, shape (frames,) + field shape
+        """
+        description = self.description["fields"][field]
+        offsets = self.offsets[field]
+        with open(os.path.join(self.directory, field + CHUNK_SUFFIX), 'rb') as f:
+            f.seek(int(offsets[index]))
+            data = f.read(int(offsets[index + 1] - offsets[index]))
+        chunk_frames = self.description["chunk_frames"]
+        nframes = min(chunk_frames, self.frames - index * chunk_frames)
+        return decompress(data, description["dtype"], (nframes,) + tuple(description["shape"]))
+
+    def iter_chunks(self, t_start=None, t_stop=None, fields=None, coils=None, bands=None):
+        """reads a time window one chunk at a time
+
+        Args:
+            t_start (float): start of the window in seconds from the start of
+                the capture (inclusive)
+            t_stop (float): end of the window in seconds from the start of
+                the capture (exclusive)
+            fields (tuple): the fields to read, defaults to every field
+            coils (list): indices of the coils to select, defaults to all
+            bands (list): indices of the bands to select, defaults to all
+
+        Yields:
+            pipeline.CoilResult : the frames of every chunk inside the
+                window, fields that weren't asked for are None
+        """
+        fields = self.fields if fields is None else list(fields)
+        unknown = set(fields) - set(self.fields)
+        if unknown:
+            raise ValueError("unknown fields {}, the capture has {}".format(sorted(unknown), self.fields))
+
+        for index in self.chunk_range(t_start, t_stop):
+            frame_times = self.read_chunk(index, "frame_times")
+            keep = slice(None)
+            if t_start is not None or t_stop is not None:
+                lower = 0 if t_start is None else np.searchsorted(frame_times, t_start, side="left")
+                upper = frame_times.shape[0] if t_stop is None else np.searchsorted(frame_times, t_stop, side="left")
+                keep = slice(lower, upper)
+            products = dict.fromkeys(pipeline.CoilResult._fields)
+            for name in fields:
+                array = frame_times if name == "frame_times" else self.read_chunk(index, name)
+                products[name] = _select(name, array[keep], coils, bands)
+            yield pipeline.CoilResult(**products)
+
+    def read(self, t_start=None, t_stop=None, fields=None, coils=None, bands=None):
+        """reads a time window, see `iter_chunks`
+
+        Returns:
+            pipeline.CoilResult : every frame inside the window, fields that
+                weren't asked for are None
+        """
+        chunks = list(self.iter_chunks(t_start, t_stop, fields, coils, bands))
+        fields = self.fields if fields is None else list(fields)
+        products = dict.fromkeys(pipeline.CoilResult._fields)
+        for name in fields:
+            if chunks:
+                products[name] = np.concatenate([getattr(chunk, name) for chunk in chunks], axis=0)
+            else:
+                # an empty window still has the shape and dtype of the field
+                field = self.description["fields"][name]
+                products[name] = _select(name, np.empty( [0] + field["shape"], dtype=field["dtype"] ), coils, bands)
+        return pipeline.CoilResult(**products)
+
+
+class ResultStore(object):
+    """A directory of the products of many captures, with a manifest
+
+    Args:
+        directory (str): the store directory, created if needed
+        chunk_frames (int): frames per chunk of the captures written
+        level (int): zlib compression level of the captures written
+    """
+    def __init__(self, directory, chunk_frames=DEFAULT_CHUNK_FRAMES, level=DEFAULT_LEVEL):
+        self.directory = directory
+        self.chunk_frames = int(chunk_frames)
+        self.level = int(level)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.manifest = self._load_manifest()
+
+    def _load_manifest(self):
+        path = os.path.join(self.directory, MANIFEST_FILENAME)
+        if not os.path.exists(path):
+            return {"captures" : {}}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def save_manifest(self):
+        """writes the manifest"""
+        _save_json(os.path.join(self.directory, MANIFEST_FILENAME), self.manifest)
+
+    @property
+    def captures(self):
+        """the names of every capture in the manifest"""
+        return sorted(self.manifest["captures"])
+
+    def __contains__(self, name):
+        return name in self.manifest["captures"]
+
+    def writer(self, name, start_time=None, **info):
+        """starts writing a capture, it's added to the manifest by `register`
+
+        Args:
+            name (str): the name of the capture
+            start_time (float): the session time of frame time 0, see
+                `CaptureWriter`
+            **info: json serializable details kept with the capture
+
+        Returns:
+            CaptureWriter : the writer
+        """
+        return CaptureWriter(self.directory, name, self.chunk_frames, self.level, info, start_time)
+
+    def write(self, name, results, start_time=None, **info):
+        """writes a capture and adds it to the manifest
+
+        Args:
+            name (str): the name of the capture, replaces a capture with the
+                same name
+            results (pipeline.CoilResult or iterable): the products of the
+                capture, or runs of frames in time order (ie from
+                `CoilPipeline.iter_run`)
+            start_time (float): the session time of frame time 0, see
+                `CaptureWriter`
+            **info: json serializable details kept with the capture
+
+        Returns:
+            StoredCapture : the written capture
+        """
+        if isinstance(results, pipeline.CoilResult):
+            results = [results]
+        writer = self.writer(name, start_time, **info)
+        try:
+            for result in results:
+                writer.append(result)
+        except BaseException:
+            writer.abort()
+            raise
+        writer.close()
+        self.register(name)
+        return self.open(name)
+
+    def register(self, name):
+        """adds a written capture to the manifest
+
+        Captures can be written by other processes (see `batch.py`), only one
+        process should update the manifest.
+
+        Args:
+            name (str): the name of the capture
+        """
+        with open(os.path.join(self.directory, name, CAPTURE_FILENAME), 'r') as f:
+            description = json.load(f)
+        self.manifest["captures"][name] = {key : description.get(key) for key in ("frames", "start_time", "t_start", "t_stop", "info")}
+        self.save_manifest()
+
+    def rescan(self):
+        """rebuilds the manifest from the captures in the store directory"""
+        self.manifest = {"captures" : {}}
+        for name in sorted(os.listdir(self.directory)):
+            # hidden directories are unfinished writers or replaced captures
+            if name.startswith("."):
+                continue
+            if os.path.exists(os.path.join(self.directory, name, CAPTURE_FILENAME)):
+                self.register(name)
+        self.save_manifest()
+
+    def remove(self, name):
+        """deletes a capture from the store
+
+        Args:
+            name (str): the name of the capture
+        """
+        self.manifest["captures"].pop(name, None)
+        self.save_manifest()
+        shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+    def open(self, name):
+        """opens a capture for reading, nothing is decompressed until it's read
+
+        Args:
+            name (str): the name of the capture
+
+        Returns:
+            StoredCapture : the capture
+        """
+        if name not in self:
+            raise KeyError("capture '{}' is not in the store '{}'".format(name, self.directory))
+        return StoredCapture(os.path.join(self.directory, name))
+
+    def select(self, t_start=None, t_stop=None):
+        """finds the captures that overlap a window of session time, from the
+        manifest
+
+        Captures without a start time can't be placed in the session, they
+        are only selected when there is no window.
+
+        Args:
+            t_start (float): start of the window in session seconds (the
+                optitrack clock)
+            t_stop (float): end of the window in session seconds
+
+        Returns:
+            list : the names of the captures
+        """
+        names = []
+        for name in self.captures:
+            entry = self.manifest["captures"][name]
+            if entry["t_start"] is None:
+                continue
+            if t_start is None and t_stop is None:
+                names.append(name)
+                continue
+            start_time = entry.get("start_time")
+            if start_time is None:
+                continue
+            first = start_time + entry["t_start"]
+            last = start_time + entry["t_stop"]
+            if (t_stop is None or first < t_stop) and (t_start is None or last >= t_start):
+                names.append(name)
+        return names
+
+
+def is_store(directory):
+    """checks whether a directory is a results store
+
+    Args:
+        directory (str): the directory
+
+    Returns:
+        bool : True if the directory has a store manifest
+    """
+    return os.path.exists(os.path.join(directory, MANIFEST_FILENAME))
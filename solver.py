@@ -0,0 +1,283 @@
+"""
+Coil orientation solver
+
+Solves STEPS 3 to 6 for every frame, band and coil at once. The three
+measurement coils are mounted orthogonally, so the calibrated signal of coil i
+in band b is the projection of that band's field axis onto the coil axis
+    projection[i, b] = sign * normalized_amplitude = cos(theta[i, b])
+where the sign comes from the relative phase (in phase with the reference coil
+is +1, pi out of phase is -1). Laid out as a (bands, coils) matrix the
+projections are the rotation matrix between the field axes and the coil axes:
+    row b    : field axis b in coil coordinates (the field vector of band b)
+    column i : coil axis i in field coordinates
+With only two coils the third column is the cross product of the first two.
+
+The orientation quaternion is found with TRIAD from the first two field axes,
+which always gives a proper rotation even when noise makes the measured matrix
+slightly non-orthogonal.
+
+Normalized amplitudes outside of [0, 1] (noise, or a calibration that is
+slightly off) are clipped before the arccos instead of producing nans. Frames
+where the first two field vectors are parallel (or zero) have no TRIAD
+solution, their orientation is nan.
+
+Array layout:
+    FRAMES IS AXIS 0
+    COIL INDEX IS AXIS 1
+    BANDS IS AXIS 2
+Quaternions are (qx, qy, qz, qw), the same as the optitrack data.
+"""
+import collections
+
+import numpy as np
+
+# The products of the solver for a run of frames
+#   theta (np.ndarray): angle between every coil axis and every field axis in
+#       radians, between 0 and pi, shape (frames, coils, bands)
+#   direction (np.ndarray): flux direction, 0 for back->front and 1 for
+#       front->back, shape (frames, coils, bands)
+#   field (np.ndarray): unit field vector of every band in coil coordinates,
+#       shape (frames, bands, 3)
+#   orientation (np.ndarray): rotation from coil to field coordinates as a
+#       quaternion, shape (frames, 4)
+Solution = collections.namedtuple("Solution", ["theta", "direction", "field", "orientation"])
+
+
+def can_orient(ncoils, nbands):
+    """checks whether a rig can be solved for a full orientation
+
+    Args:
+        ncoils (int): number of orthogonal measurement coils
+        nbands (int): number of field axes
+
+    Returns:
+        bool : True for two or three coils in three orthogonal fields
+    """
+    return ncoils in (2, 3) and nbands == 3
+
+
+def row_norm(vectors, out, square):
+    """euclidean norm of vectors along the last axis, written into `out`
+    (np.linalg.norm has no out argument)
+
+    Args:
+        vectors (np.ndarray): vectors, shape (..., m)
+        out (np.ndarray): array to write the norms into, shape (..., 1)
+        square (np.ndarray): scratch array, the same shape as `vectors`
+
+    Returns:
+        np.ndarray : the norms, shape (..., 1)
+    """
+    np.multiply(vectors, vectors, out=square)
+    np.sum(square, axis=-1, keepdims=True, out=out)
+    return np.sqrt(out, out=out)
+
+
+def cross(a, b, out, scratch=None):
+    """cross product of rows of vectors written into `out` (np.cross has no
+    out argument)
+
+    Args:
+        a (np.ndarray): vectors, shape (n, 3)
+        b (np.ndarray): vectors, shape (n, 3)
+        out (np.ndarray): array to write the result into, shape (n, 3). Must
+            not overlap `a` or `b`
+        scratch (np.ndarray): scratch array, shape (n,). Allocated if None
+
+    Returns:
+        np.ndarray : a x b, shape (n, 3)
+    """
+    if scratch is None:
+        scratch = np.empty(out.shape[0], dtype=out.dtype)
+    for i in range(3):
+        j = (i + 1) % 3
+        k = (j + 1) % 3
+        np.multiply(a[:, j], b[:, k], out=out[:, i])
+        np.multiply(a[:, k], b[:, j], out=scratch)
+        out[:, i] -= scratch
+    return out
+
+
+def quaternion_scratch(nmatrices, dtype=np.float64):
+    """scratch arrays for `quaternion_from_matrix`
+
+    Args:
+        nmatrices (int): number of matrices converted at once
+        dtype (np.dtype): the dtype of the matrices
+
+    Returns:
+        tuple : the scratch arrays
+    """
+    # the diagonal and trace side by side, the squared components and the
+    # norm of the quaternions, the branch of every matrix and a mask
+    return (np.empty( (nmatrices, 4), dtype=dtype ),
+            np.empty( (nmatrices, 4), dtype=dtype ),
+            np.empty( (nmatrices, 1), dtype=dtype ),
+            np.empty(nmatrices, dtype=np.intp),
+            np.empty(nmatrices, dtype=bool))
+
+
+def quaternion_from_matrix(matrix, out=None, scratch=None):
+    """converts rotation matrices into quaternions
+
+    Uses the numerically stable branch (largest of w, x, y, z) for every
+    matrix individually.
+
+    Args:
+        matrix (np.ndarray): rotation matrices, shape (n, 3, 3)
+        out (np.ndarray): array to write the quaternions into, shape (n, 4)
+        scratch (tuple): scratch arrays from `quaternion_scratch`, allocated
+            if None
+
+    Returns:
+        np.ndarray : unit quaternions (qx, qy, qz, qw), shape (n, 4)
+    """
+    n = matrix.shape[0]
+    if out is None:
+        out = np.empty( (n, 4), dtype=matrix.dtype )
+    if scratch is None:
+        scratch = quaternion_scratch(n, matrix.dtype)
+    key, square, norm, branch, mask = (array[:n] for array in scratch)
+    np.copyto(key[:, :3], np.diagonal(matrix, axis1=1, axis2=2))
+    np.sum(key[:, :3], axis=1, out=key[:, 3])
+    trace = key[:, 3]
+    np.argmax(key, axis=1, out=branch)
+
+    m = matrix
+    np.equal(branch, 3, out=mask)
+    np.subtract(m[:, 2, 1], m[:, 1, 2], out=out[:, 0], where=mask)
+    np.subtract(m[:, 0, 2], m[:, 2, 0], out=out[:, 1], where=mask)
+    np.subtract(m[:, 1, 0], m[:, 0, 1], out=out[:, 2], where=mask)
+    np.add(trace, 1, out=out[:, 3], where=mask)
+    for i in range(3):
+        j = (i + 1) % 3
+        k = (j + 1) % 3
+        np.equal(branch, i, out=mask)
+        # 1 - trace + 2 * m[i, i]
+        np.subtract(m[:, i, i], trace, out=out[:, i], where=mask)
+        np.add(out[:, i], m[:, i, i], out=out[:, i], where=mask)
+        np.add(out[:, i], 1, out=out[:, i], where=mask)
+        np.add(m[:, j, i], m[:, i, j], out=out[:, j], where=mask)
+        np.add(m[:, k, i], m[:, i, k], out=out[:, k], where=mask)
+        np.subtract(m[:, k, j], m[:, j, k], out=out[:, 3], where=mask)
+    row_norm(out, norm, square)
+    np.greater(norm[:, 0], 0, out=mask)
+    np.divide(out, norm, out=out, where=mask[:, np.newaxis])
+    return out
+
+
+class OrientationSolver(object):
+    """Solves coil angles, field vectors and orientation for runs of frames
+
+    Intermediate arrays (projections, norms, cross product and quaternion
+    scratch) are kept between calls and only grown when a longer run of
+    frames arrives, so solving a capture block by block allocates nothing
+    but the returned products.
+
+    Args:
+        ncoils (int): number of measurement coils
+        nbands (int): number of bands (field axes)
+        dtype (np.dtype): float64 or float32, the precision of the products
+            and the intermediate arrays
+    """
+    def __init__(self, ncoils, nbands, dtype=np.float64):
+        self.ncoils = int(ncoils)
+        self.nbands = int(nbands)
+        self.dtype = np.dtype(dtype)
+        self.orient = can_orient(self.ncoils, self.nbands)
+        self._projection = np.empty( (0, self.ncoils, self.nbands), dtype=self.dtype )
+        self._rotation = np.empty( (0, 3, 3), dtype=self.dtype )
+        self._triad = np.empty( (0, 3, 3), dtype=self.dtype )
+        self._flip = np.empty( (0, self.ncoils, self.nbands), dtype=bool )
+        self._square = np.empty( (0, self.nbands, 3), dtype=self.dtype )
+        self._norm = np.empty( (0, self.nbands, 1), dtype=self.dtype )
+        self._valid = np.empty( (0, self.nbands, 1), dtype=bool )
+        self._degenerate = np.empty( (0, 1), dtype=bool )
+        self._quaternion = quaternion_scratch(0, self.dtype)
+
+    def _scratch(self, nframes):
+        """scratch arrays for a run of `nframes` frames"""
+        if self._projection.shape[0] < nframes:
+            self._projection = np.empty( (nframes, self.ncoils, self.nbands), dtype=self.dtype )
+            self._rotation = np.empty( (nframes, 3, 3), dtype=self.dtype )
+            self._triad = np.empty( (nframes, 3, 3), dtype=self.dtype )
+            self._flip = np.empty( (nframes, self.ncoils, self.nbands), dtype=bool )
+            self._square = np.empty( (nframes, self.nbands, 3), dtype=self.dtype )
+            self._norm = np.empty( (nframes, self.nbands, 1), dtype=self.dtype )
+            self._valid = np.empty( (nframes, self.nbands, 1), dtype=bool )
+            self._degenerate = np.empty( (nframes, 1), dtype=bool )
+            self._quaternion = quaternion_scratch(nframes, self.dtype)
+        return self._projection[:nframes], self._flip[:nframes], self._rotation[:nframes], self._triad[:nframes]
+
+    def solve(self, amplitude, relative_phase, out=None):
+        """solves a run of frames
+
+        Args:
+            amplitude (np.ndarray): normalized amplitude (1 is perpendicular),
+                shape (frames, coils, bands)
+            relative_phase (np.ndarray): phase relative to the reference coil
+                in radians, shape (frames, coils, bands)
+            out (Solution): arrays to write the products into
+
+        Returns:
+            Solution : the products. field and orientation are nan if the rig
+                can't be solved for an orientation (see `can_orient`)
+        """
+        nframes = amplitude.shape[0]
+        if amplitude.shape[1:] != (self.ncoils, self.nbands):
+            raise ValueError("expected (frames, {}, {}) amplitudes, got {}".format(self.ncoils, self.nbands, amplitude.shape))
+        if out is None:
+            out = Solution(np.empty(amplitude.shape, dtype=self.dtype),
+                            np.empty(amplitude.shape, dtype=np.int8),
+                            np.empty( (nframes, self.nbands, 3), dtype=self.dtype ),
+                            np.empty( (nframes, 4), dtype=self.dtype ))
+        projection, flip, rotation, triad = self._scratch(nframes)
+
+        # STEP 5, the flux direction is the sign of cos(relative phase)
+        np.cos(relative_phase, out=projection)
+        np.less(projection, 0, out=flip)
+        np.copyto(out.direction, flip, casting="unsafe")
+
+        # STEP 3, signed projection of every field axis onto every coil axis
+        np.clip(amplitude, 0, 1, out=projection)
+        np.negative(projection, out=projection, where=flip)
+        np.arccos(projection, out=out.theta)
+
+        if not self.orient:
+            out.field.fill(np.nan)
+            out.orientation.fill(np.nan)
+            return out
+
+        # STEP 6, rotation between field axes (rows) and coil axes (columns)
+        rotation[:, :, :self.ncoils] = projection.transpose(0, 2, 1)
+        if self.ncoils == 2:
+            cross(rotation[:, :, 0], rotation[:, :, 1], out=rotation[:, :, 2])
+
+        square = self._square[:nframes]
+        norm = self._norm[:nframes]
+        valid = self._valid[:nframes]
+        # the quaternion scratch is free until the end
+        column = self._quaternion[1][:nframes, 0]
+        np.copyto(out.field, rotation)
+        row_norm(out.field, norm, square)
+        np.greater(norm, 0, out=valid)
+        np.divide(out.field, norm, out=out.field, where=valid)
+
+        # TRIAD with field axes x and y: t1 along x, t2 normal to x and y
+        t1, t2, t3 = triad[:, 0], triad[:, 1], triad[:, 2]
+        np.copyto(t1, out.field[:, 0])
+        cross(rotation[:, 0], rotation[:, 1], out=t2, scratch=column)
+        # parallel (or zero) field vectors leave no normal, so no orientation
+        t2_norm = row_norm(t2, norm[:, 0], square[:, 0])
+        degenerate = np.less_equal(t2_norm, np.finfo(self.dtype).eps, out=self._degenerate[:nframes])
+        np.logical_not(degenerate, out=valid[:, 0])
+        np.divide(t2, t2_norm, out=t2, where=valid[:, 0])
+        cross(t1, t2, out=t3, scratch=column)
+        # the field triad is (x, z, -y), so the rotation from coil to field
+        # coordinates has the rows (t1, -t3, t2)
+        rotation[:, 0] = t1
+        np.negative(t3, out=rotation[:, 1])
+        rotation[:, 2] = t2
+        quaternion_from_matrix(rotation, out=out.orientation, scratch=self._quaternion)
+        np.copyto(out.orientation, np.nan, where=degenerate)
+        return out
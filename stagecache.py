@@ -0,0 +1,340 @@
+"""
+Stage cache
+
+Keeps the output of the pipeline stages on disk, so re-running a capture only
+recomputes the stages whose inputs or parameters changed. Sweeping
+`BUTTER_ORDER` re-filters but reuses the parsed samples, changing a
+calibration constant only re-solves the frames.
+
+Every entry is content addressed, its key is the sha256 of
+    the stage name + the key of the stage's input + the stage's parameters
+and the first stage is keyed by the sha256 of the capture file itself, so an
+entry can never be stale: edit the capture or any parameter upstream of a
+stage and the stage gets a new key.
+
+    parse      : the samples of a csv capture (binary captures are already
+                 memory mapped and skip this stage)
+    demodulate : frame times, amplitude and phase of every frame, filtered
+                 and demodulated in one go (the filtered samples are as
+                 large as the capture times the number of bands, so they
+                 aren't kept)
+    solve      : the CoilResult of every frame
+
+An entry is a directory holding one .npy file per array, which are opened
+memory mapped, and a meta.json. Entries are written to a temporary directory
+and renamed into place, so a crash never leaves a partial entry and several
+processes can share a cache. When the cache grows past `max_bytes` the least
+recently used entries (by the modification time of their meta.json, which is
+touched on every hit) are evicted. An entry larger than `max_bytes` on its own
+is never cached.
+
+    cache = stagecache.StageCache("~/.coil_cache", max_bytes=20e9)
+    coil_pipeline = pipeline.CoilPipeline(calib, cache=cache)
+"""
+import hashlib
+import json
+import os
+import shutil
+import uuid
+
+import numpy as np
+
+DEFAULT_CACHE_SIZE = 10e9 # bytes
+META_FILENAME = "meta.json"
+# digests of the captures already hashed, keyed by path, size and mtime
+DIGESTS_FILENAME = "digests.json"
+_HASH_CHUNK_SIZE = 2**24
+
+
+def _jsonable(value):
+    """converts the parameters of a stage into something json can hash"""
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (np.generic, np.dtype)):
+        return str(value) if isinstance(value, np.dtype) else value.item()
+    raise TypeError("can't hash a stage parameter of type {}".format(type(value).__name__))
+
+
+class StageCache(object):
+    """An on disk, content addressed cache of stage outputs
+
+    Args:
+        directory (str): where the entries are stored, created if needed
+        max_bytes (float): the most bytes of entries to keep
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_CACHE_SIZE):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = float(max_bytes)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.hits = 0
+        self.misses = 0
+
+    ############################################################################
+    # KEYS
+    ############################################################################
+    def key(self, stage, *parameters):
+        """the key of a stage output
+
+        Args:
+            stage (str): the name of the stage
+            *parameters: the key of the stage's input and every parameter that
+                changes its output, anything json serializable (or numpy)
+
+        Returns:
+            str : the hex sha256 key
+        """
+        text = json.dumps([stage] + list(parameters), sort_keys=True, default=_jsonable)
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def file_digest(self, filename):
+        """the sha256 of a file's contents
+
+        Captures are large, so digests are remembered in the cache directory by
+        path, size and modification time and a file is only hashed again once
+        it changes.
+
+        Args:
+            filename (str): path to the file
+
+        Returns:
+            str : the hex sha256 digest
+        """
+        stat = os.stat(filename)
+        stamp = "{}:{}:{}".format(os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        digests = self._load_digests()
+        if stamp not in digests:
+            sha = hashlib.sha256()
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+                    sha.update(chunk)
+            digests = self._prune_digests(digests)
+            digests[stamp] = sha.hexdigest()
+            self._save_digests(digests)
+        return digests[stamp]
+
+    def _prune_digests(self, digests):
+        """drops the digests of captures that were changed or removed since
+        they were hashed"""
+        pruned = {}
+        for stamp, digest in digests.items():
+            filename, size, mtime = stamp.rsplit(":", 2)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            if (str(stat.st_size), str(stat.st_mtime_ns)) == (size, mtime):
+                pruned[stamp] = digest
+        return pruned
+
+    def _load_digests(self):
+        try:
+            with open(os.path.join(self.directory, DIGESTS_FILENAME), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_digests(self, digests):
+        # another process may be writing them too, the last one wins and at
+        # worst a capture is hashed again
+        tmp = os.path.join(self.directory, "{}.{}.tmp".format(DIGESTS_FILENAME, uuid.uuid4().hex))
+        with open(tmp, 'w') as f:
+            json.dump(digests, f)
+        os.replace(tmp, os.path.join(self.directory, DIGESTS_FILENAME))
+
+    ############################################################################
+    # ENTRIES
+    ############################################################################
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """opens a cached stage output
+
+        Args:
+            key (str): the key from `key`
+
+        Returns:
+            dict : read only memory mapped arrays by name and the "meta" dict,
+                None if the entry isn't cached
+        """
+        entry = self._open(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def _open(self, key):
+        """opens an entry without counting a hit or a miss, see `get`"""
+        path = self._path(key)
+        try:
+            with open(os.path.join(path, META_FILENAME), 'r') as f:
+                meta = json.load(f)
+            entry = {name : np.load(os.path.join(path, name + ".npy"), mmap_mode="r") for name in meta["arrays"]}
+            # marks the entry as recently used
+            os.utime(os.path.join(path, META_FILENAME))
+        except (OSError, ValueError):
+            # missing, or evicted by another process while we opened it
+            return None
+        entry["meta"] = meta["meta"]
+        return entry
+
+    def create(self, key, arrays, meta=None):
+        """starts writing a stage output, for outputs that are written a block
+        at a time
+
+        Args:
+            key (str): the key from `key`
+            arrays (dict): (shape, dtype) of every array by name
+            meta (dict): json serializable details stored with the arrays
+
+        Returns:
+            CacheWriter : the writer, call `commit` once the arrays are filled
+        """
+        return CacheWriter(self, key, arrays, meta)
+
+    def put(self, key, arrays, meta=None):
+        """stores a stage output
+
+        Args:
+            key (str): the key from `key`
+            arrays (dict): the arrays by name
+            meta (dict): json serializable details stored with the arrays
+
+        Returns:
+            dict : the stored arrays, memory mapped, and the "meta" dict
+        """
+        writer = self.create(key, {name : (array.shape, array.dtype) for name, array in arrays.items()}, meta)
+        for name, array in arrays.items():
+            writer.arrays[name][...] = array
+        return writer.commit()
+
+    def entries(self):
+        """every complete entry
+
+        Returns:
+            list : (last used time, size in bytes, key) tuples, least
+                recently used first
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            path = self._path(key)
+            try:
+                used = os.stat(os.path.join(path, META_FILENAME)).st_mtime
+                size = sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+            except OSError:
+                # not an entry, one being written or one being evicted
+                continue
+            entries.append( (used, size, key) )
+        return sorted(entries)
+
+    def size(self):
+        """the total size of every entry in bytes"""
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None):
+        """removes the least recently used entries until the cache fits in
+        `max_bytes`
+
+        Args:
+            keep (str): the key of an entry that must not be evicted
+
+        Returns:
+            int : the number of entries removed
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            # arrays that are still mapped stay readable until they're closed
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= size
+            removed += 1
+        if removed:
+            digests = self._load_digests()
+            pruned = self._prune_digests(digests)
+            if len(pruned) != len(digests):
+                self._save_digests(pruned)
+        return removed
+
+    def clear(self):
+        """removes every entry"""
+        for _, _, key in self.entries():
+            shutil.rmtree(self._path(key), ignore_errors=True)
+
+
+class CacheWriter(object):
+    """Writes one cache entry
+
+    The arrays are memory mapped .npy files in a temporary directory, fill
+    them and call `commit` to move them into the cache.
+
+    Attributes:
+        arrays (dict): the writable arrays by name
+    """
+    def __init__(self, cache, key, arrays, meta=None):
+        self.cache = cache
+        self.key = key
+        self.meta = {} if meta is None else meta
+        self._tmp = os.path.join(cache.directory, ".{}.{}.tmp".format(key, uuid.uuid4().hex))
+        os.makedirs(self._tmp)
+        self.arrays = {name : np.lib.format.open_memmap(os.path.join(self._tmp, name + ".npy"), mode="w+",
+                                                        dtype=dtype, shape=tuple(shape))
+                        for name, (shape, dtype) in arrays.items()}
+
+    def commit(self, meta=None):
+        """moves the entry into the cache and evicts old entries if the cache
+        is too large
+
+        Args:
+            meta (dict): details to add to the meta dict given to `create`
+
+        Returns:
+            dict : the stored arrays, memory mapped read only, and the "meta"
+                dict. If the entry is larger than the whole cache it's
+                discarded rather than evicting every other entry, and if it
+                can't be opened once it's moved into the cache (ie another
+                process evicted it) this counts as a miss. Either way the
+                arrays that were just written are returned instead
+        """
+        if meta:
+            self.meta.update(meta)
+        arrays = self.arrays
+        for array in arrays.values():
+            array.flush()
+        self.arrays = {}
+        if sum(array.nbytes for array in arrays.values()) > self.cache.max_bytes:
+            shutil.rmtree(self._tmp, ignore_errors=True)
+            return self._written(arrays)
+        with open(os.path.join(self._tmp, META_FILENAME), 'w') as f:
+            json.dump({"arrays" : list(arrays), "meta" : self.meta}, f, default=_jsonable)
+
+        path = self.cache._path(self.key)
+        try:
+            os.rename(self._tmp, path)
+        except OSError:
+            # another process cached the same output first, theirs is identical
+            shutil.rmtree(self._tmp, ignore_errors=True)
+        self.cache.evict(keep=self.key)
+        entry = self.cache._open(self.key)
+        if entry is None:
+            self.cache.misses += 1
+            entry = self._written(arrays)
+        return entry
+
+    def _written(self, arrays):
+        """the entry made of the arrays that were written, which stay readable
+        while they're mapped even once their files are removed"""
+        for array in arrays.values():
+            array.setflags(write=False)
+        return dict(arrays, meta=self.meta)
+
+    def abort(self):
+        """discards the entry"""
+        self.arrays = {}
+        shutil.rmtree(self._tmp, ignore_errors=True)
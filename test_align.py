@@ -0,0 +1,95 @@
+"""
+Checks the interpolation behind the optitrack alignment, and that resampling
+coil frames run by run matches resampling them in one piece
+"""
+import numpy as np
+
+import align
+import util
+
+FRAME_RATE = 120.
+
+
+def _optitrack(nframes, start=3.):
+    """optitrack rows of a body moving along x and spinning about z, on a
+    clock that starts at `start`"""
+    frames = np.arange(nframes, dtype=np.float64)
+    timestamps = start + frames / FRAME_RATE
+    positions = np.zeros( (nframes, 3) )
+    positions[:, 0] = frames / FRAME_RATE
+    quaternions = util.axis_angle_quaternions('z', 2 * np.pi * 0.5 * frames / FRAME_RATE)
+    return np.column_stack( (frames, timestamps, positions, quaternions) )
+
+
+def test_bracket():
+    timestamps = np.array([0., 1., 2., 4.])
+    lower, fraction = align.bracket(timestamps, np.array([-1., 0., 0.25, 1., 3., 4., 5.]))
+    np.testing.assert_array_equal(lower, [0, 0, 0, 1, 2, 2, 2])
+    np.testing.assert_allclose(fraction, [0, 0, 0.25, 0, 0.5, 1, 1])
+
+    lower, fraction = align.bracket(np.array([2.]), np.array([1., 3.]))
+    np.testing.assert_array_equal(lower, [0, 0])
+    np.testing.assert_array_equal(fraction, [0, 0])
+
+
+def test_slerp():
+    q0 = util.axis_angle_quaternions('z', np.zeros(3))
+    q1 = util.axis_angle_quaternions('z', np.full(3, np.pi / 2))
+    t = np.array([0., 0.5, 1.])
+    np.testing.assert_allclose(align.slerp(q0, q1, t), util.axis_angle_quaternions('z', t * np.pi / 2), atol=1e-12)
+
+    # -q1 is the same rotation, the short way around is still a quarter turn
+    np.testing.assert_allclose(np.abs(align.slerp(q0, -q1, t)),
+                                np.abs(util.axis_angle_quaternions('z', t * np.pi / 2)), atol=1e-12)
+
+    # nearly identical quaternions fall back to lerp, and stay unit length
+    q2 = util.axis_angle_quaternions('z', np.full(3, 1e-9))
+    out = np.empty( (3, 4) )
+    result = align.slerp(q0, q2, t, out=out)
+    assert result is out
+    np.testing.assert_allclose(np.linalg.norm(result, axis=1), 1)
+    assert np.all(np.isfinite(result))
+
+
+def test_interpolate_poses():
+    optitrack = _optitrack(10)
+    times = np.array([-1., 0., 0.5 / FRAME_RATE, 2.6 / FRAME_RATE, 100.])
+
+    nearest = align.interpolate_poses(optitrack, times, "nearest")
+    np.testing.assert_array_equal(nearest[:, align.FRAME_COLUMN], [0, 0, 1, 3, 9])
+
+    linear = align.interpolate_poses(optitrack, times, "linear")
+    clamped = np.clip(times, 0, 9 / FRAME_RATE)
+    np.testing.assert_allclose(linear[:, align.TIME_COLUMN], times + 3.)
+    np.testing.assert_allclose(linear[:, align.POSITION_COLUMNS][:, 0], clamped)
+    np.testing.assert_allclose(linear[:, align.QUATERNION_COLUMNS],
+                                util.axis_angle_quaternions('z', np.pi * clamped), atol=1e-12)
+
+
+def test_interpolate_phase_wraps():
+    p0 = np.array([3., -3., 0.])
+    p1 = np.array([-3., 3., 1.])
+    phase = align.interpolate_phase(p0, p1, 0.5)
+    # half way between 3 and -3 the short way is pi, not 0
+    np.testing.assert_allclose(np.abs(phase[:2]), np.pi)
+    np.testing.assert_allclose(phase[2], 0.5)
+
+
+def test_resampler_runs_match_one_piece():
+    optitrack = _optitrack(240)
+    frame_times = np.arange(0, 1.9, 1 / 250.)
+    rng = np.random.default_rng(0)
+    amplitude = rng.random( (frame_times.size, 6, 3) ).astype(np.float32)
+    phase = rng.uniform(-np.pi, np.pi, (frame_times.size, 6, 3)).astype(np.float32)
+
+    whole = align.FrameResampler(optitrack).resample(frame_times, amplitude, phase)
+    # no rows past the last coil frame
+    assert whole[0][-1] <= frame_times[-1] < whole[0][-1] + 1 / FRAME_RATE
+    assert whole[1].dtype == np.float32 and whole[2].dtype == np.float32
+    np.testing.assert_array_equal(whole[3], optitrack[:whole[0].size])
+
+    resampler = align.FrameResampler(optitrack)
+    runs = [resampler.resample(frame_times[run], amplitude[run], phase[run])
+                for run in np.split(np.arange(frame_times.size), [1, 2, 100, 100, 301])]
+    for index, expected in enumerate(whole):
+        np.testing.assert_allclose(np.concatenate([run[index] for run in runs]), expected, rtol=1e-6, atol=1e-6)
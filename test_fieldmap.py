@@ -0,0 +1,131 @@
+"""
+Checks that merging runs of samples into a field map gives the same
+statistics as a single pass over every sample, and that maps survive a save
+and load
+"""
+import numpy as np
+import pytest
+
+import fieldmap
+
+LOWER = (-1, -1, 0)
+UPPER = (1, 1, 2)
+VOXEL_SIZE = 0.5
+
+
+def _samples(n, seed=0):
+    """random positions in (and a little outside of) the grid, with a
+    (2, 3) value that depends on the position"""
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(-1.2, 2.2, (n, 3))
+    values = np.sin(positions[:, :1, np.newaxis] * np.arange(1, 4)) + rng.standard_normal( (n, 2, 3) )
+    return positions, values
+
+
+def _single_pass(fmap, positions, values):
+    """count, mean and sample variance of every voxel, straight from the
+    samples"""
+    index, inside = fmap.voxel_index(positions)
+    flat = np.ravel_multi_index(index[inside].T, fmap.shape)
+    values = values[inside]
+    count = np.bincount(flat, minlength=np.prod(fmap.shape))
+    mean = np.full( (count.size,) + fmap.value_shape, np.nan )
+    variance = np.full_like(mean, np.nan)
+    for voxel in np.flatnonzero(count):
+        mean[voxel] = values[flat == voxel].mean(axis=0)
+        if count[voxel] > 1:
+            variance[voxel] = values[flat == voxel].var(axis=0, ddof=1)
+    return (count.reshape(fmap.shape), mean.reshape(fmap.shape + fmap.value_shape),
+            variance.reshape(fmap.shape + fmap.value_shape))
+
+
+def test_merged_runs_match_single_pass():
+    positions, values = _samples(5000)
+    fmap = fieldmap.FieldMap.from_bounds(LOWER, UPPER, VOXEL_SIZE, (2, 3))
+    added = 0
+    for run in np.split(np.arange(5000), [1, 10, 700, 701, 3000]):
+        added += fmap.add(positions[run], values[run])
+
+    count, mean, variance = _single_pass(fmap, positions, values)
+    assert added == count.sum()
+    np.testing.assert_array_equal(fmap.count, count)
+    occupied = count > 0
+    np.testing.assert_allclose(fmap.mean[occupied], mean[occupied], rtol=1e-12, atol=1e-12)
+    np.testing.assert_allclose(fmap.variance, variance, rtol=1e-10, atol=1e-12)
+
+
+def test_non_finite_samples_are_ignored():
+    positions, values = _samples(100)
+    positions[0] = np.nan
+    values[1, 0, 0] = np.inf
+    fmap = fieldmap.FieldMap.from_bounds(LOWER, UPPER, VOXEL_SIZE, (2, 3))
+    fmap.add(positions, values)
+    assert np.all(np.isfinite(fmap.mean)) and np.all(np.isfinite(fmap.m2))
+    _, inside = fmap.voxel_index(positions[2:])
+    assert fmap.count.sum() == inside.sum()
+
+
+def test_lookup_and_interpolate():
+    fmap = fieldmap.FieldMap.from_bounds(LOWER, UPPER, VOXEL_SIZE)
+    # a linear field sampled at the voxel centers
+    centers = np.stack(np.meshgrid(*(fmap.lower[axis] + VOXEL_SIZE * (np.arange(n) + 0.5)
+                                        for axis, n in enumerate(fmap.shape)), indexing="ij"), axis=-1).reshape(-1, 3)
+    field = lambda positions: positions @ np.array([1., -2., 0.5])
+    fmap.add(centers, field(centers))
+
+    mean, variance, count = fmap.lookup(centers + 0.1)
+    np.testing.assert_allclose(mean, field(centers))
+    assert np.all(count == 1) and np.all(np.isnan(variance))
+
+    inner = np.random.default_rng(0).uniform(fmap.lower + VOXEL_SIZE / 2, fmap.upper - VOXEL_SIZE / 2, (100, 3))
+    np.testing.assert_allclose(fmap.interpolate(inner), field(inner))
+    assert np.isnan(fmap.lookup(np.array([[5., 5., 5.]]))[0][0])
+
+
+def test_save_load_round_trip(tmp_path):
+    directory = str(tmp_path / "map")
+    positions, values = _samples(2000)
+    fmap = fieldmap.FieldMap.from_bounds(LOWER, UPPER, VOXEL_SIZE, (2, 3))
+    fmap.add_capture("first", positions[:1000], values[:1000])
+    fmap.save(directory)
+
+    loaded = fieldmap.FieldMap.load(directory, mode="r")
+    assert loaded.captures == ["first"]
+    assert loaded.shape == fmap.shape and loaded.value_shape == (2, 3) and loaded.voxel_size == VOXEL_SIZE
+    np.testing.assert_array_equal(loaded.lower, fmap.lower)
+    for name in fieldmap.ARRAY_NAMES:
+        np.testing.assert_array_equal(getattr(loaded, name), getattr(fmap, name))
+
+    # a second capture folds into the saved map, once
+    updated = fieldmap.FieldMap.load(directory)
+    updated.add_capture("second", positions[1000:], values[1000:])
+    with pytest.raises(ValueError):
+        updated.add_capture("first", positions, values)
+    updated.save(directory)
+
+    reference = fieldmap.FieldMap.from_bounds(LOWER, UPPER, VOXEL_SIZE, (2, 3))
+    reference.add(positions, values)
+    loaded = fieldmap.FieldMap.load(directory, mode=None)
+    assert loaded.captures == ["first", "second"]
+    np.testing.assert_array_equal(loaded.count, reference.count)
+    np.testing.assert_allclose(loaded.mean, reference.mean, atol=1e-12)
+    np.testing.assert_allclose(loaded.m2, reference.m2, atol=1e-9)
+    # only the map directory is left behind
+    assert [path.name for path in tmp_path.iterdir()] == ["map"]
+
+
+def test_discard_leaves_saved_map(tmp_path):
+    directory = str(tmp_path / "map")
+    positions, values = _samples(200)
+    fmap = fieldmap.FieldMap.from_bounds(LOWER, UPPER, VOXEL_SIZE, (2, 3))
+    fmap.add_capture("first", positions, values)
+    fmap.save(directory)
+
+    updated = fieldmap.FieldMap.load(directory)
+    updated.add_capture("second", positions, values)
+    updated.discard()
+
+    loaded = fieldmap.FieldMap.load(directory, mode="r")
+    assert loaded.captures == ["first"]
+    np.testing.assert_array_equal(loaded.count, fmap.count)
+    assert [path.name for path in tmp_path.iterdir()] == ["map"]
@@ -0,0 +1,65 @@
+"""
+Checks that streaming the filter bank block by block gives the same output as
+filtering a capture in one piece, and that delay compensation lines the
+envelope up with zero-phase filtering
+"""
+import numpy as np
+from scipy import signal
+
+import filters
+
+FS = 100e3
+
+
+def _carriers(duration, seed=0):
+    """one channel per carrier, with a 0.1HZ amplitude envelope and a little
+    read noise
+
+    Returns:
+        np.ndarray : the envelope, shape (nsamples,)
+        np.ndarray : the capture, shape (nsamples, nbands)
+    """
+    t = np.arange(int(duration * FS)) / FS
+    envelope = 1 + 0.5 * np.sin(2 * np.pi * 0.1 * t)
+    data = np.stack([envelope * np.sin(2 * np.pi * center * t + 0.3) for center in filters.BAND_CENTERS], axis=1)
+    data += 0.01 * np.random.default_rng(seed).standard_normal(data.shape)
+    return envelope, data
+
+
+def _uneven_blocks(data):
+    """splits a capture into blocks of different sizes"""
+    return np.split(data, [1, 1000, 4097, 30000, 70001])
+
+
+def test_causal_blocks_match_sosfilt():
+    _, data = _carriers(1.0)
+    bank = filters.FilterBank(FS, mode="causal")
+    streamed = np.concatenate([bank.filter(block) for block in _uneven_blocks(data)])
+
+    expected = np.stack([signal.sosfilt(sos, data, axis=0) for sos in bank.sos], axis=-1)
+    np.testing.assert_array_equal(streamed, expected)
+
+
+def test_compensated_blocks_match_one_shot():
+    _, data = _carriers(1.0)
+    streamed = np.concatenate(list(filters.FilterBank(FS, mode="compensated").filter_blocks(_uneven_blocks(data))))
+
+    bank = filters.FilterBank(FS, mode="compensated")
+    expected = np.concatenate( (bank.filter(data), bank.flush()) )
+    assert streamed.shape == (data.shape[0], data.shape[1], bank.nbands)
+    np.testing.assert_array_equal(streamed, expected)
+
+
+def test_compensated_envelope_matches_zero_phase():
+    envelope, data = _carriers(6.0)
+    compensated = np.concatenate(list(filters.FilterBank(FS, mode="compensated").filter_blocks(_uneven_blocks(data))))
+    zero_phase = filters.FilterBank(FS, mode="zero-phase").filtfilt(data)
+
+    # the filters settle in ~5 group delays, zero-phase filtering has edge
+    # effects for as long at the end of the capture
+    settle = int(5 * filters.FilterBank(FS).group_delay().max())
+    for band in range(len(filters.BAND_CENTERS)):
+        compensated_envelope = np.abs(signal.hilbert(compensated[:, band, band]))[settle:-settle]
+        zero_phase_envelope = np.abs(signal.hilbert(zero_phase[:, band, band]))[settle:-settle]
+        error = np.abs(compensated_envelope - zero_phase_envelope)
+        assert np.all(error < 0.01 * envelope[settle:-settle])
@@ -0,0 +1,124 @@
+"""
+Checks that the results store gives back exactly what was written, whichever
+chunks a read window falls in
+"""
+import numpy as np
+
+import align
+import pipeline
+import resultstore
+
+FRAME_RATE = 100.
+
+
+def _result(nframes, first=0, start_time=5., seed=0):
+    """simulated products of frames `first` to `first + nframes`, with poses
+    on an optitrack clock that starts `start_time` seconds before the coils
+    """
+    rng = np.random.default_rng( (seed, first) )
+    frame_times = np.arange(first, first + nframes) / FRAME_RATE
+    pose = rng.standard_normal( (nframes, 9) )
+    pose[:, align.TIME_COLUMN] = frame_times + start_time
+    return pipeline.CoilResult(frame_times=frame_times,
+                                amplitude=rng.standard_normal( (nframes, 6, 3) ),
+                                relative_phase=rng.standard_normal( (nframes, 3, 3) ).astype(np.float32),
+                                theta=rng.standard_normal( (nframes, 3, 3) ),
+                                direction=rng.standard_normal( (nframes, 3, 3) ),
+                                field=rng.standard_normal( (nframes, 3) ),
+                                orientation=rng.standard_normal( (nframes, 4) ),
+                                pose=pose)
+
+
+def _runs(lengths, **kwargs):
+    """consecutive results of uneven lengths"""
+    starts = np.cumsum([0] + list(lengths))
+    return [_result(length, first, **kwargs) for first, length in zip(starts, lengths)]
+
+
+def _assert_equal(result, expected):
+    for name in pipeline.CoilResult._fields:
+        np.testing.assert_array_equal(getattr(result, name), getattr(expected, name))
+        assert getattr(result, name).dtype == getattr(expected, name).dtype
+
+
+def test_compression_round_trip():
+    array = np.random.default_rng(0).standard_normal( (1000, 3, 3) ).astype(np.float32)
+    array[::7] = np.nan
+    for level in (0, resultstore.DEFAULT_LEVEL, 9):
+        restored = resultstore.decompress(resultstore.compress(array, level), array.dtype.str, array.shape)
+        np.testing.assert_array_equal(restored, array)
+    # the byte shuffle makes smooth data compress well
+    smooth = np.linspace(0, 1, 10000)
+    assert len(resultstore.compress(smooth)) < smooth.nbytes / 2
+
+
+def test_write_read_round_trip(tmp_path):
+    runs = _runs([1, 30, 170, 0, 49, 333])
+    store = resultstore.ResultStore(str(tmp_path), chunk_frames=64)
+    stored = store.write("capture", runs, operator="test")
+    expected = pipeline.concatenate_results(runs)
+
+    assert stored.frames == 583
+    assert stored.nchunks == 10
+    assert stored.info == {"operator" : "test"}
+    _assert_equal(stored.read(), expected)
+    # and from a store that's opened again
+    _assert_equal(resultstore.ResultStore(str(tmp_path)).open("capture").read(), expected)
+
+
+def test_window_across_chunks(tmp_path):
+    store = resultstore.ResultStore(str(tmp_path), chunk_frames=64)
+    stored = store.write("capture", _runs([100, 200, 83]))
+    expected = pipeline.concatenate_results(_runs([100, 200, 83]))
+
+    # frames 60 to 200, the end of chunk 0 to the start of chunk 3
+    window = stored.read(t_start=0.6, t_stop=2.005)
+    keep = (expected.frame_times >= 0.6) & (expected.frame_times < 2.005)
+    np.testing.assert_array_equal(window.frame_times, expected.frame_times[keep])
+    np.testing.assert_array_equal(window.theta, expected.theta[keep])
+    assert window.frame_times[0] == 0.6 and window.frame_times[-1] == 2.0
+    assert list(stored.chunk_range(0.6, 2.005)) == [0, 1, 2, 3]
+
+    # a subset of the fields, coils and bands
+    subset = stored.read(t_start=0.6, t_stop=2.005, fields=("amplitude",), coils=[0, 2], bands=[1])
+    np.testing.assert_array_equal(subset.amplitude, expected.amplitude[keep][:, [0, 2]][:, :, [1]])
+    assert subset.theta is None
+
+    # an empty window keeps the shape of the fields
+    empty = stored.read(t_start=100)
+    assert empty.amplitude.shape == (0, 6, 3)
+
+
+def test_select_by_start_time(tmp_path):
+    store = resultstore.ResultStore(str(tmp_path), chunk_frames=64)
+    # 2s long captures, starting 5s and 20s into the session
+    store.write("early", _result(200, start_time=5.))
+    store.write("late", _result(200, start_time=20.))
+    store.write("explicit", _result(200, start_time=5.), start_time=40.)
+    # live captures have no poses, so no start time
+    unplaced = _result(200)
+    unplaced.pose[:, align.TIME_COLUMN] = np.nan
+    store.write("unplaced", unplaced)
+
+    assert store.open("early").start_time == 5.
+    assert store.open("explicit").start_time == 40.
+    assert store.open("unplaced").start_time is None
+    assert sorted(store.select()) == ["early", "explicit", "late", "unplaced"]
+    assert store.select(t_start=6, t_stop=7) == ["early"]
+    assert sorted(store.select(t_start=6)) == ["early", "explicit", "late"]
+    assert sorted(store.select(t_stop=21)) == ["early", "late"]
+    assert store.select(t_start=30, t_stop=35) == []
+
+
+def test_replace_capture(tmp_path):
+    store = resultstore.ResultStore(str(tmp_path), chunk_frames=64)
+    store.write("capture", _result(300, seed=1))
+    replacement = _result(120, seed=2)
+    stored = store.write("capture", replacement)
+
+    _assert_equal(stored.read(), replacement)
+    reopened = resultstore.ResultStore(str(tmp_path))
+    assert reopened.captures == ["capture"]
+    assert reopened.manifest["captures"]["capture"]["frames"] == 120
+    # nothing is left of the replaced capture
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["capture", resultstore.MANIFEST_FILENAME]
@@ -0,0 +1,107 @@
+"""
+Checks the orientation solver against known rotations, including the frames
+it can't solve
+"""
+import numpy as np
+
+import solver
+import util
+
+
+def _random_quaternions(n, seed=0):
+    """uniformly distributed unit quaternions (qx, qy, qz, qw), with qw >= 0"""
+    quaternions = np.random.default_rng(seed).standard_normal( (n, 4) )
+    quaternions /= np.linalg.norm(quaternions, axis=1, keepdims=True)
+    quaternions *= np.sign(quaternions[:, 3:])
+    return quaternions
+
+
+def _measure(quaternions, ncoils=3):
+    """the ideal normalized amplitude and relative phase of a rig in every
+    orientation, see `util.DataGenerator`"""
+    # projection[:, i, b] = field axis b . (rotation * coil axis i)
+    projection = util.rotation_matrices(quaternions).transpose(0, 2, 1)[:, :ncoils]
+    return np.abs(projection), np.where(projection < 0, np.pi, 0.)
+
+
+def _angle(q0, q1):
+    """angle of the rotation between quaternions in degrees"""
+    dot = np.abs(np.sum(q0 * q1, axis=-1))
+    return np.degrees(2 * np.arccos(np.clip(dot, 0, 1)))
+
+
+def test_quaternion_from_matrix_every_branch():
+    # half turns about x, y and z and no rotation pick each of the 4 branches
+    special = np.vstack([util.axis_angle_quaternions(axis, np.array([np.pi - 0.1])) for axis in "xyz"] + [[0, 0, 0, 1.]])
+    quaternions = np.vstack( (special, _random_quaternions(1000)) )
+    matrices = util.rotation_matrices(quaternions)
+
+    converted = solver.quaternion_from_matrix(matrices)
+    np.testing.assert_allclose(np.linalg.norm(converted, axis=1), 1)
+    assert np.max(_angle(converted, quaternions)) < 1e-5
+    np.testing.assert_allclose(util.rotation_matrices(converted), matrices, atol=1e-12)
+
+
+def test_known_rotation():
+    # a quarter turn about z maps coil x onto field y and coil y onto -x
+    quaternion = util.axis_angle_quaternions('z', np.array([np.pi / 2]))
+    amplitude, relative_phase = _measure(quaternion)
+    solution = solver.OrientationSolver(3, 3).solve(amplitude, relative_phase)
+
+    np.testing.assert_allclose(solution.theta[0], np.radians([[90, 0, 90], [180, 90, 90], [90, 90, 0]]), atol=1e-7)
+    np.testing.assert_array_equal(solution.direction[0], [[0, 0, 0], [1, 0, 0], [0, 0, 0]])
+    np.testing.assert_allclose(solution.field[0], [[0, -1, 0], [1, 0, 0], [0, 0, 1]], atol=1e-12)
+    assert _angle(solution.orientation, quaternion)[0] < 1e-5
+
+
+def test_random_rotations():
+    quaternions = _random_quaternions(2000, seed=1)
+    for ncoils in (2, 3):
+        amplitude, relative_phase = _measure(quaternions, ncoils)
+        solution = solver.OrientationSolver(ncoils, 3).solve(amplitude, relative_phase)
+        assert np.max(_angle(solution.orientation, quaternions)) < 1e-4
+
+
+def test_blocks_match_one_run():
+    quaternions = _random_quaternions(1000, seed=2)
+    amplitude, relative_phase = _measure(quaternions)
+    whole = solver.OrientationSolver(3, 3).solve(amplitude, relative_phase)
+
+    # the scratch arrays are grown and reused between runs of any length
+    streaming = solver.OrientationSolver(3, 3)
+    for run in np.split(np.arange(1000), [10, 500, 510, 999]):
+        solution = streaming.solve(amplitude[run], relative_phase[run])
+        for name in solver.Solution._fields:
+            np.testing.assert_array_equal(getattr(solution, name), getattr(whole, name)[run])
+
+
+def test_out_of_range_amplitudes_are_clipped():
+    quaternions = _random_quaternions(100, seed=3)
+    amplitude, relative_phase = _measure(quaternions)
+    amplitude *= 1.05
+    solution = solver.OrientationSolver(3, 3).solve(amplitude, relative_phase)
+    assert np.all(np.isfinite(solution.theta))
+    assert np.all((solution.theta >= 0) & (solution.theta <= np.pi))
+    assert np.all(np.isfinite(solution.orientation))
+
+
+def test_degenerate_frames_have_no_orientation():
+    quaternions = _random_quaternions(4, seed=4)
+    amplitude, relative_phase = _measure(quaternions)
+    # no signal at all, and parallel x and y field vectors
+    amplitude[1] = 0
+    amplitude[2, :, 1] = amplitude[2, :, 0]
+    relative_phase[2, :, 1] = relative_phase[2, :, 0]
+    solution = solver.OrientationSolver(3, 3, dtype=np.float32).solve(amplitude.astype(np.float32),
+                                                                        relative_phase.astype(np.float32))
+    assert np.all(np.isnan(solution.orientation[1:3]))
+    assert np.max(_angle(solution.orientation[[0, 3]], quaternions[[0, 3]])) < 0.05
+
+
+def test_rig_without_orientation():
+    assert not solver.can_orient(1, 3)
+    assert not solver.can_orient(3, 2)
+    amplitude = np.full( (5, 1, 3), 0.5 )
+    solution = solver.OrientationSolver(1, 3).solve(amplitude, np.zeros_like(amplitude))
+    np.testing.assert_allclose(solution.theta, np.pi / 3)
+    assert np.all(np.isnan(solution.field)) and np.all(np.isnan(solution.orientation))
@@ -0,0 +1,123 @@
+"""
+Checks which stages the stage cache recomputes when a parameter changes, and
+how entries are evicted and committed
+"""
+import os
+
+import numpy as np
+import pytest
+
+import calibration
+import pipeline
+import stagecache
+import util
+
+
+@pytest.fixture(scope="module")
+def simulated(tmp_path_factory):
+    """a short simulated csv capture and the calibration of its rig"""
+    directory = tmp_path_factory.mktemp("capture")
+    generator = util.DataGenerator(duration=1)
+    coil_filename = str(directory / "coil.csv")
+    optitrack_filename = str(directory / "optitrack.csv")
+    generator.write(coil_filename, optitrack_filename)
+    return coil_filename, optitrack_filename, generator.calib
+
+
+def _run(cache, calib, coil_filename, optitrack_filename):
+    """runs the pipeline, returning the result and the hits and misses of the
+    run"""
+    hits, misses = cache.hits, cache.misses
+    with pipeline.CoilPipeline(calib, cache=cache) as coil_pipeline:
+        result = coil_pipeline.run(coil_filename, optitrack_filename)
+    return result, cache.hits - hits, cache.misses - misses
+
+
+def _changed(calib, **fields):
+    """the calibration with some of its fields replaced"""
+    return calibration.Calibration.from_dict(dict(calib.to_dict(), **fields))
+
+
+def test_second_run_hits(simulated, tmp_path):
+    coil_filename, optitrack_filename, calib = simulated
+    cache = stagecache.StageCache(str(tmp_path))
+    first, hits, misses = _run(cache, calib, coil_filename, optitrack_filename)
+    assert hits == 0 and misses > 0
+    nentries = len(cache.entries())
+
+    second, hits, misses = _run(cache, calib, coil_filename, optitrack_filename)
+    assert (hits, misses) == (nentries, 0)
+    for name in pipeline.CoilResult._fields:
+        np.testing.assert_array_equal(getattr(second, name), getattr(first, name))
+
+    # the same as running without a cache
+    with pipeline.CoilPipeline(calib) as coil_pipeline:
+        uncached = coil_pipeline.run(coil_filename, optitrack_filename)
+    for name in pipeline.CoilResult._fields:
+        np.testing.assert_allclose(getattr(second, name), getattr(uncached, name), equal_nan=True)
+
+
+def test_calibration_change_only_solves(simulated, tmp_path):
+    coil_filename, optitrack_filename, calib = simulated
+    cache = stagecache.StageCache(str(tmp_path))
+    _run(cache, calib, coil_filename, optitrack_filename)
+    nentries = len(cache.entries())
+
+    changed = _changed(calib, phase_offset=(np.asarray(calib.phase_offset) + 0.1).tolist())
+    _, hits, misses = _run(cache, changed, coil_filename, optitrack_filename)
+    assert (hits, misses) == (nentries - 1, 1)
+    assert len(cache.entries()) == nentries + 1
+
+
+def test_butter_order_change_reuses_parse(simulated, tmp_path):
+    coil_filename, optitrack_filename, calib = simulated
+    cache = stagecache.StageCache(str(tmp_path))
+    _run(cache, calib, coil_filename, optitrack_filename)
+    before = set(key for _, _, key in cache.entries())
+
+    changed = _changed(calib, butter_order=calib.butter_order + 1)
+    _, hits, misses = _run(cache, changed, coil_filename, optitrack_filename)
+    # the parsed captures are reused, the demodulated and solved frames aren't
+    parse_keys = {cache.key("parse coil", cache.file_digest(coil_filename)),
+                    cache.key("parse optitrack", cache.file_digest(optitrack_filename))}
+    assert parse_keys < before
+    assert (hits, misses) == (2, len(before) - 2)
+    assert before < set(key for _, _, key in cache.entries())
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = stagecache.StageCache(str(tmp_path), max_bytes=3e5)
+    array = np.zeros(10000) # 80kB
+    for index, key in enumerate("abc"):
+        cache.put(key, {"array" : array})
+        # modification times can be coarse
+        os.utime(os.path.join(cache._path(key), stagecache.META_FILENAME), (index, index))
+    assert cache.get("a") is not None
+
+    cache.put("d", {"array" : array})
+    assert [key for _, _, key in cache.entries()] == ["c", "a", "d"]
+    assert cache.get("b") is None
+
+
+def test_oversized_entry_isnt_cached(tmp_path):
+    cache = stagecache.StageCache(str(tmp_path), max_bytes=1e5)
+    cache.put("small", {"array" : np.zeros(1000)})
+
+    entry = cache.put("large", {"array" : np.arange(20000.0)})
+    np.testing.assert_array_equal(entry["array"], np.arange(20000.0))
+    assert [key for _, _, key in cache.entries()] == ["small"]
+
+
+def test_commit_falls_back_to_written_arrays(tmp_path, monkeypatch):
+    cache = stagecache.StageCache(str(tmp_path))
+    # another process evicts the entry as soon as it is committed
+    monkeypatch.setattr(cache, "_open", lambda key: None)
+    misses = cache.misses
+
+    writer = cache.create("key", {"array" : ((5,), np.float64)}, {"stage" : "test"})
+    writer.arrays["array"][:] = np.arange(5)
+    entry = writer.commit({"frames" : 5})
+    np.testing.assert_array_equal(entry["array"], np.arange(5))
+    assert not entry["array"].flags.writeable
+    assert entry["meta"] == {"stage" : "test", "frames" : 5}
+    assert cache.misses == misses + 1
@@ -1,61 +1,324 @@
 import numpy as np
 import math
-import random
+
+import calibration
+import capture
 
 
 AXIS_FREQS = {'x':12e3, 'y':16e3, 'z':20e3}
 
+# names of the columns of the simulated captures
+OPTITRACK_COLUMNS = ["frame_index", "timestamp", "x", "y", "z", "qx", "qy", "qz", "qw"]
+
+# read noise is drawn in blocks of this many samples, each from its own seeded
+# generator, so any range of samples can be generated on its own and comes
+# out identical no matter how a capture is split into blocks
+NOISE_BLOCK_SIZE = 65536
+
 def arcmin2radians(arcmin):
     return math.radians(arcmin / 60)
 
+
+def _unit_axis(axis):
+    """a unit vector from a field axis name ('x', 'y', 'z') or a 3 vector"""
+    if isinstance(axis, str):
+        return np.eye(3)[list(AXIS_FREQS).index(axis)]
+    axis = np.asarray(axis, dtype=np.float64)
+    return axis / np.linalg.norm(axis)
+
+
+def axis_angle_quaternions(axis, angles):
+    """quaternions (qx, qy, qz, qw) for rotations about a single axis
+
+    Args:
+        axis (str or array_like): field axis name or a 3 vector
+        angles (np.ndarray): rotation angle in radians, shape (n,)
+
+    Returns:
+        np.ndarray : the quaternions, shape (n, 4)
+    """
+    half = angles / 2
+    quaternions = np.empty( (angles.shape[0], 4) )
+    quaternions[:,:3] = np.sin(half)[:,np.newaxis] * _unit_axis(axis)
+    quaternions[:,3] = np.cos(half)
+    return quaternions
+
+
+def rotation_matrices(quaternions):
+    """rotation matrices from quaternions (qx, qy, qz, qw)
+
+    Args:
+        quaternions (np.ndarray): unit quaternions, shape (n, 4)
+
+    Returns:
+        np.ndarray : the rotation matrices, shape (n, 3, 3)
+    """
+    x, y, z, w = quaternions.T
+    matrices = np.empty( (quaternions.shape[0], 3, 3) )
+    matrices[:,0,0] = 1 - 2*(y*y + z*z)
+    matrices[:,0,1] = 2*(x*y - z*w)
+    matrices[:,0,2] = 2*(x*z + y*w)
+    matrices[:,1,0] = 2*(x*y + z*w)
+    matrices[:,1,1] = 1 - 2*(x*x + z*z)
+    matrices[:,1,2] = 2*(y*z - x*w)
+    matrices[:,2,0] = 2*(x*z - y*w)
+    matrices[:,2,1] = 2*(y*z + x*w)
+    matrices[:,2,2] = 1 - 2*(x*x + y*y)
+    return matrices
+
+
+def spin(axis='x', rate=0.1, position=(0, 0, 0)):
+    """a trajectory that stays in place and rotates about a field axis
+
+    Args:
+        axis (str or array_like): field axis name or a 3 vector to rotate about
+        rate (float): rotation rate in revolutions per second
+        position (array_like): the (x, y, z) position of the coils
+
+    Returns:
+        callable : the trajectory, see `DataGenerator`
+    """
+    position = np.asarray(position, dtype=np.float64)
+    def trajectory(times):
+        positions = np.broadcast_to(position, (times.shape[0], 3))
+        return positions, axis_angle_quaternions(axis, 2 * np.pi * rate * times)
+    return trajectory
+
+
+def lissajous(lower=(-0.5, -0.5, -0.5), upper=(0.5, 0.5, 0.5), periods=(7, 11, 13), axis=(1, 1, 1), rate=0.1):
+    """a trajectory that sweeps a box along a lissajous curve while rotating,
+    for simulating a mapping session
+
+    Args:
+        lower (array_like): (x, y, z) of the lower corner of the box
+        upper (array_like): (x, y, z) of the upper corner of the box
+        periods (tuple): period of the motion along x, y and z (in seconds)
+        axis (str or array_like): field axis name or a 3 vector to rotate about
+        rate (float): rotation rate in revolutions per second
+
+    Returns:
+        callable : the trajectory, see `DataGenerator`
+    """
+    lower = np.asarray(lower, dtype=np.float64)
+    upper = np.asarray(upper, dtype=np.float64)
+    frequencies = 2 * np.pi / np.asarray(periods, dtype=np.float64)
+    def trajectory(times):
+        swing = np.sin(times[:,np.newaxis] * frequencies)
+        positions = lower + (upper - lower) * (swing + 1) / 2
+        return positions, axis_angle_quaternions(axis, 2 * np.pi * rate * times)
+    return trajectory
+
+
 class DataGenerator():
+    """Simulates coil and optitrack captures
+
+    The measurement coils are mounted along the coil body axes (x, y, z, then
+    repeating for more than 3 coils) and the reference coils are fixed along
+    the field axes. The body moves along `trajectory`, so in band b coil i sees
+        projection = field_axis_b . (rotation * coil_axis_i)
+        coil = sign(projection) * (cal_min + (cal_max - cal_min) * |projection|)
+                    * cos(2 pi f_b t + phase_offset)
+    and reference coil b sees its own carrier at `ref_coil_max` and the other
+    two carriers at `ref_coil_min`. Gaussian read noise with a standard
+    deviation of `mean_read_noise` is added to every channel, use the read
+    noise measured by `daq_noise_analysis.py` to simulate the real DAQ:
+
+        model = daq_noise_analysis.load_noise_model("daq_noise.npz")
+        generator = DataGenerator(mean_read_noise=model.read_noise(ncoils + 3), ncoils=ncoils)
+
+    Captures are generated in blocks of any size and every block can be
+    generated independently, so hours long captures are produced in constant
+    memory. The same seed always produces the same capture.
+
+    Args:
+        cal_max (array_like): coil amplitude when perpendicular to the field,
+            per band or shaped (ncoils, nbands)
+        cal_min (array_like): coil amplitude when parallel to the field,
+            per band or shaped (ncoils, nbands)
+        ref_coil_max (float): reference coil amplitude of its own carrier
+        ref_coil_min (float): reference coil amplitude of the other carriers
+        duration (float): length of the capture in seconds
+        mean_read_noise (array_like): standard deviation of the DAQ read
+            noise, for every channel or one value per channel (the
+            measurement coils then the reference coils)
+        ncoils (int): number of measurement coils
+        coil_sample_rate (float): DAQ sampling frequency (in HZ)
+        opti_sample_rate (float): optitrack frame rate (in HZ)
+        trajectory (callable): maps times (n,) in seconds to (x, y, z)
+            positions (n, 3) and coil to field quaternions (n, 4), defaults to
+            `spin()`
+        phase_offset (array_like): system phase offset in radians, per coil
+            or shaped (ncoils, nbands)
+        seed (int): seed of the read noise
+    """
     def __init__(self,
-                    cal_max,
-                    cal_min,
+                    cal_max=1,
+                    cal_min=0,
                     ref_coil_max=1,
                     ref_coil_min=0,
                     duration=60,
                     mean_read_noise=3e-3,
                     ncoils=3,
                     coil_sample_rate=1e5,
-                    opti_sample_rate=1e5,
+                    opti_sample_rate=120,
+                    trajectory=None,
+                    phase_offset=0,
+                    seed=0,
                     ):
 
         self.duration = duration
         self.mean_read_noise = mean_read_noise
-        self.ncoils = 3
+        self.ncoils = int(ncoils)
         self.coil_sample_rate = coil_sample_rate
         self.opti_sample_rate = opti_sample_rate
+        self.ref_coil_max = ref_coil_max
+        self.ref_coil_min = ref_coil_min
+        self.trajectory = spin() if trajectory is None else trajectory
+        self.seed = seed
 
+        # the calibration this rig would be measured to have
+        self.calib = calibration.Calibration(cal_max, cal_min, phase_offset, bands=tuple(AXIS_FREQS.values()))
+        self.calib.check_coils(self.ncoils)
+        self.freqs = np.array(list(AXIS_FREQS.values()))
+        self.coil_axes = np.eye(3)[np.arange(self.ncoils) % 3]
 
+        self.nsamples = int(round(duration * coil_sample_rate))
+        self.nframes = int(duration * opti_sample_rate) + 1
+        self.nchannels = self.ncoils + capture.NUM_REF_COILS
+        if np.ndim(mean_read_noise) and np.shape(mean_read_noise) != (self.nchannels,):
+            raise ValueError("mean_read_noise must be one value or one per channel ({}), got shape {}".format(
+                                self.nchannels, np.shape(mean_read_noise)))
 
-    def coil_data(self, axis, rate):
-        """Generates simulated coil data rotating about the specified axis
-        at the specified rate.
+    @property
+    def columns(self):
+        """the column names of the simulated coil capture"""
+        return (["timestamp"]
+                + ["coil{}".format(i + 1) for i in range(self.ncoils)]
+                + ["ref_coil{}".format(i + 1) for i in range(capture.NUM_REF_COILS)])
+
+    def coil_data(self, start=0, nsamples=None):
+        """Generates simulated coil data for a range of samples
+
+        Args:
+            start (int): index of the first sample
+            nsamples (int): number of samples, defaults to the rest of the capture
+
+        Returns:
+            capture.CoilBlock : the timestamps, coil and reference channels
+        """
+        if nsamples is None:
+            nsamples = self.nsamples - start
+        nsamples = max(min(nsamples, self.nsamples - start), 0)
+        index = np.arange(start, start + nsamples, dtype=np.float64)
+        timestamps = index / self.coil_sample_rate
+
+        # carrier phase in cycles. index * freq is exact in float64 for many
+        # hours of capture, unlike accumulating 2 pi f / fs sample by sample
+        cycles = np.mod(index[:,np.newaxis] * self.freqs, self.coil_sample_rate) / self.coil_sample_rate
+        carriers = np.cos(2 * np.pi * cycles)
+
+        # projection of every field axis onto every coil axis, shape (n, coils, bands)
+        _, quaternions = self.trajectory(timestamps)
+        projection = np.einsum("nbj,cj->ncb", rotation_matrices(quaternions), self.coil_axes)
+        calib = self.calib
+        amplitude = calib.min + (calib.max - calib.min) * np.abs(projection)
+        amplitude *= np.where(projection < 0, -1.0, 1.0)
+
+        if np.any(calib.phase_offset):
+            shifted = np.cos(2 * np.pi * cycles[:,np.newaxis,:] + calib.phase_offset)
+            coils = np.einsum("ncb,ncb->nc", amplitude, shifted)
+        else:
+            coils = np.einsum("ncb,nb->nc", amplitude, carriers)
+
+        refs = self.ref_coil_min * carriers.sum(axis=1, keepdims=True) + (self.ref_coil_max - self.ref_coil_min) * carriers
+
+        noise = self._noise(start, nsamples)
+        coils += noise[:,:self.ncoils]
+        refs += noise[:,self.ncoils:]
+        return capture.CoilBlock(start, timestamps, coils, refs)
+
+    def coil_blocks(self, block_size=capture.DEFAULT_BLOCK_SIZE):
+        """Generates the simulated coil capture one block at a time
+
+        Args:
+            block_size (int): number of samples per block
+
+        Yields:
+            capture.CoilBlock : consecutive blocks covering the whole capture
+        """
+        for start in range(0, self.nsamples, block_size):
+            yield self.coil_data(start, block_size)
+
+    def optitrack_data(self):
+        """Generates the simulated optitrack capture
+
+        Returns:
+            np.ndarray : rows of (frame_index, timestamp, x, y, z, qx, qy, qz, qw),
+                shape (nframes, 9)
         """
-        
-
-
-
-        # data = []
-        # references = []
-        # for axis, rate in zip(axes, rates):
-        #     # calculate the carrier wave (field) oscillations
-        #     nsamples_coil = self.coil_sample_rate * self.duration
-        #     max_phase = AXIS_FREQS[axis] * self.duration * 2 * np.pi
-        #
-        #     phi = np.linspace(0, max_phase, nsamples)
-        #     # calculate the reference coil output as a normalized
-        #     reference = np.sin(phi).reshape( (nsamples,1) )
-        #     max_emf = (reference * self.cal_max) + self.cal_min
-        #
-        #     # calculate the effect of the coil rotation on the waveform
-        #     max_rotation = rate * self.duration * 2 * np.pi
-        #     theta = np.linspace(0, max_rotation, nsamples).reshape((nsamples, 1))
-        #     rotation = np.sin(theta)
-        #
-        #     # we now construct the sample data by multiplying our rotation_waveform
-        #     # with our maximum emf as a function of time
-        #     data.append( (rotation * max_emf) )
-
-        return np.hstack( data ), reference
+        frames = np.arange(self.nframes, dtype=np.float64)
+        timestamps = frames / self.opti_sample_rate
+        positions, quaternions = self.trajectory(timestamps)
+        return np.column_stack( (frames, timestamps, positions, quaternions) )
+
+    def write(self, coil_filename, optitrack_filename, dtype="float32", block_size=capture.DEFAULT_BLOCK_SIZE):
+        """writes the simulated captures to disk, as csv files if the
+        filenames end in .csv and binary captures otherwise
+
+        Args:
+            coil_filename (str): path to write the coil capture to
+            optitrack_filename (str): path to write the optitrack capture to
+            dtype (str): channel dtype of binary captures
+            block_size (int): number of samples generated at a time
+        """
+        self.write_coil(coil_filename, dtype, block_size)
+        self.write_optitrack(optitrack_filename)
+
+    def write_coil(self, filename, dtype="float32", block_size=capture.DEFAULT_BLOCK_SIZE, nsamples=None):
+        """writes the simulated coil capture to disk
+
+        Args:
+            filename (str): path to write the coil capture to
+            dtype (str): channel dtype of binary captures
+            block_size (int): number of samples generated at a time
+            nsamples (int): only write the first `nsamples` samples, defaults
+                to the whole capture
+        """
+        nsamples = self.nsamples if nsamples is None else min(nsamples, self.nsamples)
+        blocks = (self.coil_data(start, min(block_size, nsamples - start)) for start in range(0, nsamples, block_size))
+        rows = ((block.start, np.column_stack( (block.timestamps, block.coils, block.refs) )) for block in blocks)
+        self._write(filename, rows, self.columns, nsamples, "coil", dtype)
+
+    def write_optitrack(self, filename):
+        """writes the simulated optitrack capture to disk
+
+        Args:
+            filename (str): path to write the optitrack capture to
+        """
+        # optitrack captures are small, keep the poses at full precision
+        self._write(filename, [(0, self.optitrack_data())], OPTITRACK_COLUMNS, self.nframes, "optitrack", "float64")
+
+    def _write(self, filename, blocks, columns, nsamples, kind, dtype):
+        if filename.lower().endswith(".csv"):
+            with open(filename, 'w') as f:
+                f.write(",".join(columns) + "\n")
+                # 9 digits are plenty for voltages, but not for the timestamps
+                # of captures longer than ~1000s at 100kS/s
+                fmt = ["%.17g" if column == "timestamp" else "%.9g" for column in columns]
+                for _, rows in blocks:
+                    np.savetxt(f, rows, delimiter=",", fmt=fmt)
+        else:
+            capture.write_capture(filename, blocks, columns, nsamples, kind, dtype)
+
+    def _noise(self, start, nsamples):
+        """read noise for a range of samples, shape (nsamples, nchannels)"""
+        if nsamples == 0 or not np.any(self.mean_read_noise):
+            return np.zeros( (nsamples, self.nchannels) )
+        first = start // NOISE_BLOCK_SIZE
+        last = (start + nsamples - 1) // NOISE_BLOCK_SIZE
+        noise = np.concatenate([np.random.default_rng( (self.seed, block) ).standard_normal( (NOISE_BLOCK_SIZE, self.nchannels) )
+                                    for block in range(first, last + 1)])
+        offset = start - first * NOISE_BLOCK_SIZE
+        noise = noise[offset:offset + nsamples]
+        noise *= self.mean_read_noise
+        return noise